@@ -0,0 +1,51 @@
+"""CLI to check that an encoder at reduced precision matches the fp32 encoder."""
+
+import json
+
+import click
+
+from src import config
+from src.ml import ENCODER_BACKENDS, PRECISIONS, load_encoder
+from src.parity import precision_parity_report
+
+
+@click.command()
+@click.option(
+    "--precision",
+    type=click.Choice([precision for precision in PRECISIONS if precision != "fp32"]),
+    required=True,
+    help="Precision to compare against fp32.",
+)
+@click.option(
+    "--reference-backend",
+    type=click.Choice(list(ENCODER_BACKENDS)),
+    default="torch",
+    help="Backend to run the fp32 reference encoder with. Reduced precisions always "
+    "run with torch.",
+)
+def run_as_cli(precision: str, reference_backend: str):
+    """
+    Print a report comparing embeddings at a reduced precision with fp32 embeddings.
+
+    Both encoders embed a fixed sample of texts, and the cosine similarities between
+    each pair of embeddings are summarised as JSON.
+    """
+    reference = load_encoder(
+        config.SBERT_MODEL, backend=reference_backend, precision="fp32"
+    )
+    candidate = load_encoder(config.SBERT_MODEL, backend="torch", precision=precision)
+
+    report = precision_parity_report(reference, candidate)
+    report.update(
+        {
+            "model": config.SBERT_MODEL,
+            "precision": precision,
+            "reference_backend": reference_backend,
+        }
+    )
+
+    click.echo(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    run_as_cli()
@@ -7,6 +7,8 @@ import pytest
 from cpr_sdk.parser_models import BlockType, HTMLTextBlock
 from moto import mock_aws
 
+from src.s3 import reset_s3_client
+
 
 class S3Client:
     """Helper class to connect to S3 and perform actions on buckets and documents."""
@@ -1114,6 +1116,8 @@ def pipeline_s3_objects_main(
 @pytest.fixture
 def pipeline_s3_client_main(s3_bucket_and_region, pipeline_s3_objects_main):
     with mock_aws():
+        # The shared client has to be created inside the mock
+        reset_s3_client()
         s3_client = S3Client(s3_bucket_and_region["region"])
 
         s3_client.client.create_bucket(
@@ -1132,6 +1136,8 @@ def pipeline_s3_client_main(s3_bucket_and_region, pipeline_s3_objects_main):
 
         yield s3_client
 
+    reset_s3_client()
+
 
 def get_html_text_block(text_block_type: str) -> HTMLTextBlock:
     """Returns a HTMLTextBlock object with the given type."""
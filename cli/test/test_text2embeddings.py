@@ -1,6 +1,11 @@
+import copy
 import io
 import json
 import logging
+import os
+import signal
+import subprocess
+import sys
 import tempfile
 from pathlib import Path
 
@@ -8,7 +13,13 @@ import numpy as np
 from click.testing import CliRunner
 from cpr_sdk.parser_models import ParserOutput
 
+from cli import text2embeddings
 from cli.text2embeddings import run_as_cli
+from src import config
+from src.batching import get_text_hash
+from src.manifest import CheckpointManifest, get_embeddings_hash, get_input_versions
+from src.shutdown import INTERRUPTED_EXIT_CODE
+from src.utils import get_files_to_process
 
 
 def test_run_encoder_local(
@@ -168,3 +179,313 @@ def test_run_parser_skip_already_done(
             )
 
             assert "No more documents to encode. Exiting." in all_messages
+            # Skipped documents don't have their JSON rewritten
+            assert not list(Path(output_dir).glob("*.json"))
+
+
+def test_run_parser_redo(test_pdf_file_json) -> None:
+    """Test that --redo encodes documents which already have embeddings."""
+
+    with tempfile.TemporaryDirectory() as input_dir:
+        with tempfile.TemporaryDirectory() as output_dir:
+            document_id = test_pdf_file_json["document_id"]
+            (Path(input_dir) / f"{document_id}.json").write_text(
+                json.dumps(test_pdf_file_json)
+            )
+            np.save(Path(output_dir) / f"{document_id}.npy", np.zeros((1, 3)))
+
+            runner = CliRunner()
+            result = runner.invoke(run_as_cli, [input_dir, output_dir, "--redo"])
+
+            assert result.exit_code == 0
+            assert (Path(output_dir) / f"{document_id}.json").exists()
+            assert np.load(Path(output_dir) / f"{document_id}.npy").shape[1] == 768
+
+
+def test_run_encoder_resumes_from_manifest(
+    test_pdf_file_json, tmp_path, monkeypatch
+) -> None:
+    """Test that a rerun skips documents in the checkpoint manifest, and no others."""
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", str(tmp_path / "manifest"))
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for document_id in ["doc_a", "doc_b"]:
+        (input_dir / f"{document_id}.json").write_text(
+            json.dumps({**test_pdf_file_json, "document_id": document_id})
+        )
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+    entries = CheckpointManifest(str(tmp_path / "manifest")).load()
+    assert set(entries) == {"doc_a", "doc_b"}
+
+    # Simulate an interrupted upload, which left doc_b's .npy without its .json.
+    # A new run only trusts the manifest, so encodes doc_b again.
+    (output_dir / "doc_b.json").unlink()
+    for segment in (tmp_path / "manifest").glob("*.jsonl"):
+        segment.write_text(
+            "".join(
+                line + "\n"
+                for line in segment.read_text().splitlines()
+                if "doc_b" not in line
+            )
+        )
+    (output_dir / "doc_a.npy").write_bytes(b"unchanged")
+
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+    assert (output_dir / "doc_b.json").exists()
+    assert (output_dir / "doc_a.npy").read_bytes() == b"unchanged"
+
+    # Documents encoded with another model are only redone with --redo-stale
+    for segment in (tmp_path / "manifest").glob("*.jsonl"):
+        segment.write_text(
+            segment.read_text().replace(entries["doc_a"].model_id, "old-model")
+        )
+    result = runner.invoke(
+        run_as_cli, [str(input_dir), str(output_dir), "--redo-stale"]
+    )
+    assert result.exit_code == 0
+    assert np.load(output_dir / "doc_a.npy").shape[1] == 768
+
+
+def test_run_encoder_reencodes_changed_inputs(
+    test_pdf_file_json, tmp_path, monkeypatch
+) -> None:
+    """Test that a rerun encodes documents whose input changed, and skips others."""
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", str(tmp_path / "manifest"))
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for document_id in ["doc_a", "doc_b"]:
+        (input_dir / f"{document_id}.json").write_text(
+            json.dumps({**test_pdf_file_json, "document_id": document_id})
+        )
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+
+    for document_id in ["doc_a", "doc_b"]:
+        (output_dir / f"{document_id}.npy").write_bytes(b"unchanged")
+    (input_dir / "doc_b.json").write_text(
+        json.dumps(
+            {**test_pdf_file_json, "document_id": "doc_b", "document_name": "new"}
+        )
+    )
+
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+    assert (output_dir / "doc_a.npy").read_bytes() == b"unchanged"
+    assert np.load(output_dir / "doc_b.npy").shape[1] == 768
+    assert json.loads((output_dir / "doc_b.json").read_text())["document_name"] == (
+        "new"
+    )
+
+
+def test_run_encoder_files_to_process_records_input_versions(
+    test_pdf_file_json, tmp_path, monkeypatch
+) -> None:
+    """Test that a run over FILES_TO_PROCESS records the inputs' versions too."""
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", str(tmp_path / "manifest"))
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for document_id in ["doc_a", "doc_b"]:
+        (input_dir / f"{document_id}.json").write_text(
+            json.dumps({**test_pdf_file_json, "document_id": document_id})
+        )
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+
+    monkeypatch.setattr(config, "FILES_TO_PROCESS", "$doc_a.json")
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir), "--redo"])
+    assert result.exit_code == 0
+
+    entries = CheckpointManifest(str(tmp_path / "manifest")).load()
+    input_versions = get_input_versions(str(input_dir), s3=False)
+    for document_id in ["doc_a", "doc_b"]:
+        assert entries[document_id].input_etag == input_versions[document_id].etag
+
+
+def test_run_encoder_records_finished_documents_on_error(
+    test_pdf_file_json, tmp_path, monkeypatch, pipeline_s3_client_main
+) -> None:
+    """Test that documents finished before an error are in the manifest."""
+    manifest_path = "s3://test-bucket/manifest"
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", manifest_path)
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for document_id in ["doc_a", "doc_b"]:
+        (input_dir / f"{document_id}.json").write_text(
+            json.dumps({**test_pdf_file_json, "document_id": document_id})
+        )
+
+    encode_parser_outputs = text2embeddings.encode_parser_outputs
+
+    def encode_then_fail(*args, **kwargs):
+        outputs = encode_parser_outputs(*args, **kwargs)
+        yield next(outputs)
+        raise RuntimeError("encoding failed")
+
+    monkeypatch.setattr(text2embeddings, "encode_parser_outputs", encode_then_fail)
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+
+    assert isinstance(result.exception, RuntimeError)
+    assert set(CheckpointManifest(manifest_path).load()) == {"doc_a"}
+    assert (output_dir / "doc_a.npy").exists()
+
+
+def test_run_encoder_stops_on_sigterm(
+    test_pdf_file_json, tmp_path, monkeypatch
+) -> None:
+    """Test that SIGTERM stops the run early, saving progress and exiting distinctly."""
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", str(tmp_path / "manifest"))
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    (input_dir / "doc_a.json").write_text(
+        json.dumps({**test_pdf_file_json, "document_id": "doc_a"})
+    )
+
+    def get_files_then_sigterm(*args, **kwargs):
+        files_to_process = get_files_to_process(*args, **kwargs)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return files_to_process
+
+    monkeypatch.setattr(text2embeddings, "get_files_to_process", get_files_then_sigterm)
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+
+    assert result.exit_code == INTERRUPTED_EXIT_CODE
+    assert not (output_dir / "doc_a.npy").exists()
+    assert CheckpointManifest(str(tmp_path / "manifest")).load() == {}
+
+
+def update_manifest_entries(manifest_dir: Path, **fields) -> None:
+    """Overwrite fields of every entry in a local checkpoint manifest."""
+    for segment in manifest_dir.glob("*.jsonl"):
+        segment.write_text(
+            "".join(
+                json.dumps({**json.loads(line), **fields}) + "\n"
+                for line in segment.read_text().splitlines()
+            )
+        )
+
+
+def test_run_encoder_incremental(test_pdf_file_json, tmp_path, monkeypatch) -> None:
+    """Test that --incremental only encodes the changed text blocks of a document."""
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", str(tmp_path / "manifest"))
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    input_path = input_dir / f"{test_pdf_file_json['document_id']}.json"
+    embeddings_path = output_dir / f"{test_pdf_file_json['document_id']}.npy"
+    input_path.write_text(json.dumps(test_pdf_file_json))
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+
+    # Mark the previous embeddings, then change the text of the first text block
+    n_rows, dimension = np.load(embeddings_path).shape
+    marked_embeddings = np.ones((n_rows, dimension), dtype=np.float32)
+    np.save(embeddings_path, marked_embeddings)
+    update_manifest_entries(
+        tmp_path / "manifest", npy_sha256=get_embeddings_hash(marked_embeddings)
+    )
+    changed_file_json = copy.deepcopy(test_pdf_file_json)
+    changed_file_json["pdf_data"]["text_blocks"][0]["text"] = ["A new paragraph."]
+    input_path.write_text(json.dumps(changed_file_json))
+
+    result = runner.invoke(
+        run_as_cli, [str(input_dir), str(output_dir), "--redo", "--incremental"]
+    )
+    assert result.exit_code == 0
+
+    embeddings = np.load(embeddings_path)
+    assert embeddings.shape == (n_rows, dimension)
+    reused_rows = [row for row in range(n_rows) if np.all(embeddings[row] == 1)]
+    assert reused_rows == [row for row in range(n_rows) if row != 1]
+
+    # Nothing is reused from outputs the manifest records as made by another model
+    np.save(embeddings_path, marked_embeddings)
+    update_manifest_entries(
+        tmp_path / "manifest",
+        model_id="old-model",
+        npy_sha256=get_embeddings_hash(marked_embeddings),
+    )
+    result = runner.invoke(
+        run_as_cli, [str(input_dir), str(output_dir), "--redo", "--incremental"]
+    )
+    assert result.exit_code == 0
+    assert not np.any(np.all(np.load(embeddings_path) == 1, axis=1))
+
+
+def test_run_encoder_incremental_out_of_sync_outputs(
+    test_pdf_file_json, tmp_path, monkeypatch
+) -> None:
+    """Test that --incremental doesn't pair a new .json with an old .npy."""
+    monkeypatch.setattr(config, "CHECKPOINT_MANIFEST_DIR", str(tmp_path / "manifest"))
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    document_id = test_pdf_file_json["document_id"]
+    input_path = input_dir / f"{document_id}.json"
+    embeddings_path = output_dir / f"{document_id}.npy"
+    input_path.write_text(json.dumps(test_pdf_file_json))
+
+    runner = CliRunner()
+    result = runner.invoke(run_as_cli, [str(input_dir), str(output_dir)])
+    assert result.exit_code == 0
+
+    n_rows, dimension = np.load(embeddings_path).shape
+    marked_embeddings = np.ones((n_rows, dimension), dtype=np.float32)
+    np.save(embeddings_path, marked_embeddings)
+    update_manifest_entries(
+        tmp_path / "manifest", npy_sha256=get_embeddings_hash(marked_embeddings)
+    )
+
+    # A run stopped after writing the changed document's .json, but not its .npy
+    changed_file_json = copy.deepcopy(test_pdf_file_json)
+    changed_file_json["pdf_data"]["text_blocks"][0]["text"] = ["A new paragraph."]
+    input_path.write_text(json.dumps(changed_file_json))
+    (output_dir / f"{document_id}.json").write_text(json.dumps(changed_file_json))
+
+    result = runner.invoke(
+        run_as_cli, [str(input_dir), str(output_dir), "--redo", "--incremental"]
+    )
+    assert result.exit_code == 0
+    embeddings = np.load(embeddings_path)
+    assert not np.any(np.all(embeddings == 1, axis=1))
+
+    entry = CheckpointManifest(str(tmp_path / "manifest")).load()[document_id]
+    assert entry.npy_sha256 == get_embeddings_hash(embeddings)
+    assert entry.json_sha256 == get_text_hash(
+        (output_dir / f"{document_id}.json").read_text()
+    )
+
+
+def test_cli_import_does_not_load_torch():
+    """Test that torch and sentence-transformers are only imported once the encoder loads."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, cli.text2embeddings; "
+            "assert 'torch' not in sys.modules, 'torch imported'; "
+            "assert 'sentence_transformers' not in sys.modules, "
+            "'sentence_transformers imported'",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
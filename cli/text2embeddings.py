@@ -1,25 +1,44 @@
 """CLI to convert JSON documents outputted by the PDF parsing pipeline to embeddings."""
 
+import functools
 import logging
 import logging.config
 import os
-from pathlib import Path
-from typing import Optional
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple, Union
 
 import click
-import numpy as np
+from cpr_sdk.parser_models import ParserOutput
 from tqdm.auto import tqdm
 
-from src.languages import get_docs_of_supported_language
-from src.ml import SBERTEncoder
+from src.batching import encode_parser_outputs, get_text_hash
+from src.cache import CachedEncoder, EmbeddingCache
+from src.incremental import PreviousOutputs
+from src.languages import iter_docs_of_supported_language
+from src.manifest import (
+    CheckpointManifest,
+    InputVersion,
+    ManifestEntry,
+    get_changed_input_ids,
+    get_embeddings_hash,
+    get_input_versions,
+)
+from src.ml import ENCODER_BACKENDS, PRECISIONS, SBERTEncoder, load_encoder
 from src import config
 from src.utils import (
-    filter_on_block_type,
-    encode_parser_output,
     get_files_to_process,
-    get_Text2EmbeddingsInput_array,
+    get_files_to_process_subset,
+    get_ids_with_suffix,
+    iter_filter_on_block_type,
+    iter_Text2EmbeddingsInput,
+    log_duration,
 )
-from src.s3 import check_file_exists_in_s3, write_json_to_s3, save_ndarray_to_s3_as_npy
+from src.pipeline import buffered, take_until
+from src.shutdown import INTERRUPTED_EXIT_CODE, RunInterrupted, handle_sigterm
+from src.workers import ParallelEncoder, get_available_cores, is_oversubscribed
+from src.writer import BackgroundWriter, OutputIndex
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 DEFAULT_LOGGING = {
@@ -44,6 +63,127 @@ logger = logging.getLogger(__name__)
 logging.config.dictConfig(DEFAULT_LOGGING)
 
 
+def iter_tasks_to_encode(
+    tasks: Iterable[ParserOutput],
+    output_index: OutputIndex,
+    redo: bool,
+    previous_outputs: Optional[PreviousOutputs] = None,
+    changed_ids: Optional[Set[str]] = None,
+) -> Iterator[ParserOutput]:
+    """
+    Yield the tasks to encode.
+
+    Unless `redo` is set or the task is in `changed_ids`, tasks whose embeddings file
+    is already in the output index are skipped, so they don't cost any requests.
+
+    If `previous_outputs` is given, each task's previous outputs are loaded into it.
+    Its new outputs are only written once it's encoded, so the previous ones are
+    still in place.
+    """
+    for task in tasks:
+        embeddings_file_name = task.document_id + ".npy"
+        if (
+            not redo
+            and embeddings_file_name in output_index
+            and task.document_id not in (changed_ids or set())
+        ):
+            logger.info(
+                f"Embeddings output file '{embeddings_file_name}' already exists, "
+                "skipping processing.",
+                extra={"props": {"document_id": task.document_id}},
+            )
+            continue
+
+        logger.info(
+            f"Processing document {task.document_id}.",
+            extra={
+                "props": {
+                    "lang": task.languages,
+                    "translated": task.translated,
+                    "document_id": task.document_id,
+                }
+            },
+        )
+        if previous_outputs is not None:
+            previous_outputs.load(task.document_id)
+
+        yield task
+
+
+def load_output_index(
+    output_dir: str,
+    s3: bool,
+    manifest: Optional[CheckpointManifest],
+    stale_model_id: Optional[str] = None,
+) -> Tuple[OutputIndex, Dict[str, ManifestEntry]]:
+    """
+    Build the index of finished outputs, from the checkpoint manifest if there is one.
+
+    With a manifest, only documents it records as finished count as done, and the
+    output directory isn't listed. The first time a manifest is used, the output
+    directory is listed instead, and documents with both outputs are imported into
+    the manifest without a model id.
+
+    :param stale_model_id: if set, leave documents whose manifest entry wasn't made
+        with this model out of the index, so they're encoded again
+    :return tuple[OutputIndex, dict[str, ManifestEntry]]: the index, and the
+        manifest entries of the documents in it
+    """
+    if manifest is None:
+        return OutputIndex.from_listing(output_dir, s3), {}
+
+    entries = manifest.load()
+    if not entries:
+        output_file_names = OutputIndex.from_listing(output_dir, s3).file_names
+        entries = {
+            document_id: ManifestEntry(document_id=document_id, model_id=None)
+            for document_id in get_ids_with_suffix(list(output_file_names), ".npy")
+            if document_id + ".json" in output_file_names
+        }
+        manifest.record_many(entries.values())
+        logger.info(
+            f"Imported {len(entries)} finished documents into the checkpoint manifest.",
+            extra={"props": {"manifest": manifest.path}},
+        )
+
+    if stale_model_id is not None:
+        stale_ids = {
+            document_id
+            for document_id, entry in entries.items()
+            if entry.is_stale(stale_model_id)
+        }
+        logger.info(
+            f"Found {len(stale_ids)} documents encoded with a different model.",
+            extra={"props": {"model_id": stale_model_id}},
+        )
+        entries = {
+            document_id: entry
+            for document_id, entry in entries.items()
+            if document_id not in stale_ids
+        }
+
+    output_index = OutputIndex(
+        file_name for entry in entries.values() for file_name in entry.file_names
+    )
+    return output_index, entries
+
+
+def load_run_encoder(
+    workers: int, threads_per_worker: Optional[int], encoder_kwargs: dict
+) -> Union[SBERTEncoder, ParallelEncoder]:
+    """Load the encoder for a run, with a pool of workers if `workers` > 1."""
+    with log_duration("Loading the encoder"):
+        if workers > 1:
+            return ParallelEncoder(
+                config.SBERT_MODEL,
+                n_workers=workers,
+                threads_per_worker=threads_per_worker,
+                **encoder_kwargs,
+            )
+
+        return load_encoder(config.SBERT_MODEL, **encoder_kwargs)
+
+
 @click.command()
 @click.argument(
     "input-dir",
@@ -65,6 +205,21 @@ logging.config.dictConfig(DEFAULT_LOGGING)
     is_flag=True,
     default=False,
 )
+@click.option(
+    "--redo-stale",
+    help="Redo encoding for documents which the checkpoint manifest records as "
+    "encoded with a different model. Needs CHECKPOINT_MANIFEST_DIR to be set.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--incremental",
+    help="When encoding a document which already has outputs, reuse the "
+    "embeddings of its unchanged text blocks and only encode new or changed ones. "
+    "Needs CHECKPOINT_MANIFEST_DIR, which records the model of the previous outputs.",
+    is_flag=True,
+    default=False,
+)
 @click.option(
     "--device",
     type=click.Choice(["cuda", "mps", "cpu"]),
@@ -78,13 +233,46 @@ logging.config.dictConfig(DEFAULT_LOGGING)
     default=None,
     help="Optionally limit the number of text samples to process. Useful for debugging.",
 )
+@click.option(
+    "--backend",
+    type=click.Choice(list(ENCODER_BACKENDS)),
+    help="Backend to run the encoder with. The onnx backend only runs on CPU.",
+    default=config.ENCODER_BACKEND,
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    help="Numerical precision to run the encoder in. int8 applies dynamic "
+    "quantisation and bf16 runs under bfloat16 autocast. Both only run on CPU.",
+    default=config.ENCODER_PRECISION,
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of CPU worker processes to encode with. Each worker is pinned to "
+    "its own set of cores.",
+    default=config.ENCODING_WORKERS,
+)
+@click.option(
+    "--threads-per-worker",
+    type=click.IntRange(min=1),
+    help="Number of torch threads per worker process. Defaults to the number of "
+    "cores each worker is pinned to.",
+    default=None,
+)
 def run_as_cli(
     input_dir: str,
     output_dir: str,
     s3: bool,
     redo: bool,
+    redo_stale: bool,
+    incremental: bool,
     device: str,
     limit: Optional[int],
+    backend: str,
+    precision: str,
+    workers: int,
+    threads_per_worker: Optional[int],
 ):
     """
     Run CLI to produce embeddings from document parser JSON outputs.
@@ -97,20 +285,38 @@ def run_as_cli(
     Args: input_dir: Directory containing JSON files output_dir: Directory to save
     embeddings to s3: Whether we are reading from and writing to S3. redo: Redo
     encoding for files that have already been parsed. By default, files with IDs that
-    already exist in the output directory are skipped. limit (Optional[int]):
+    already exist in the output directory are skipped. redo_stale: Redo encoding for
+    documents the checkpoint manifest records as encoded with a different model.
+    incremental: Reuse the embeddings of unchanged text blocks from a document's
+    previous outputs. limit (Optional[int]):
     Optionally limit the number of text samples to process. Useful for debugging.
     device (str): Device to use for embeddings generation. Must be either "cuda", "mps",
-    or "cpu".
+    or "cpu". backend (str): Backend to run the encoder with, "torch" or "onnx".
+    precision (str): Numerical precision to run the encoder in. workers (int): Number
+    of CPU worker processes to encode with. threads_per_worker (Optional[int]): Number
+    of torch threads per worker process.
     """
 
-    return run_embeddings_generation(
-        input_dir=input_dir,
-        output_dir=output_dir,
-        s3=s3,
-        redo=redo,
-        device=device,
-        limit=limit,
-    )
+    with handle_sigterm() as shutdown:
+        try:
+            return run_embeddings_generation(
+                input_dir=input_dir,
+                output_dir=output_dir,
+                s3=s3,
+                redo=redo,
+                redo_stale=redo_stale,
+                incremental=incremental,
+                device=device,
+                limit=limit,
+                backend=backend,
+                precision=precision,
+                workers=workers,
+                threads_per_worker=threads_per_worker,
+                shutdown=shutdown,
+            )
+        except RunInterrupted as e:
+            logger.warning(str(e))
+            sys.exit(INTERRUPTED_EXIT_CODE)
 
 
 def run_embeddings_generation(
@@ -120,12 +326,24 @@ def run_embeddings_generation(
     redo: bool,
     device: str,
     limit: Optional[int],
+    backend: str = "torch",
+    precision: str = "fp32",
+    workers: int = 1,
+    threads_per_worker: Optional[int] = None,
+    redo_stale: bool = False,
+    shutdown: Optional[threading.Event] = None,
+    incremental: bool = False,
 ):
     """
     Run CLI to produce embeddings from document parser JSON outputs.
 
     See docstring for run_as_cli for details.
+
+    If `shutdown` is set during the run, no more documents are taken. Documents whose
+    texts are all encoded are written, but texts still queued aren't encoded. Outputs
+    and the checkpoint manifest are flushed, and RunInterrupted is raised.
     """
+    shutdown = shutdown or threading.Event()
 
     logger.info(
         "Running embeddings generation...",
@@ -135,106 +353,282 @@ def run_embeddings_generation(
                 "output_dir": output_dir,
                 "s3": s3,
                 "redo": redo,
+                "redo_stale": redo_stale,
+                "incremental": incremental,
                 "device": device,
                 "limit": limit,
+                "backend": backend,
+                "precision": precision,
+                "workers": workers,
+                "threads_per_worker": threads_per_worker,
             }
         },
     )
 
-    logger.info("Identifying files to process.")
-    files_to_process_ids = get_files_to_process(s3, input_dir, output_dir, redo, limit)
     logger.info(
-        f"Found {len(files_to_process_ids)} files to process.",
-        extra={"props": {"files_to_process_ids": files_to_process_ids}},
+        f"Loading sentence-transformer model {config.SBERT_MODEL} in the background",
+        extra={"props": {"backend": backend, "precision": precision}},
+    )
+    encoder_kwargs = dict(
+        backend=backend,
+        precision=precision,
+        weight_windows_by_new_tokens=config.ENCODING_WEIGHT_WINDOWS_BY_NEW_TOKENS,
     )
+    if workers > 1:
+        if device != "cpu":
+            raise ValueError("Encoding with multiple workers is only supported on CPU.")
 
-    logger.info("Constructing Text2EmbeddingsInput objects from parser output jsons.")
-    tasks = get_Text2EmbeddingsInput_array(input_dir, s3, files_to_process_ids)
+        n_cores = len(get_available_cores())
+        if is_oversubscribed(workers, threads_per_worker or max(n_cores // workers, 1)):
+            logger.warning(
+                "The encoding workers have more threads than there are CPU cores, "
+                "which will slow encoding down. Reduce --workers or "
+                "--threads-per-worker.",
+                extra={
+                    "props": {
+                        "workers": workers,
+                        "threads_per_worker": threads_per_worker,
+                        "n_cores": n_cores,
+                    }
+                },
+            )
+
+    if redo_stale and not config.CHECKPOINT_MANIFEST_DIR:
+        raise ValueError("--redo-stale needs CHECKPOINT_MANIFEST_DIR to be set.")
 
+    # Load the model while the inputs are listed, fetched and filtered
+    model_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
+    encoder_future = model_loader.submit(
+        load_run_encoder, workers, threads_per_worker, encoder_kwargs
+    )
+    model_loader.shutdown(wait=False)
+
+    logger.info("Identifying files to process.")
+    with log_duration("Identifying files to process"):
+        manifest = (
+            CheckpointManifest(
+                config.CHECKPOINT_MANIFEST_DIR,
+                segment_size=config.CHECKPOINT_SEGMENT_SIZE,
+            )
+            if config.CHECKPOINT_MANIFEST_DIR
+            else None
+        )
+        # Finding stale documents needs the model id, so waits for the encoder
+        stale_model_id = encoder_future.result().model_id if redo_stale else None
+
+        # The outputs are indexed once, and the index is used to skip documents and
+        # updated as outputs are written for the rest of the run
+        output_index, manifest_entries = load_output_index(
+            output_dir, s3, manifest, stale_model_id
+        )
+        # With FILES_TO_PROCESS, only the versions of those files are fetched
+        files_to_process_subset = get_files_to_process_subset()
+        input_versions: Dict[str, InputVersion] = get_input_versions(
+            input_dir, s3, file_names=files_to_process_subset
+        )
+        # Inputs whose ETag or LastModified time differs from the one recorded with
+        # their outputs are encoded again
+        changed_ids = get_changed_input_ids(input_versions, manifest_entries)
+        files_to_process_ids = get_files_to_process(
+            s3,
+            input_dir,
+            output_dir,
+            redo,
+            limit,
+            output_file_names=output_index.file_names,
+            input_file_names=(
+                [document_id + ".json" for document_id in input_versions]
+                if files_to_process_subset is None
+                else None
+            ),
+            changed_ids=changed_ids,
+        )
     logger.info(
-        "Filtering tasks to those with supported languages.",
-        extra={"props": {"target_languages": config.TARGET_LANGUAGES}},
+        f"Found {len(files_to_process_ids)} files to process.",
+        extra={"props": {"files_to_process_ids": files_to_process_ids}},
     )
-    tasks = get_docs_of_supported_language(tasks)
+
+    # Documents are read and filtered in a background thread, streaming into encoding through a bounded buffer, so memory use doesn't grow
+    # with the number of documents
     logger.info(
-        f"Found {len(tasks)} tasks with supported languages.",
+        "Streaming parser outputs to encode.",
         extra={
             "props": {
-                "tasks": [
-                    {
-                        "lang": task.languages,
-                        "translated": task.translated,
-                        "document_id": task.document_id,
-                    }
-                    for task in tasks
-                ]
+                "target_languages": config.TARGET_LANGUAGES,
+                "BLOCKS_TO_FILTER": config.BLOCKS_TO_FILTER,
+                "PIPELINE_BUFFER_SIZE": config.PIPELINE_BUFFER_SIZE,
+                "PREFETCH_DOCUMENTS": config.PREFETCH_DOCUMENTS,
             }
         },
     )
-
-    logger.info(
-        "Filtering unwanted text block types.",
-        extra={"props": {"BLOCKS_TO_FILTER": config.BLOCKS_TO_FILTER}},
+    tasks = iter_Text2EmbeddingsInput(
+        input_dir, s3, files_to_process_ids, n_prefetch=config.PREFETCH_DOCUMENTS
     )
-    tasks = filter_on_block_type(
+    tasks = iter_docs_of_supported_language(tasks)
+    tasks = iter_filter_on_block_type(
         inputs=tasks, remove_block_types=config.BLOCKS_TO_FILTER
     )
+    writer = BackgroundWriter(
+        output_dir,
+        s3,
+        n_threads=config.WRITER_THREADS,
+        max_in_flight_bytes=config.WRITER_MAX_IN_FLIGHT_MB * 1024 * 1024,
+        max_attempts=config.WRITER_MAX_ATTEMPTS,
+        output_index=output_index,
+        on_written=manifest.on_file_written if manifest is not None else None,
+    )
+    previous_outputs = None
+    if incremental:
+        # Embeddings are only reused if the manifest records the model that made them
+        if manifest is None:
+            logger.warning(
+                "--incremental needs CHECKPOINT_MANIFEST_DIR to know which model "
+                "made the previous outputs, so no embeddings will be reused."
+            )
+        previous_outputs = PreviousOutputs(
+            output_dir,
+            s3,
+            output_index,
+            manifest_entries=manifest_entries,
+        )
+    tasks_to_encode = take_until(
+        shutdown,
+        buffered(
+            iter_tasks_to_encode(
+                tasks, output_index, redo, previous_outputs, changed_ids
+            ),
+            max_size=config.PIPELINE_BUFFER_SIZE,
+        ),
+    )
 
-    logger.info(f"Loading sentence-transformer model {config.SBERT_MODEL}")
-    encoder = SBERTEncoder(config.SBERT_MODEL)
+    with log_duration("Waiting for the encoder to load"):
+        encoder: Union[SBERTEncoder, ParallelEncoder, CachedEncoder] = (
+            encoder_future.result()
+        )
+    model_id = encoder.model_id
+
+    if config.EMBEDDING_CACHE_PATH:
+        logger.info(
+            f"Using the embedding cache at {config.EMBEDDING_CACHE_PATH}",
+            extra={"props": {"model_id": encoder.model_id}},
+        )
+        encoder = CachedEncoder(
+            encoder,
+            EmbeddingCache(
+                config.EMBEDDING_CACHE_PATH,
+                model_id=encoder.model_id,
+                max_size_bytes=config.EMBEDDING_CACHE_MAX_SIZE_MB * 1024 * 1024,
+            ),
+        )
 
     logger.info(
         "Encoding text from documents.",
         extra={
             "props": {
                 "ENCODING_BATCH_SIZE": config.ENCODING_BATCH_SIZE,
-                "tasks_number": len(tasks),
+                "ENCODING_POOL_BATCHES": config.ENCODING_POOL_BATCHES,
+                "ENCODING_MAX_TOKENS_PER_BATCH": config.ENCODING_MAX_TOKENS_PER_BATCH,
+                "ENCODING_NEAR_DUPLICATE_THRESHOLD": (
+                    config.ENCODING_NEAR_DUPLICATE_THRESHOLD
+                ),
+                "files_to_process_number": len(files_to_process_ids),
             }
         },
     )
-    for task in tqdm(tasks, unit="docs"):
-        task_output_path = os.path.join(output_dir, task.document_id + ".json")
+    n_documents_encoded = 0
+    # Finished documents are recorded even if encoding fails, so that a rerun
+    # doesn't encode them again
+    try:
+        with log_duration("Encoding"):
+            for task, combined_embeddings in tqdm(
+                encode_parser_outputs(
+                    encoder,
+                    tasks_to_encode,
+                    config.ENCODING_BATCH_SIZE,
+                    device=device,
+                    pool_batches=config.ENCODING_POOL_BATCHES,
+                    near_duplicate_threshold=config.ENCODING_NEAR_DUPLICATE_THRESHOLD,
+                    get_reusable_embeddings=(
+                        functools.partial(
+                            previous_outputs.pop_reusable_embeddings,
+                            dimension=encoder.dimension,
+                            model_id=model_id,
+                        )
+                        if previous_outputs is not None
+                        else None
+                    ),
+                    stop=shutdown,
+                ),
+                unit="docs",
+            ):
+                # The .json is written with the .npy, so that a run stopped before a
+                # document is encoded doesn't leave its new .json with its old .npy
+                task_json = task.model_dump_json(indent=2)
+                writer.write_text(task.document_id + ".json", task_json)
+                writer.write_npy(task.document_id + ".npy", combined_embeddings)
+                if manifest is not None:
+                    manifest.expect(
+                        task.document_id,
+                        model_id,
+                        input_versions.get(task.document_id),
+                        json_sha256=get_text_hash(task_json),
+                        npy_sha256=get_embeddings_hash(combined_embeddings),
+                    )
+                n_documents_encoded += 1
+    finally:
+        with log_duration("Flushing outputs"):
+            writer.flush()
+            if manifest is not None:
+                manifest.flush()
+                logger.info(
+                    f"Recorded {manifest.n_recorded} documents in the checkpoint "
+                    "manifest.",
+                    extra={"props": {"manifest": manifest.path}},
+                )
 
-        try:
-            write_json_to_s3(
-                task.model_dump_json(indent=2), task_output_path
-            ) if s3 else Path(task_output_path).write_text(
-                task.model_dump_json(indent=2)
-            )
-        except Exception as e:
-            logger.info(
-                "Failed to write embeddings data to s3.",
-                extra={"props": {"task_output_path": task_output_path, "exception": e}},
-            )
+    logger.info(f"Encoded {n_documents_encoded} documents.")
+    if previous_outputs is not None:
+        logger.info(
+            f"Loaded the previous outputs of {previous_outputs.n_loaded} documents "
+            "to reuse embeddings from."
+        )
+    if shutdown.is_set():
+        logger.warning(
+            "Shutdown requested, so stopped taking new documents.",
+            extra={"props": {"n_documents_encoded": n_documents_encoded}},
+        )
+    writer.verify()
 
-        embeddings_output_path = os.path.join(output_dir, task.document_id + ".npy")
+    logger.info(
+        f"Padding efficiency: {encoder.padding_stats.efficiency:.1%} of tokens in "
+        "forward passes were real tokens.",
+        extra={
+            "props": {
+                "real_tokens": encoder.padding_stats.real_tokens,
+                "padded_tokens": encoder.padding_stats.padded_tokens,
+            }
+        },
+    )
 
-        file_exists = (
-            check_file_exists_in_s3(embeddings_output_path)
-            if s3
-            else os.path.exists(embeddings_output_path)
+    if isinstance(encoder, CachedEncoder):
+        logger.info(
+            f"Embedding cache hit rate: {encoder.cache.hit_rate:.1%}.",
+            extra={
+                "props": {
+                    "hits": encoder.cache.hits,
+                    "misses": encoder.cache.misses,
+                }
+            },
         )
-        if file_exists:
-            logger.info(
-                f"Embeddings output file '{embeddings_output_path}' already exists, "
-                "skipping processing."
-            )
-            continue
 
-        description_embedding, text_embeddings = encode_parser_output(
-            encoder, task, config.ENCODING_BATCH_SIZE, device=device
-        )
+    encoder.close()
 
-        combined_embeddings = (
-            np.vstack([description_embedding, text_embeddings])
-            if text_embeddings is not None
-            else description_embedding.reshape(1, -1)
+    if shutdown.is_set():
+        raise RunInterrupted(
+            f"Stopped early on shutdown after encoding {n_documents_encoded} "
+            "documents. Rerun to encode the rest."
         )
 
-        save_ndarray_to_s3_as_npy(
-            combined_embeddings, embeddings_output_path
-        ) if s3 else np.save(embeddings_output_path, combined_embeddings)
-
 
 if __name__ == "__main__":
     run_as_cli()
@@ -0,0 +1,368 @@
+"""Scheduling of encoding work across documents."""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from cpr_sdk.parser_models import ParserOutput
+
+from src.dedup import NearDuplicateIndex
+from src.ml import SentenceEncoder
+
+logger = logging.getLogger(__name__)
+
+
+def get_texts_to_encode(parser_output: ParserOutput) -> List[str]:
+    """
+    Return the texts to encode for a parser output.
+
+    The first text is the document description, followed by each of the text blocks
+    in order. This is the row order of the embeddings array for the document.
+    """
+    return [parser_output.document_description] + [
+        block.to_string() for block in parser_output.get_text_blocks()
+    ]
+
+
+def get_text_hash(text: str) -> str:
+    """Return a hash of a text's content, to match texts without storing them."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _PendingDocument:
+    """A parser output whose embeddings array is being filled in."""
+
+    parser_output: ParserOutput
+    embeddings: np.ndarray
+    n_missing_rows: int
+    near_duplicate_rows: List[int] = field(default_factory=list)
+
+
+@dataclass
+class _PendingText:
+    """A text waiting to be encoded, and the document rows its embedding goes to."""
+
+    text: str
+    targets: List[Tuple[_PendingDocument, int]] = field(default_factory=list)
+
+
+class EncodingScheduler:
+    """
+    Pools texts from many documents into full batches for an encoder.
+
+    Documents are added one at a time. Their descriptions and text blocks are queued
+    and sent to the encoder in multiples of `batch_size` once `pool_batches` batches'
+    worth of texts are queued, and embeddings are scattered back into each document's
+    embeddings array.
+
+    Texts are deduplicated across the run: a description or text block which has
+    already been encoded or queued (e.g. an empty description, a running header or
+    footer, or a disclaimer) is not encoded again, and its embedding is copied to
+    every row the text appears in.
+
+    Optionally, texts which are near-duplicates of an encoded or queued text (e.g.
+    differing only in a page number or OCR noise) reuse that text's embedding too.
+
+    Documents can also be added with embeddings to reuse, such as those from a
+    previous version of the document, keyed by `get_text_hash`. Texts with a
+    reusable embedding aren't encoded.
+    """
+
+    def __init__(
+        self,
+        encoder: SentenceEncoder,
+        batch_size: int,
+        device: Optional[str] = None,
+        pool_batches: int = 1,
+        max_cached_texts: int = 10_000,
+        near_duplicate_threshold: Optional[float] = None,
+    ):
+        """
+        Create a scheduler.
+
+        :param encoder: sentence encoder
+        :param batch_size: number of texts to send to the encoder in each batch
+        :param device: device to use for encoding
+        :param pool_batches: number of batches of texts to pool before encoding
+        :param max_cached_texts: number of most recently used text embeddings to
+            keep for reuse
+        :param near_duplicate_threshold: if set, reuse the embedding of an encoded or
+            queued text for texts whose estimated Jaccard similarity to it is at
+            least this
+        """
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.device = device
+        self.pool_size = batch_size * pool_batches
+        self.max_cached_texts = max_cached_texts
+
+        self.n_texts = 0
+        self.n_texts_encoded = 0
+        self.n_near_duplicates = 0
+        self.n_previous_reused = 0
+
+        self._pending_documents: Deque[_PendingDocument] = deque()
+        self._pending_texts: List[_PendingText] = []
+        self._pending_by_text: Dict[str, _PendingText] = {}
+        self._embeddings_by_text: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._near_duplicates = (
+            NearDuplicateIndex(near_duplicate_threshold)
+            if near_duplicate_threshold is not None
+            else None
+        )
+
+    @property
+    def n_pending_documents(self) -> int:
+        """Number of documents added whose embeddings aren't complete yet."""
+        return len(self._pending_documents)
+
+    @property
+    def is_pool_full(self) -> bool:
+        """Whether enough texts are queued to encode a pool of batches."""
+        return len(self._pending_texts) >= self.pool_size
+
+    def add(
+        self,
+        parser_output: ParserOutput,
+        reusable_embeddings: Optional[Dict[str, np.ndarray]] = None,
+    ) -> None:
+        """
+        Queue the texts of a parser output for encoding.
+
+        :param parser_output: parser output to encode
+        :param reusable_embeddings: embeddings to use for the document's texts
+            instead of encoding them, by the hash of each text
+        """
+        texts = get_texts_to_encode(parser_output)
+        document = _PendingDocument(
+            parser_output=parser_output,
+            embeddings=np.empty((len(texts), self.encoder.dimension), dtype=np.float32),
+            n_missing_rows=len(texts),
+        )
+        self._pending_documents.append(document)
+
+        for row, text in enumerate(texts):
+            if reusable_embeddings:
+                embedding = reusable_embeddings.get(get_text_hash(text))
+                if embedding is not None:
+                    self.n_texts += 1
+                    self.n_previous_reused += 1
+                    self._fill(document, row, embedding)
+                    continue
+
+            self._add_text(document, row, text)
+
+    @property
+    def n_duplicates_removed(self) -> int:
+        """Number of texts whose embedding was reused rather than encoded again."""
+        return (
+            self.n_texts
+            - self.n_texts_encoded
+            - len(self._pending_by_text)
+            - self.n_previous_reused
+        )
+
+    def _add_text(self, document: _PendingDocument, row: int, text: str) -> None:
+        """Queue a text for a document row, unless it's already encoded or queued."""
+        self.n_texts += 1
+
+        if text in self._embeddings_by_text or text in self._pending_by_text:
+            self._reuse(document, row, text)
+            return
+
+        if self._near_duplicates is not None:
+            signature = self._near_duplicates.get_signature(text)
+            near_duplicate = self._near_duplicates.query(signature)
+            if near_duplicate is not None:
+                self.n_near_duplicates += 1
+                document.near_duplicate_rows.append(row)
+                self._reuse(document, row, near_duplicate[0])
+                return
+
+            self._near_duplicates.add(text, signature)
+
+        pending_text = _PendingText(text=text, targets=[(document, row)])
+        self._pending_by_text[text] = pending_text
+        self._pending_texts.append(pending_text)
+
+    def _reuse(self, document: _PendingDocument, row: int, text: str) -> None:
+        """Use the embedding of an encoded or queued text for a document row."""
+        if text in self._embeddings_by_text:
+            self._embeddings_by_text.move_to_end(text)
+            self._fill(document, row, self._embeddings_by_text[text])
+        else:
+            self._pending_by_text[text].targets.append((document, row))
+
+    @staticmethod
+    def _fill(document: _PendingDocument, row: int, embedding: np.ndarray) -> None:
+        document.embeddings[row] = embedding
+        document.n_missing_rows -= 1
+
+    def encode_pool(self, flush: bool = False) -> None:
+        """
+        Encode the queued texts which fill whole batches.
+
+        :param flush: encode all queued texts, including a final partial batch
+        """
+        if flush:
+            n_texts = len(self._pending_texts)
+        else:
+            n_texts = len(self._pending_texts) // self.batch_size * self.batch_size
+
+        if n_texts == 0:
+            return
+
+        to_encode = self._pending_texts[:n_texts]
+        self._pending_texts = self._pending_texts[n_texts:]
+
+        logger.debug(
+            f"Encoding {len(to_encode)} texts from "
+            f"{len(self._pending_documents)} documents."
+        )
+        embeddings = self.encoder.encode_batch(
+            [pending_text.text for pending_text in to_encode],
+            batch_size=self.batch_size,
+            device=self.device,
+        )
+
+        for pending_text, embedding in zip(to_encode, embeddings):
+            for document, row in pending_text.targets:
+                self._fill(document, row, embedding)
+
+            self.n_texts_encoded += 1
+            del self._pending_by_text[pending_text.text]
+            self._embeddings_by_text[pending_text.text] = embedding
+            if len(self._embeddings_by_text) > self.max_cached_texts:
+                evicted_text, _ = self._embeddings_by_text.popitem(last=False)
+                if self._near_duplicates is not None:
+                    self._near_duplicates.remove(evicted_text)
+
+    def pop_completed(self) -> Iterator[Tuple[ParserOutput, np.ndarray]]:
+        """Yield the documents whose embeddings are complete, in the order added."""
+        while (
+            self._pending_documents and self._pending_documents[0].n_missing_rows == 0
+        ):
+            document = self._pending_documents.popleft()
+            if document.near_duplicate_rows:
+                self._log_near_duplicates(document)
+            yield document.parser_output, document.embeddings
+
+    @staticmethod
+    def _log_near_duplicates(document: _PendingDocument) -> None:
+        """Log which of a document's texts reused a near-duplicate's embedding."""
+        text_blocks = document.parser_output.get_text_blocks()
+        logger.info(
+            f"Reused near-duplicate embeddings for {len(document.near_duplicate_rows)} "
+            f"texts of document {document.parser_output.document_id}.",
+            extra={
+                "props": {
+                    "document_id": document.parser_output.document_id,
+                    "rows": document.near_duplicate_rows,
+                    "text_block_ids": [
+                        text_blocks[row - 1].text_block_id
+                        for row in document.near_duplicate_rows
+                        if row > 0
+                    ],
+                    "description": 0 in document.near_duplicate_rows,
+                }
+            },
+        )
+
+
+def encode_parser_outputs(
+    encoder: SentenceEncoder,
+    inputs: Iterable[ParserOutput],
+    batch_size: int,
+    device: Optional[str] = None,
+    pool_batches: int = 1,
+    near_duplicate_threshold: Optional[float] = None,
+    get_reusable_embeddings: Optional[
+        Callable[[ParserOutput], Optional[Dict[str, np.ndarray]]]
+    ] = None,
+    stop: Optional[threading.Event] = None,
+) -> Iterator[Tuple[ParserOutput, np.ndarray]]:
+    """
+    Encode parser outputs, pooling texts from many documents into full batches.
+
+    Descriptions and text blocks from consecutive documents are pooled together and
+    sent to the encoder in multiples of `batch_size`, so that short documents don't
+    each result in their own, mostly empty, batches. Only the final batch of the run
+    can be partially filled. Each distinct text is only encoded once per run, with
+    its embedding copied to every row it appears in. If `near_duplicate_threshold`
+    is set, near-duplicate texts reuse embeddings too. If `get_reusable_embeddings`
+    is given, texts whose embedding it returns aren't encoded at all.
+
+    Pooling `pool_batches` batches' worth of texts before encoding lets the encoder,
+    which sorts the sequences it's given by token length, bucket texts of similar
+    length from different documents together. This means headings and long
+    paragraphs don't end up padded to the same length in one batch.
+
+    Each parser output is yielded with its embeddings as soon as all of its texts
+    have been encoded, in the order of the inputs. The first row of the embeddings
+    array is the description embedding and the remaining rows are the text block
+    embeddings.
+
+    :param encoder: sentence encoder
+    :param inputs: parser output objects to encode
+    :param batch_size: number of texts to send to the encoder in each batch
+    :param device: device to use for encoding
+    :param pool_batches: number of batches of texts to pool before encoding
+    :param near_duplicate_threshold: minimum estimated Jaccard similarity for a text
+        to reuse the embedding of a near-duplicate. No near-duplicate reuse if None.
+    :param get_reusable_embeddings: function returning embeddings to reuse for a
+        parser output's texts, by the hash of each text (see `get_text_hash`)
+    :param stop: if set once the inputs run out, e.g. on shutdown, the texts still
+        queued aren't encoded, and documents waiting on them aren't yielded
+    """
+    scheduler = EncodingScheduler(
+        encoder,
+        batch_size=batch_size,
+        device=device,
+        pool_batches=pool_batches,
+        near_duplicate_threshold=near_duplicate_threshold,
+    )
+
+    for parser_output in inputs:
+        scheduler.add(
+            parser_output,
+            (
+                get_reusable_embeddings(parser_output)
+                if get_reusable_embeddings is not None
+                else None
+            ),
+        )
+        if scheduler.is_pool_full:
+            scheduler.encode_pool()
+
+        yield from scheduler.pop_completed()
+
+    if stop is not None and stop.is_set():
+        logger.warning(
+            f"Stopped, so dropping {scheduler.n_pending_documents} documents whose "
+            "texts haven't all been encoded.",
+            extra={"props": {"n_documents": scheduler.n_pending_documents}},
+        )
+    else:
+        scheduler.encode_pool(flush=True)
+        yield from scheduler.pop_completed()
+
+    duplicate_fraction = scheduler.n_duplicates_removed / max(scheduler.n_texts, 1)
+    logger.info(
+        f"Encoded {scheduler.n_texts_encoded} unique texts for {scheduler.n_texts} "
+        f"descriptions and text blocks, removing {duplicate_fraction:.1%} as "
+        "duplicates.",
+        extra={
+            "props": {
+                "n_texts": scheduler.n_texts,
+                "n_texts_encoded": scheduler.n_texts_encoded,
+                "n_duplicates_removed": scheduler.n_duplicates_removed,
+                "n_near_duplicates": scheduler.n_near_duplicates,
+                "n_previous_reused": scheduler.n_previous_reused,
+            }
+        },
+    )
@@ -0,0 +1,237 @@
+"""Persistent cache of text embeddings."""
+
+import hashlib
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Sequence, Union
+
+import numpy as np
+
+from src.ml import PaddingStats, SentenceEncoder
+
+logger = logging.getLogger(__name__)
+
+# Number of keys looked up per SQL query, below SQLite's limit on query parameters
+_QUERY_CHUNK_SIZE = 500
+
+
+def get_cache_key(model_id: str, text: str) -> str:
+    """Return the cache key of a text's embedding from a model."""
+    return hashlib.sha256(f"{model_id}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed store of embeddings in a local SQLite database.
+
+    Embeddings are keyed by a hash of the model id and the text, so one database can
+    hold embeddings from several models. The total size of the stored embeddings is
+    kept under `max_size_bytes` by evicting the least recently used ones.
+
+    A cache can be used from any thread, but only from one thread at a time.
+    """
+
+    def __init__(self, path: Union[str, Path], model_id: str, max_size_bytes: int):
+        """
+        Open a cache, creating its database if it doesn't exist.
+
+        :param path: path of the SQLite database
+        :param model_id: id of the model whose embeddings are read and written
+        :param max_size_bytes: size the stored embeddings are kept under
+        """
+        self.path = Path(path)
+        self.model_id = model_id
+        self.max_size_bytes = max_size_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used INTEGER NOT NULL"
+            ")"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._connection.commit()
+
+        (self._size_bytes,) = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings"
+        ).fetchone()
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the fraction of lookups which found an embedding."""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Return the cached embedding of each text, or None if it isn't cached."""
+        keys = [get_cache_key(self.model_id, text) for text in texts]
+        found = {}
+
+        for start in range(0, len(keys), _QUERY_CHUNK_SIZE):
+            chunk = keys[start : start + _QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(
+                self._connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+            )
+
+        if found:
+            now = time.time_ns()
+            self._connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self._connection.commit()
+
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+
+        return [
+            np.frombuffer(found[key], dtype=np.float32) if key in found else None
+            for key in keys
+        ]
+
+    def put_many(self, texts: Sequence[str], embeddings: np.ndarray) -> None:
+        """Store the embeddings of texts, then evict entries if over the size cap."""
+        now = time.time_ns()
+        rows = {
+            get_cache_key(self.model_id, text): embedding.astype(np.float32).tobytes()
+            for text, embedding in zip(texts, embeddings)
+        }
+        keys = list(rows)
+
+        for start in range(0, len(keys), _QUERY_CHUNK_SIZE):
+            chunk = keys[start : start + _QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            ((replaced_bytes,),) = self._connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings "
+                f"WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            self._size_bytes -= replaced_bytes
+
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) "
+            "VALUES (?, ?, ?)",
+            [(key, blob, now) for key, blob in rows.items()],
+        )
+        self._size_bytes += sum(len(blob) for blob in rows.values())
+
+        if self._size_bytes > self.max_size_bytes:
+            self._evict(self._size_bytes - self.max_size_bytes)
+
+        self._connection.commit()
+
+    def _evict(self, n_bytes: int) -> None:
+        """Delete the least recently used embeddings until `n_bytes` are freed."""
+        keys_to_delete = []
+        freed_bytes = 0
+
+        for key, size in self._connection.execute(
+            "SELECT key, LENGTH(embedding) FROM embeddings ORDER BY last_used"
+        ):
+            if freed_bytes >= n_bytes:
+                break
+            keys_to_delete.append((key,))
+            freed_bytes += size
+
+        self._connection.executemany(
+            "DELETE FROM embeddings WHERE key = ?", keys_to_delete
+        )
+        self._size_bytes -= freed_bytes
+
+        logger.debug(
+            f"Evicted {len(keys_to_delete)} embeddings from the embedding cache.",
+            extra={"props": {"n_evicted": len(keys_to_delete), "freed": freed_bytes}},
+        )
+
+    def close(self) -> None:
+        """Close the database."""
+        self._connection.close()
+
+
+class CachedEncoder(SentenceEncoder):
+    """
+    Encoder which reuses embeddings from an `EmbeddingCache`.
+
+    Only texts which aren't in the cache are passed to the wrapped encoder, and
+    their embeddings are added to the cache.
+    """
+
+    def __init__(self, encoder: SentenceEncoder, cache: EmbeddingCache):
+        """
+        Wrap an encoder.
+
+        :param encoder: encoder for the texts which aren't cached
+        :param cache: cache of embeddings from the same model as `encoder`
+        """
+        super().__init__()
+        self.encoder = encoder
+        self.cache = cache
+
+    @property
+    def padding_stats(self) -> PaddingStats:
+        """Return the padding stats of the wrapped encoder."""
+        return self.encoder.padding_stats  # type: ignore
+
+    def encode(self, text: str, device: Optional[str] = None) -> np.ndarray:
+        """Encode a string, return a numpy array."""
+        return self.encode_batch([text], device=device)[0]
+
+    def encode_batch(
+        self,
+        text_batch: List[str],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        **kwargs: Any,
+    ) -> np.ndarray:
+        """
+        Encode a batch of strings, return a numpy array.
+
+        For args, see SBERTEncoder.encode_batch.
+        """
+        embeddings = np.empty((len(text_batch), self.dimension), dtype=np.float32)
+        missing_texts: dict[str, List[int]] = {}
+
+        for idx, (text, cached_embedding) in enumerate(
+            zip(text_batch, self.cache.get_many(text_batch))
+        ):
+            if cached_embedding is None:
+                missing_texts.setdefault(text, []).append(idx)
+            else:
+                embeddings[idx] = cached_embedding
+
+        if missing_texts:
+            new_embeddings = self.encoder.encode_batch(
+                list(missing_texts), batch_size=batch_size, device=device, **kwargs
+            )
+            for rows, embedding in zip(missing_texts.values(), new_embeddings):
+                embeddings[rows] = embedding
+
+            self.cache.put_many(list(missing_texts), new_embeddings)
+
+        return embeddings
+
+    @property
+    def dimension(self) -> int:
+        """Return the dimension of the embeddings produced by the encoder."""
+        return self.encoder.dimension
+
+    def close(self) -> None:
+        """Close the cache and the wrapped encoder."""
+        self.cache.close()
+        self.encoder.close()
@@ -1,7 +1,7 @@
 """In-app config. Set by environment variables."""
 
 import os
-from typing import Set
+from typing import Optional, Set
 import re
 from dotenv import load_dotenv, find_dotenv
 
@@ -9,7 +9,61 @@ load_dotenv(find_dotenv())
 
 SBERT_MODEL: str = os.getenv("SBERT_MODEL", "msmarco-distilbert-dot-v5")
 INDEX_ENCODER_CACHE_FOLDER: str = os.getenv("INDEX_ENCODER_CACHE_FOLDER", "/models")
+# Backend to run the encoder with: "torch" or "onnx"
+ENCODER_BACKEND: str = os.getenv("ENCODER_BACKEND", "torch").lower()
+# Numerical precision to run the encoder in: "fp32", "int8" or "bf16"
+ENCODER_PRECISION: str = os.getenv("ENCODER_PRECISION", "fp32").lower()
 ENCODING_BATCH_SIZE: int = int(os.getenv("ENCODING_BATCH_SIZE", "32"))
+# If set, batches are packed up to this many (padded) tokens instead of having a fixed
+# number of texts
+ENCODING_MAX_TOKENS_PER_BATCH: Optional[int] = (
+    int(os.environ["ENCODING_MAX_TOKENS_PER_BATCH"])
+    if os.getenv("ENCODING_MAX_TOKENS_PER_BATCH")
+    else None
+)
+# Weight the windows of long texts by their number of tokens which aren't in the
+# window before when averaging them
+ENCODING_WEIGHT_WINDOWS_BY_NEW_TOKENS: bool = (
+    os.getenv("ENCODING_WEIGHT_WINDOWS_BY_NEW_TOKENS", "false").lower() == "true"
+)
+# Number of batches of texts pooled across documents and sorted by length together
+ENCODING_POOL_BATCHES: int = int(os.getenv("ENCODING_POOL_BATCHES", "16"))
+# If set, texts whose estimated Jaccard similarity to an already encoded text is at
+# least this reuse its embedding instead of being encoded
+ENCODING_NEAR_DUPLICATE_THRESHOLD: Optional[float] = (
+    float(os.environ["ENCODING_NEAR_DUPLICATE_THRESHOLD"])
+    if os.getenv("ENCODING_NEAR_DUPLICATE_THRESHOLD")
+    else None
+)
+# Number of documents read ahead of encoding and buffered in memory
+PIPELINE_BUFFER_SIZE: int = int(os.getenv("PIPELINE_BUFFER_SIZE", "32"))
+# Number of documents downloaded and validated concurrently ahead of encoding
+PREFETCH_DOCUMENTS: int = int(os.getenv("PREFETCH_DOCUMENTS", "8"))
+# Number of output files written concurrently in the background
+WRITER_THREADS: int = int(os.getenv("WRITER_THREADS", "8"))
+# Maximum total size of output files waiting to be written before encoding pauses
+WRITER_MAX_IN_FLIGHT_MB: int = int(os.getenv("WRITER_MAX_IN_FLIGHT_MB", "256"))
+# Number of times to try writing each output file
+WRITER_MAX_ATTEMPTS: int = int(os.getenv("WRITER_MAX_ATTEMPTS", "3"))
+# Number of CPU worker processes to encode with
+ENCODING_WORKERS: int = int(os.getenv("ENCODING_WORKERS", "1"))
+# Path of the SQLite database embeddings are cached in across runs. No cache if unset
+EMBEDDING_CACHE_PATH: Optional[str] = os.getenv("EMBEDDING_CACHE_PATH") or None
+# Size the embedding cache is kept under by evicting its least recently used entries
+EMBEDDING_CACHE_MAX_SIZE_MB: int = int(os.getenv("EMBEDDING_CACHE_MAX_SIZE_MB", "1024"))
+# Local directory or s3:// prefix of the checkpoint manifest of finished documents.
+# No manifest if unset
+CHECKPOINT_MANIFEST_DIR: Optional[str] = os.getenv("CHECKPOINT_MANIFEST_DIR") or None
+# Number of manifest entries written to each segment in S3
+CHECKPOINT_SEGMENT_SIZE: int = int(os.getenv("CHECKPOINT_SEGMENT_SIZE", "1000"))
+# Maximum number of open connections to S3, shared by all threads
+S3_MAX_POOL_CONNECTIONS: int = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+# botocore retry mode ("legacy", "standard" or "adaptive") and maximum attempts
+S3_RETRY_MODE: str = os.getenv("S3_RETRY_MODE", "standard")
+S3_MAX_ATTEMPTS: int = int(os.getenv("S3_MAX_ATTEMPTS", "5"))
+# Timeouts for connecting to S3 and reading from a connection, in seconds
+S3_CONNECT_TIMEOUT: float = float(os.getenv("S3_CONNECT_TIMEOUT", "10"))
+S3_READ_TIMEOUT: float = float(os.getenv("S3_READ_TIMEOUT", "60"))
 # comma-separated 2-letter ISO codes
 TARGET_LANGUAGES: Set[str] = set(os.getenv("TARGET_LANGUAGES", "en").lower().split(","))
 ENCODER_SUPPORTED_LANGUAGES: Set[str] = {"en"}
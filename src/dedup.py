@@ -0,0 +1,169 @@
+"""Detection of near-duplicate texts with MinHash and locality-sensitive hashing."""
+
+import re
+from collections import defaultdict
+from typing import DefaultDict, Dict, Optional, Set, Tuple
+
+import numpy as np
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def get_shingles(text: str, shingle_size: int = 5) -> np.ndarray:
+    """
+    Return the distinct character shingles of a text, as integers.
+
+    Text is lowercased and runs of whitespace are collapsed first, so texts which
+    only differ in case or whitespace have the same shingles. Texts shorter than
+    `shingle_size` bytes have a single shingle.
+
+    :param text: text to shingle
+    :param shingle_size: number of bytes of UTF-8 in each shingle, at most 8
+    :return np.ndarray: sorted array of uint64 shingles
+    """
+    normalized = _WHITESPACE_PATTERN.sub(" ", text.lower()).strip()
+    text_bytes = np.frombuffer(normalized.encode("utf-8"), dtype=np.uint8)
+    text_bytes = text_bytes.astype(np.uint64)
+
+    if len(text_bytes) < shingle_size:
+        text_bytes = np.pad(text_bytes, (0, shingle_size - len(text_bytes)))
+
+    windows = np.lib.stride_tricks.sliding_window_view(text_bytes, shingle_size)
+    shifts = np.arange(shingle_size, dtype=np.uint64) * np.uint64(8)
+
+    return np.unique(np.bitwise_or.reduce(windows << shifts, axis=1))
+
+
+def get_lsh_bands(n_permutations: int, threshold: float) -> Tuple[int, int]:
+    """
+    Choose how to split MinHash signatures into LSH bands.
+
+    Texts are candidate duplicates if all the rows of any band match, which is
+    likely once their Jaccard similarity is above roughly (1 / bands) ** (1 / rows).
+    This picks the split whose threshold is highest without going above
+    `threshold`, so that few true near-duplicates are missed.
+
+    :return tuple[int, int]: number of bands and number of rows per band
+    """
+    splits = [
+        (n_permutations // rows, rows)
+        for rows in range(1, n_permutations + 1)
+        if n_permutations % rows == 0
+    ]
+    below_threshold = [
+        (bands, rows)
+        for bands, rows in splits
+        if (1 / bands) ** (1 / rows) <= threshold
+    ]
+
+    return max(
+        below_threshold or splits[:1],
+        key=lambda split: (1 / split[0]) ** (1 / split[1]),
+    )
+
+
+class NearDuplicateIndex:
+    """
+    Index of texts which finds previously added texts similar to a new one.
+
+    Each text is summarised by a MinHash signature of its character shingles. A
+    query returns the indexed text with the highest estimated Jaccard similarity to
+    the new text, if that's at least `threshold`. Candidates are found with
+    locality-sensitive hashing, so a query doesn't compare against every text.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        n_permutations: int = 128,
+        shingle_size: int = 5,
+        seed: int = 0,
+    ):
+        """
+        Create an empty index.
+
+        :param threshold: minimum estimated Jaccard similarity of near-duplicates
+        :param n_permutations: number of hash functions in each MinHash signature
+        :param shingle_size: number of bytes in each shingle
+        :param seed: seed of the hash functions
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"Threshold should be in (0, 1], not {threshold}.")
+
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.n_bands, self.rows_per_band = get_lsh_bands(n_permutations, threshold)
+
+        # Multiply-shift hash functions: h(x) = (a * x + b) >> 32 with odd a and
+        # arithmetic modulo 2 ** 64
+        rng = np.random.default_rng(seed)
+        max_uint64 = np.iinfo(np.uint64).max
+        self._a = rng.integers(0, max_uint64, n_permutations, dtype=np.uint64) | 1
+        self._b = rng.integers(0, max_uint64, n_permutations, dtype=np.uint64)
+
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._buckets: DefaultDict[Tuple[int, bytes], Set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        """Return the number of texts in the index."""
+        return len(self._signatures)
+
+    def __contains__(self, text: str) -> bool:
+        """Return whether a text has been added to the index."""
+        return text in self._signatures
+
+    def get_signature(self, text: str) -> np.ndarray:
+        """Return the MinHash signature of a text."""
+        shingles = get_shingles(text, self.shingle_size)
+        hashes = self._a[:, None] * shingles[None, :] + self._b[:, None]
+
+        return (hashes.min(axis=1) >> np.uint64(32)).astype(np.uint32)
+
+    def _get_band_keys(self, signature: np.ndarray) -> list[Tuple[int, bytes]]:
+        bands = signature[: self.n_bands * self.rows_per_band].reshape(self.n_bands, -1)
+        return [(band, rows.tobytes()) for band, rows in enumerate(bands)]
+
+    def add(self, text: str, signature: Optional[np.ndarray] = None) -> None:
+        """Add a text to the index, with its signature if already computed."""
+        if text in self._signatures:
+            return
+
+        if signature is None:
+            signature = self.get_signature(text)
+
+        self._signatures[text] = signature
+        for band_key in self._get_band_keys(signature):
+            self._buckets[band_key].add(text)
+
+    def remove(self, text: str) -> None:
+        """Remove a text from the index, if it's in it."""
+        signature = self._signatures.pop(text, None)
+        if signature is None:
+            return
+
+        for band_key in self._get_band_keys(signature):
+            bucket = self._buckets[band_key]
+            bucket.discard(text)
+            if not bucket:
+                del self._buckets[band_key]
+
+    def query(self, signature: np.ndarray) -> Optional[Tuple[str, float]]:
+        """
+        Return the most similar indexed text to a signature, if it's a near-duplicate.
+
+        :return Optional[tuple[str, float]]: the indexed text and its estimated
+            Jaccard similarity, or None if no indexed text is similar enough
+        """
+        candidates: Set[str] = set()
+        for band_key in self._get_band_keys(signature):
+            candidates.update(self._buckets.get(band_key, ()))
+
+        best_match = None
+        for candidate in sorted(candidates):
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= self.threshold and (
+                best_match is None or similarity > best_match[1]
+            ):
+                best_match = (candidate, similarity)
+
+        return best_match
@@ -0,0 +1,176 @@
+"""Reuse of a document's previous embeddings when it's encoded again."""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from cpr_sdk.parser_models import ParserOutput
+
+from src.batching import get_text_hash, get_texts_to_encode
+from src.manifest import ManifestEntry, get_embeddings_hash
+from src.s3 import load_npy_from_s3, s3_object_read_text
+from src.writer import OutputIndex
+
+logger = logging.getLogger(__name__)
+
+
+def get_reusable_embeddings(
+    parser_output: ParserOutput, embeddings: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """
+    Return the embeddings of a document's texts, by the hash of each text.
+
+    :param parser_output: the filtered parser output the embeddings were made from
+    :param embeddings: its embeddings array, with the description embedding first
+    :return dict[str, np.ndarray]: embedding of each text, by `get_text_hash`. Empty
+        if the array doesn't have a row for each text.
+    """
+    texts = get_texts_to_encode(parser_output)
+    if embeddings.ndim != 2 or len(texts) != len(embeddings):
+        return {}
+
+    return {get_text_hash(text): row for text, row in zip(texts, embeddings)}
+
+
+class PreviousOutputs:
+    """
+    The previous outputs of documents being encoded again, for reusing embeddings.
+
+    `load` reads a document's previous .json and .npy outputs, and must be called
+    before its new outputs overwrite them, e.g. in the stage that writes the new
+    .json. `pop_reusable_embeddings` then hands the embeddings of its unchanged
+    texts to the encoder, so only new and changed texts are encoded.
+
+    Embeddings are only reused if the checkpoint manifest records the previous
+    outputs, with hashes matching the files read back, so a .json and .npy from
+    different runs are never paired. They must also have been made with the
+    encoder's model, and have the same dimension as the encoder's.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        s3: bool,
+        output_index: OutputIndex,
+        manifest_entries: Dict[str, ManifestEntry],
+    ):
+        """
+        Create an empty store of previous outputs.
+
+        :param output_dir: local directory or S3 prefix of the outputs
+        :param s3: whether output_dir is in S3
+        :param output_index: index of the output directory, so that documents
+            without previous outputs cost no requests
+        :param manifest_entries: checkpoint manifest entries of the previous
+            outputs, by document id. Documents without an entry recording their
+            model and output hashes aren't loaded.
+        """
+        self.output_dir = output_dir
+        self.s3 = s3
+        self.output_index = output_index
+        self.manifest_entries = manifest_entries
+
+        self.n_loaded = 0
+
+        self._lock = threading.Lock()
+        self._embeddings: Dict[str, Tuple[Optional[str], Dict[str, np.ndarray]]] = {}
+
+    def load(self, document_id: str) -> None:
+        """Read a document's previous outputs, if it has any."""
+        entry = self.manifest_entries.get(document_id)
+        if (
+            entry is None
+            or entry.model_id is None
+            or entry.json_sha256 is None
+            or entry.npy_sha256 is None
+            or document_id + ".json" not in self.output_index
+            or document_id + ".npy" not in self.output_index
+        ):
+            return
+
+        json_path = os.path.join(self.output_dir, document_id + ".json")
+        embeddings_path = os.path.join(self.output_dir, document_id + ".npy")
+        try:
+            previous_json = (
+                s3_object_read_text(json_path)
+                if self.s3
+                else Path(json_path).read_text()
+            )
+            previous_embeddings = (
+                load_npy_from_s3(embeddings_path)
+                if self.s3
+                else np.load(embeddings_path)
+            )
+        except Exception as e:
+            logger.warning(
+                f"Couldn't read the previous outputs of {document_id}, so encoding "
+                "all its texts.",
+                extra={"props": {"document_id": document_id, "exception": str(e)}},
+            )
+            return
+
+        # An interrupted run can leave a .json and .npy which weren't made together
+        if (
+            get_text_hash(previous_json) != entry.json_sha256
+            or get_embeddings_hash(previous_embeddings) != entry.npy_sha256
+        ):
+            logger.warning(
+                f"The previous outputs of {document_id} don't match the checkpoint "
+                "manifest, so encoding all its texts.",
+                extra={"props": {"document_id": document_id}},
+            )
+            return
+
+        reusable_embeddings = get_reusable_embeddings(
+            ParserOutput.model_validate_json(previous_json), previous_embeddings
+        )
+        with self._lock:
+            self._embeddings[document_id] = (entry.model_id, reusable_embeddings)
+            self.n_loaded += 1
+
+    def pop_reusable_embeddings(
+        self, parser_output: ParserOutput, dimension: int, model_id: str
+    ) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Return the embeddings to reuse for a document, forgetting them.
+
+        :param parser_output: the document being encoded
+        :param dimension: dimension of the encoder's embeddings
+        :param model_id: id of the encoder's model
+        :return Optional[dict[str, np.ndarray]]: embeddings by `get_text_hash`, or
+            None if there are none to reuse
+        """
+        with self._lock:
+            previous_model_id, reusable_embeddings = self._embeddings.pop(
+                parser_output.document_id, (None, {})
+            )
+
+        if not reusable_embeddings:
+            return None
+
+        if previous_model_id != model_id:
+            logger.warning(
+                f"The previous embeddings of {parser_output.document_id} were made "
+                "with a different model, so encoding all its texts.",
+                extra={
+                    "props": {
+                        "document_id": parser_output.document_id,
+                        "previous_model_id": previous_model_id,
+                        "model_id": model_id,
+                    }
+                },
+            )
+            return None
+
+        if next(iter(reusable_embeddings.values())).shape != (dimension,):
+            logger.warning(
+                f"The previous embeddings of {parser_output.document_id} have a "
+                "different dimension to the encoder's, so encoding all its texts.",
+                extra={"props": {"document_id": parser_output.document_id}},
+            )
+            return None
+
+        return reusable_embeddings
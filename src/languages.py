@@ -1,5 +1,5 @@
 import logging
-from typing import List
+from typing import Iterable, Iterator, List
 
 from cpr_sdk.parser_models import ParserOutput
 
@@ -49,11 +49,8 @@ def task_has_no_source_url_languages_or_data(task: ParserOutput) -> bool:
     )
 
 
-@validate_languages_decorator
-def get_docs_of_supported_language(
-    tasks: List[ParserOutput],
-) -> List[ParserOutput]:
-    """Filter out documents that don't meet language requirements.
+def is_doc_of_supported_language(task: ParserOutput) -> bool:
+    """Return true if the document meets the language requirements for encoding.
 
     Empty documents that have a source url will have a translated output produced for
     them by the pdf parser with a language that is supported by the encoder. Thus,
@@ -61,9 +58,38 @@ def get_docs_of_supported_language(
     encode the root non-translated document as well. This is why we have the
     task_has_one_lang_that_is_supported function.
     """
-    return [
-        task
-        for task in tasks
-        if task_has_one_lang_that_is_supported(task)
+    return bool(
+        task_has_one_lang_that_is_supported(task)
         or task_has_no_source_url_languages_or_data(task)
-    ]
+    )
+
+
+@validate_languages_decorator
+def iter_docs_of_supported_language(
+    tasks: Iterable[ParserOutput],
+) -> Iterator[ParserOutput]:
+    """Filter out documents that don't meet language requirements, one at a time."""
+    for task in tasks:
+        if is_doc_of_supported_language(task):
+            yield task
+        else:
+            logger.info(
+                f"Skipping document {task.document_id} as its languages aren't "
+                "supported.",
+                extra={
+                    "props": {
+                        "document_id": task.document_id,
+                        "languages": task.languages,
+                    }
+                },
+            )
+
+
+def get_docs_of_supported_language(
+    tasks: List[ParserOutput],
+) -> List[ParserOutput]:
+    """Filter out documents that don't meet language requirements.
+
+    See is_doc_of_supported_language.
+    """
+    return list(iter_docs_of_supported_language(tasks))
@@ -0,0 +1,381 @@
+"""Append-only checkpoint manifest of the documents a run has finished."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from src.pipeline import prefetch
+from src.s3 import (
+    get_s3_keys_with_prefix,
+    get_s3_object_metadata,
+    get_s3_objects_with_prefix,
+    s3_object_read_text,
+    write_json_to_s3,
+)
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_SUFFIX = ".jsonl"
+
+
+@dataclass(frozen=True)
+class InputVersion:
+    """The version of an input file, from listing the input directory."""
+
+    etag: str
+    last_modified: str
+
+
+def get_input_versions(
+    input_dir: str, s3: bool, file_names: Optional[Iterable[str]] = None
+) -> Dict[str, InputVersion]:
+    """
+    Get the version of each input JSON file in a directory.
+
+    For S3, the version is the object's ETag and LastModified time. Local files have
+    no ETag, so their size and modification time in nanoseconds stand in for it.
+
+    :param file_names: if given, only get the versions of these files, with a
+        request per file, rather than listing the whole directory. Files which
+        don't exist are left out.
+    :return dict[str, InputVersion]: version of each input, by document id
+    """
+    if file_names is not None:
+        file_names = [name for name in file_names if name.endswith(".json")]
+        paths = [os.path.join(input_dir, name) for name in file_names]
+        get_version = _get_s3_object_version if s3 else _get_local_file_version
+        return {
+            os.path.splitext(file_name)[0]: version
+            for file_name, version in zip(
+                file_names, prefetch(get_version, paths, n_in_flight=16)
+            )
+            if version is not None
+        }
+
+    versions: Dict[str, InputVersion] = {}
+
+    if s3:
+        for s3_object in get_s3_objects_with_prefix(input_dir):
+            file_name = os.path.basename(s3_object["Key"])
+            if file_name.endswith(".json"):
+                versions[os.path.splitext(file_name)[0]] = _s3_object_version(s3_object)
+        return versions
+
+    for entry in os.scandir(input_dir):
+        if entry.name.endswith(".json"):
+            versions[os.path.splitext(entry.name)[0]] = _stat_version(entry.stat())
+    return versions
+
+
+def _s3_object_version(s3_object: Dict[str, Any]) -> InputVersion:
+    return InputVersion(
+        etag=s3_object["ETag"].strip('"'),
+        last_modified=s3_object["LastModified"].isoformat(),
+    )
+
+
+def _stat_version(stat: os.stat_result) -> InputVersion:
+    return InputVersion(
+        etag=f"{stat.st_size:x}-{stat.st_mtime_ns:x}",
+        last_modified=datetime.fromtimestamp(
+            stat.st_mtime, tz=timezone.utc
+        ).isoformat(),
+    )
+
+
+def _get_s3_object_version(s3_path: str) -> Optional[InputVersion]:
+    try:
+        return _s3_object_version(get_s3_object_metadata(s3_path))
+    except ClientError:
+        return None
+
+
+def _get_local_file_version(path: str) -> Optional[InputVersion]:
+    try:
+        return _stat_version(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def get_embeddings_hash(embeddings: np.ndarray) -> str:
+    """Return a hash of an embeddings array's shape, type and values."""
+    embeddings = np.ascontiguousarray(embeddings)
+    content_hash = hashlib.sha256(
+        f"{embeddings.dtype.str}{embeddings.shape}".encode("utf-8")
+    )
+    content_hash.update(embeddings.tobytes())
+    return content_hash.hexdigest()
+
+
+@dataclass
+class ManifestEntry:
+    """A document whose outputs have all been written."""
+
+    document_id: str
+    # None for documents found by listing the output directory, whose model isn't
+    # known
+    model_id: Optional[str]
+    input_etag: Optional[str] = None
+    input_last_modified: Optional[str] = None
+    json_bytes: Optional[int] = None
+    npy_bytes: Optional[int] = None
+    # Hashes of the outputs, to check files read back are the ones recorded. The
+    # .json's is `get_text_hash` of its text, the .npy's `get_embeddings_hash`.
+    json_sha256: Optional[str] = None
+    npy_sha256: Optional[str] = None
+
+    @property
+    def file_names(self) -> Set[str]:
+        """Names of the document's output files."""
+        return {self.document_id + ".json", self.document_id + ".npy"}
+
+    def is_stale(self, model_id: str) -> bool:
+        """Whether the document's embeddings weren't made by the given model."""
+        return self.model_id != model_id
+
+    def is_input_changed(self, input_version: InputVersion) -> bool:
+        """
+        Whether the document's input has changed since its outputs were made.
+
+        ETags are compared if recorded, otherwise an input modified after the
+        recorded LastModified time has changed. Entries with neither, such as
+        those imported from a listing of the outputs, never count as changed.
+        """
+        if self.input_etag is not None:
+            return self.input_etag != input_version.etag
+
+        if self.input_last_modified is not None:
+            return datetime.fromisoformat(
+                input_version.last_modified
+            ) > datetime.fromisoformat(self.input_last_modified)
+
+        return False
+
+
+def get_changed_input_ids(
+    input_versions: Dict[str, InputVersion], entries: Dict[str, ManifestEntry]
+) -> Set[str]:
+    """
+    Return the ids of documents whose input changed after their outputs were made.
+
+    :param input_versions: current version of each input, by document id
+    :param entries: manifest entries, by document id
+    :return set[str]: ids of documents with a manifest entry and a changed input
+    """
+    return {
+        document_id
+        for document_id, input_version in input_versions.items()
+        if document_id in entries
+        and entries[document_id].is_input_changed(input_version)
+    }
+
+
+@dataclass
+class _PendingEntry:
+    """A document whose outputs are being written."""
+
+    model_id: Optional[str] = None
+    input_version: Optional[InputVersion] = None
+    json_sha256: Optional[str] = None
+    npy_sha256: Optional[str] = None
+    expected: bool = False
+    n_bytes: Dict[str, int] = field(default_factory=dict)
+
+
+class CheckpointManifest:
+    """
+    Append-only record of the documents whose outputs have all been written.
+
+    A document is added once both its .json and .npy outputs are written, with its
+    model id, input ETag and output sizes, so a restarted run can tell a finished
+    document from one whose uploads were interrupted without listing the outputs.
+
+    The manifest is a directory of JSON lines segment files, locally or in S3. Each
+    run writes its own segments. Locally, entries are appended to the run's segment
+    as they're recorded. S3 objects can't be appended to, so entries are written
+    in new segments of `segment_size` entries, and when `flush` is called. Later
+    entries for a document replace earlier ones.
+    """
+
+    def __init__(self, path: str, segment_size: int = 1000):
+        """
+        Create a manifest, or open an existing one.
+
+        :param path: local directory or S3 prefix (starting s3://) of the manifest
+        :param segment_size: number of entries in each S3 segment
+        """
+        self.path = path
+        self.s3 = path.startswith("s3://")
+        self.segment_size = segment_size
+
+        self.n_recorded = 0
+
+        # Segments are read in name order, so runs are named by their start time
+        self._run_id = (
+            datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+            + "-"
+            + uuid.uuid4().hex[:8]
+        )
+        self._n_segments = 0
+        self._lock = threading.Lock()
+        self._unwritten_entries: List[ManifestEntry] = []
+        self._pending: Dict[str, _PendingEntry] = {}
+
+        if not self.s3:
+            os.makedirs(path, exist_ok=True)
+
+    def load(self) -> Dict[str, ManifestEntry]:
+        """
+        Read the entries of all segments in the manifest.
+
+        :return dict[str, ManifestEntry]: latest entry of each document, by id
+        """
+        if self.s3:
+            bucket = self.path.removeprefix("s3://").split("/", 1)[0]
+            segment_paths = [
+                f"s3://{bucket}/{key}"
+                for key in sorted(get_s3_keys_with_prefix(self.path))
+                if key.endswith(_SEGMENT_SUFFIX)
+            ]
+            segments = prefetch(s3_object_read_text, segment_paths, n_in_flight=16)
+        else:
+            segment_paths = [
+                os.path.join(self.path, file_name)
+                for file_name in sorted(os.listdir(self.path))
+                if file_name.endswith(_SEGMENT_SUFFIX)
+            ]
+            segments = (
+                Path(segment_path).read_text() for segment_path in segment_paths
+            )
+
+        entries: Dict[str, ManifestEntry] = {}
+        for segment in segments:
+            for line in segment.splitlines():
+                # A local segment can end in a partial line if a run was killed
+                # while appending to it
+                try:
+                    entry = ManifestEntry(**json.loads(line))
+                except (json.JSONDecodeError, TypeError):
+                    continue
+                entries[entry.document_id] = entry
+
+        logger.info(
+            f"Loaded {len(entries)} entries from the checkpoint manifest.",
+            extra={"props": {"path": self.path, "n_segments": len(segment_paths)}},
+        )
+
+        return entries
+
+    def expect(
+        self,
+        document_id: str,
+        model_id: str,
+        input_version: Optional[InputVersion] = None,
+        json_sha256: Optional[str] = None,
+        npy_sha256: Optional[str] = None,
+    ) -> None:
+        """
+        Record a document once both its outputs have been written.
+
+        :param document_id: id of the document
+        :param model_id: id of the model its embeddings were made with
+        :param input_version: version of its input file, if known
+        :param json_sha256: hash of its .json output, if known
+        :param npy_sha256: hash of its .npy output, if known
+        """
+        with self._lock:
+            pending = self._pending.setdefault(document_id, _PendingEntry())
+            pending.model_id = model_id
+            pending.input_version = input_version
+            pending.json_sha256 = json_sha256
+            pending.npy_sha256 = npy_sha256
+            pending.expected = True
+            self._record_if_complete(document_id, pending)
+
+    def on_file_written(self, file_name: str, n_bytes: int) -> None:
+        """Note that an output file has been written, e.g. by a `BackgroundWriter`."""
+        document_id, extension = os.path.splitext(file_name)
+        if extension not in {".json", ".npy"}:
+            return
+
+        with self._lock:
+            pending = self._pending.setdefault(document_id, _PendingEntry())
+            pending.n_bytes[extension] = n_bytes
+            self._record_if_complete(document_id, pending)
+
+    def _record_if_complete(self, document_id: str, pending: _PendingEntry) -> None:
+        if not pending.expected or len(pending.n_bytes) < 2:
+            return
+
+        del self._pending[document_id]
+        input_version = pending.input_version
+        self._append(
+            [
+                ManifestEntry(
+                    document_id=document_id,
+                    model_id=pending.model_id,
+                    input_etag=input_version.etag if input_version else None,
+                    input_last_modified=(
+                        input_version.last_modified if input_version else None
+                    ),
+                    json_bytes=pending.n_bytes[".json"],
+                    npy_bytes=pending.n_bytes[".npy"],
+                    json_sha256=pending.json_sha256,
+                    npy_sha256=pending.npy_sha256,
+                )
+            ]
+        )
+
+    def record_many(self, entries: Iterable[ManifestEntry]) -> None:
+        """Add entries to the manifest straight away, e.g. when importing outputs."""
+        with self._lock:
+            self._append(list(entries))
+            self._write_segment()
+
+    def flush(self) -> None:
+        """Write any entries that haven't been written to a segment yet."""
+        with self._lock:
+            self._write_segment()
+
+    def _append(self, entries: List[ManifestEntry]) -> None:
+        self.n_recorded += len(entries)
+
+        if self.s3:
+            self._unwritten_entries.extend(entries)
+            if len(self._unwritten_entries) >= self.segment_size:
+                self._write_segment()
+            return
+
+        with open(self._get_segment_path(), "a") as f:
+            f.writelines(json.dumps(asdict(entry)) + "\n" for entry in entries)
+
+    def _write_segment(self) -> None:
+        if not self.s3 or not self._unwritten_entries:
+            return
+
+        write_json_to_s3(
+            "".join(
+                json.dumps(asdict(entry)) + "\n" for entry in self._unwritten_entries
+            ),
+            self._get_segment_path(),
+        )
+        self._unwritten_entries = []
+        self._n_segments += 1
+
+    def _get_segment_path(self) -> str:
+        if self.s3:
+            file_name = f"segment-{self._run_id}-{self._n_segments:06d}"
+        else:
+            file_name = f"segment-{self._run_id}"
+
+        return os.path.join(self.path, file_name + _SEGMENT_SUFFIX)
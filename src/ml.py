@@ -1,22 +1,201 @@
 """Text encoders."""
 
+import hashlib
+import inspect
+import logging
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Sequence
 
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
 from src import config
 
+# torch and sentence-transformers take seconds to import, so they're imported where
+# they're used rather than here. This lets the CLI start listing and fetching its
+# inputs while the encoder is still loading.
+if TYPE_CHECKING:
+    import torch
 
-def sliding_window(text: str, window_size: int, stride: int) -> list[str]:
-    """Split a text string into overlapping windows."""
-    windows = [
-        text[i : i + window_size]
-        for i in range(0, len(text), stride)
-        if i + window_size <= len(text)
+logger = logging.getLogger(__name__)
+
+# Numerical precisions encoders can run forward passes in
+PRECISIONS = ("fp32", "int8", "bf16")
+# Precisions which are only supported for CPU inference
+CPU_ONLY_PRECISIONS = ("int8", "bf16")
+# /proc/cpuinfo flags of the x86 instructions that run bfloat16 natively
+_BF16_CPU_FLAGS = {"avx512_bf16", "amx_bf16"}
+
+
+def get_model_cache_dir(model_name: str, variant: str) -> Path:
+    """
+    Return the directory a converted variant of a model is cached in.
+
+    Variants (e.g. an ONNX export or a quantised copy) are stored next to the original
+    models, in INDEX_ENCODER_CACHE_FOLDER.
+    """
+    return (
+        Path(config.INDEX_ENCODER_CACHE_FOLDER)
+        / variant
+        / model_name.strip("/").replace("/", "__")
+    )
+
+
+def cpu_supports_bf16(cpuinfo_path: str = "/proc/cpuinfo") -> bool:
+    """
+    Return whether the CPU has bfloat16 instructions (AVX512-BF16 or AMX-BF16).
+
+    Without them bfloat16 is emulated, which is slower than fp32. The CPU flags are
+    read from /proc/cpuinfo, so on other platforms this is always False.
+    """
+    try:
+        with open(cpuinfo_path) as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.partition(":")[2].split())
+                    return bool(flags & _BF16_CPU_FLAGS)
+    except OSError:
+        pass
+
+    return False
+
+
+def sliding_window(
+    token_ids: Sequence[int], window_size: int, stride: int
+) -> list[list[int]]:
+    """
+    Split a sequence of token ids into overlapping windows.
+
+    Windows start every `stride` tokens. The last window is aligned with the end of
+    the sequence so that trailing tokens are never dropped.
+    """
+    return [
+        list(token_ids[i : i + window_size])
+        for i in get_window_starts(len(token_ids), window_size, stride)
     ]
-    return windows
+
+
+def get_window_starts(n_tokens: int, window_size: int, stride: int) -> list[int]:
+    """Return the start of each window `sliding_window` splits a sequence into."""
+    if n_tokens <= window_size:
+        return [0]
+
+    starts = list(range(0, n_tokens - window_size, stride))
+    starts.append(n_tokens - window_size)
+    return starts
+
+
+def get_window_new_token_counts(
+    n_tokens: int, window_size: int, stride: int
+) -> list[int]:
+    """
+    Return the number of tokens in each window which aren't in the window before.
+
+    The first window's tokens are all new. Every other window adds `stride` tokens,
+    apart from the last, which is aligned with the end of the sequence and so can
+    add fewer. The counts sum to the length of the sequence.
+    """
+    starts = get_window_starts(n_tokens, window_size, stride)
+    return [min(n_tokens, window_size)] + np.diff(starts).tolist()
+
+
+def get_batch_boundaries(
+    sorted_lengths: Sequence[int],
+    batch_size: int,
+    max_tokens_per_batch: Optional[int] = None,
+) -> list[tuple[int, int]]:
+    """
+    Split sequences sorted by descending length into batches.
+
+    By default each batch has `batch_size` sequences. If `max_tokens_per_batch` is
+    set, batches are instead packed with as many sequences as fit in that many tokens
+    once padded to the longest sequence in the batch. A batch always has at least one
+    sequence, even if it's longer than the token budget.
+
+    :param sorted_lengths: length of each sequence, in descending order
+    :param batch_size: number of sequences per batch
+    :param max_tokens_per_batch: optional budget of padded tokens per batch
+    :return list[tuple[int, int]]: start and end index of each batch
+    """
+    if not max_tokens_per_batch:
+        return [
+            (start, min(start + batch_size, len(sorted_lengths)))
+            for start in range(0, len(sorted_lengths), batch_size)
+        ]
+
+    boundaries = []
+    start = 0
+    while start < len(sorted_lengths):
+        # The first sequence in the batch is the longest, so sets the padded length
+        n_sequences = max(1, max_tokens_per_batch // max(sorted_lengths[start], 1))
+        end = min(start + n_sequences, len(sorted_lengths))
+        boundaries.append((start, end))
+        start = end
+
+    return boundaries
+
+
+def reduce_window_embeddings(
+    window_embeddings: np.ndarray,
+    window_offsets: np.ndarray,
+    window_weights: Optional[np.ndarray] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Average the embeddings of each text's windows in one vectorised step.
+
+    :param window_embeddings: embeddings of all windows, grouped by text
+    :param window_offsets: index of the first window of each text, followed by the
+        total number of windows. Each text must have at least one window.
+    :param window_weights: optional weight of each window in its text's average, e.g.
+        its number of tokens
+    :param out: optional preallocated array of shape (n_texts, dimension) to write
+        the averaged embeddings to
+    :return np.ndarray: one embedding per text
+    """
+    starts = window_offsets[:-1]
+    n_windows = np.diff(window_offsets)
+
+    if out is None:
+        out = np.empty(
+            (len(starts), window_embeddings.shape[1]), dtype=window_embeddings.dtype
+        )
+
+    if len(starts) == 0:
+        return out
+
+    if window_weights is None:
+        np.add.reduceat(window_embeddings, starts, axis=0, out=out)
+        out /= n_windows[:, np.newaxis]
+    else:
+        window_weights = np.asarray(window_weights, dtype=window_embeddings.dtype)
+        np.add.reduceat(
+            window_embeddings * window_weights[:, np.newaxis], starts, axis=0, out=out
+        )
+        out /= np.add.reduceat(window_weights, starts)[:, np.newaxis]
+
+    return out
+
+
+@dataclass
+class PaddingStats:
+    """Counts of real and padded tokens passed through an encoder."""
+
+    real_tokens: int = 0
+    padded_tokens: int = 0
+
+    def update(self, attention_mask: np.ndarray) -> None:
+        """Add the tokens of a padded batch, given its attention mask."""
+        self.real_tokens += int(attention_mask.sum())
+        self.padded_tokens += int(attention_mask.size)
+
+    @property
+    def efficiency(self) -> float:
+        """Return the fraction of tokens in forward passes which weren't padding."""
+        if self.padded_tokens == 0:
+            return 1.0
+        return self.real_tokens / self.padded_tokens
 
 
 class SentenceEncoder(ABC):
@@ -40,6 +219,9 @@ class SentenceEncoder(ABC):
         """Return the dimension of the embeddings produced by the encoder."""
         raise NotImplementedError
 
+    def close(self) -> None:
+        """Release any resources held by the encoder."""
+
 
 class SBERTEncoder(SentenceEncoder):
     """Encoder which uses the sentence-transformers library.
@@ -48,21 +230,187 @@ class SBERTEncoder(SentenceEncoder):
     https://www.sbert.net/docs/pretrained_models.html.
     """
 
-    def __init__(self, model_name: str):
+    backend = "torch"
+
+    def __init__(
+        self,
+        model_name: str,
+        weight_windows_by_new_tokens: bool = False,
+        precision: str = "fp32",
+    ):
+        """
+        Load a sentence-transformers model.
+
+        :param model_name: name or path of the model
+        :param weight_windows_by_new_tokens: when averaging the windows of a long
+            text, weight each window by its number of tokens which aren't in the
+            window before, so tokens in the overlap of the last two windows don't
+            count twice. See `get_window_new_token_counts`.
+        :param precision: one of PRECISIONS. "int8" applies dynamic quantisation to
+            the transformer's linear layers, and "bf16" runs forward passes under
+            bfloat16 autocast, falling back to fp32 if the CPU doesn't support
+            bfloat16. Both only run on CPU, and embeddings are always returned as
+            float32.
+        :raises ValueError: if the precision isn't known
+        """
+        from sentence_transformers import SentenceTransformer
+
         super().__init__()
 
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision '{precision}'. Should be one of {PRECISIONS}."
+            )
+
+        self.model_name = model_name
+        self.precision = precision
         self.encoder = SentenceTransformer(
             model_name, cache_folder=config.INDEX_ENCODER_CACHE_FOLDER
         )
+        self.tokenizer = self.encoder[0].tokenizer
+        self.model_revision = self._get_model_revision()
+        self.weight_windows_by_new_tokens = weight_windows_by_new_tokens
+        self.padding_stats = PaddingStats()
+
+        if precision == "int8":
+            self._quantize_int8()
+        elif precision == "bf16" and not cpu_supports_bf16():
+            logger.warning(
+                "bf16 precision was requested but this CPU doesn't support bfloat16. "
+                "Falling back to fp32."
+            )
+            self.precision = "fp32"
+
+    def _quantize_int8(self) -> None:
+        """
+        Replace the transformer with a copy whose linear layers are quantised to int8.
 
-    def get_n_tokens(self, text: str) -> int:
-        """Return the number of tokens in the text."""
+        The quantised weights are cached as a state dict. Later startups swap the
+        linear layers for empty int8 ones and load the cached weights into them, so
+        they skip the conversion, and no pickled modules are ever loaded.
+        """
+        import torch
+
+        quantized_model_path = get_quantized_model_path(
+            self.model_name, self.model_revision
+        )
+        model = self.encoder[0].auto_model.to("cpu")
+
+        if quantized_model_path.exists():
+            logger.info(f"Loading int8 quantised weights from {quantized_model_path}")
+            quantized_model = _replace_linear_with_dynamic_int8(model)
+            quantized_model.load_state_dict(
+                torch.load(quantized_model_path, weights_only=True)
+            )
+        else:
+            logger.info("Applying dynamic int8 quantisation to the encoder.")
+            quantized_model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+            # Save to a temporary file first so a partial save is never cached
+            quantized_model_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = quantized_model_path.with_suffix(".pt.tmp")
+            torch.save(quantized_model.state_dict(), tmp_path)
+            tmp_path.rename(quantized_model_path)
+
+        self.encoder[0].auto_model = quantized_model
+
+    def _get_model_revision(self) -> str:
+        """
+        Return an identifier for the version of the model's weights.
+
+        This is the commit hash for models from the Hugging Face hub. For models
+        loaded from a local directory it's a fingerprint of the directory's files.
+        """
+        commit_hash = getattr(self.encoder[0].auto_model.config, "_commit_hash", None)
+        if commit_hash:
+            return commit_hash
+
+        model_path = Path(self.model_name)
+        if not model_path.is_dir():
+            return "unknown"
+
+        fingerprint = hashlib.sha1()
+        for file_path in sorted(model_path.rglob("*")):
+            if file_path.is_file():
+                stat = file_path.stat()
+                fingerprint.update(
+                    f"{file_path.relative_to(model_path)}:{stat.st_size}:"
+                    f"{stat.st_mtime_ns}\n".encode()
+                )
+
+        return fingerprint.hexdigest()[:12]
+
+    @property
+    def model_id(self) -> str:
+        """
+        Return an identifier for everything which determines the encoder's output.
+
+        Two encoders with the same model id produce the same embeddings for a text,
+        so embeddings can be reused across runs which share a model id.
+        """
+        return (
+            f"{self.model_name}@{self.model_revision}"
+            f";max_seq_length={self.encoder.max_seq_length}"
+            f";window_stride={self.window_stride}"
+            f";weight_windows_by_new_tokens={self.weight_windows_by_new_tokens}"
+            f";precision={self.precision}"
+            f";backend={self.backend}"
+        )
+
+    @property
+    def window_size(self) -> int:
+        """Return the number of text tokens that fit in the encoder's context window."""
+        max_seq_length = self.encoder.max_seq_length
+        assert isinstance(max_seq_length, int)
+
+        return max_seq_length - self.tokenizer.num_special_tokens_to_add()
+
+    @property
+    def window_stride(self) -> int:
+        """Return the number of tokens between the starts of a long text's windows."""
+        return self.window_size // 2
+
+    def _preprocess(self, text: str) -> str:
+        """Apply the same text preprocessing as `SentenceTransformer.tokenize`."""
+        text = text.strip()
+        if self.encoder[0].do_lower_case:
+            text = text.lower()
+
+        return text
+
+    def get_token_ids(self, text: str) -> list[int]:
+        """Return the ids of the tokens in the text, excluding special tokens."""
+        return self.tokenize_batch([text])[0]
+
+    def tokenize_batch(self, text_batch: Sequence[str]) -> list[list[int]]:
+        """
+        Tokenize a batch of texts in a single call to the (fast) tokenizer.
+
+        Special tokens are excluded, and texts are not truncated.
 
-        tokenized = self.encoder[0].tokenizer(
-            text, return_attention_mask=False, return_token_type_ids=False
+        :param text_batch: texts to tokenize
+        :return list[list[int]]: token ids for each text
+        """
+        if not text_batch:
+            return []
+
+        tokenized = self.tokenizer(
+            [self._preprocess(text) for text in text_batch],
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            verbose=False,
         )
 
-        return len(tokenized["input_ids"])
+        return tokenized["input_ids"]
+
+    def get_n_tokens(self, text: str) -> int:
+        """Return the number of tokens in the text, including special tokens."""
+        return (
+            len(self.get_token_ids(text)) + self.tokenizer.num_special_tokens_to_add()
+        )
 
     def encode(self, text: str, device: Optional[str] = None) -> np.ndarray:
         """Encode a string, return a numpy array.
@@ -74,10 +422,14 @@ class SBERTEncoder(SentenceEncoder):
         Returns:
             np.ndarray
         """
-        return self.encoder.encode(text, device=device, show_progress_bar=False)
+        return self.encode_batch([text], device=device)[0]
 
     def encode_batch(
-        self, text_batch: List[str], batch_size: int = 32, device: Optional[str] = None
+        self,
+        text_batch: List[str],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
     ) -> np.ndarray:
         """Encode a batch of strings, return a numpy array.
 
@@ -85,62 +437,444 @@ class SBERTEncoder(SentenceEncoder):
             text_batch (List[str]): list of strings to encode.
             device (str): torch.device to use for encoding.
             batch_size (int, optional): batch size to encode strings in. Defaults to 32.
+            max_tokens_per_batch (int, optional): if set, pack each forward pass with
+                up to this many padded tokens instead of `batch_size` strings. Defaults
+                to config.ENCODING_MAX_TOKENS_PER_BATCH.
 
         Returns:
             np.ndarray
         """
         return self._encode_batch_using_sliding_window(
-            text_batch, batch_size=batch_size, device=device
+            text_batch,
+            batch_size=batch_size,
+            device=device,
+            max_tokens_per_batch=max_tokens_per_batch,
         )
 
+    def encode_batch_windows(
+        self,
+        text_batch: List[str],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Encode a batch of strings, keeping the embeddings of each sliding window.
+
+        The embeddings are returned as a ragged array: the embeddings of the windows of
+        text `i` are `window_embeddings[window_offsets[i] : window_offsets[i + 1]]`.
+
+        For args, see encode_batch.
+
+        :return tuple[np.ndarray, np.ndarray]: window embeddings and window offsets
+        """
+        window_embeddings, window_offsets, _ = self._encode_windows(
+            text_batch,
+            batch_size=batch_size,
+            device=device,
+            max_tokens_per_batch=max_tokens_per_batch,
+        )
+
+        return window_embeddings, window_offsets
+
     def _encode_batch_using_sliding_window(
-        self, text_batch: list[str], batch_size: int = 32, device: Optional[str] = None
+        self,
+        text_batch: list[str],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
     ):
         """
         Encode a batch of strings accommodating long texts using a sliding window.
 
-        The sliding window has length the size of the underlying encoder's context
-        window, and a stride of half of it.
+        The embedding of a long text is the mean of the embeddings of its windows,
+        optionally weighted by the number of new tokens in each window.
 
         For args, see encode_batch.
         """
 
-        max_seq_length = self.encoder.max_seq_length
-        assert isinstance(max_seq_length, int)
+        window_embeddings, window_offsets, window_weights = self._encode_windows(
+            text_batch,
+            batch_size=batch_size,
+            device=device,
+            max_tokens_per_batch=max_tokens_per_batch,
+        )
 
-        # Split the texts based on length and apply sliding window only to longer texts
-        processed_texts = []
-        window_lengths = []
+        return reduce_window_embeddings(
+            window_embeddings,
+            window_offsets,
+            window_weights=(
+                window_weights if self.weight_windows_by_new_tokens else None
+            ),
+            out=np.empty((len(text_batch), self.dimension), dtype=np.float32),
+        )
+
+    def _encode_windows(
+        self,
+        text_batch: list[str],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Encode a batch of strings as sliding windows over their tokens.
 
-        for text in text_batch:
-            if self.get_n_tokens(text) > max_seq_length:
-                windows = sliding_window(
-                    text, window_size=max_seq_length, stride=max_seq_length // 2
-                )  # Use reasonable, safe, calculated values for the sliding window
-                processed_texts.extend(windows)
-                window_lengths.append(len(windows))
-            else:
-                processed_texts.append(text)
-                window_lengths.append(1)
+        The sliding window is taken over token ids and fills the underlying encoder's
+        context window, with a stride of half of it. Texts which fit in the context
+        window are encoded as a single window.
 
-        embeddings = self.encoder.encode(
-            processed_texts, batch_size=batch_size, device=device  # type: ignore
+        All texts are tokenized in one batched call, and the resulting token ids drive
+        both the windowing and the forward passes.
+
+        For args, see encode_batch.
+
+        :return tuple[np.ndarray, np.ndarray, np.ndarray]: window embeddings, the
+            offset of each text's first window followed by the total number of
+            windows, and the number of tokens in each window which aren't in the
+            window before
+        """
+        window_size = self.window_size
+
+        token_windows = []
+        window_counts = []
+        new_token_counts = []
+
+        for token_ids in self.tokenize_batch(text_batch):
+            windows = sliding_window(
+                token_ids,
+                window_size=window_size,
+                stride=self.window_stride,
+            )
+            token_windows.extend(windows)
+            window_counts.append(len(windows))
+            new_token_counts.extend(
+                get_window_new_token_counts(
+                    len(token_ids), window_size=window_size, stride=self.window_stride
+                )
+            )
+
+        window_offsets = np.zeros(len(window_counts) + 1, dtype=np.int64)
+        np.cumsum(window_counts, out=window_offsets[1:])
+        # The single window of an empty text still needs a non-zero weight
+        window_weights = np.maximum(new_token_counts, 1)
+
+        if not token_windows:
+            window_embeddings = np.empty((0, self.dimension), dtype=np.float32)
+        else:
+            window_embeddings = self._encode_token_ids(
+                token_windows,
+                batch_size=batch_size,
+                device=device,
+                max_tokens_per_batch=max_tokens_per_batch,
+            )
+
+        return window_embeddings, window_offsets, window_weights
+
+    def _pad_token_ids(
+        self, token_ids: Sequence[Sequence[int]]
+    ) -> dict[str, np.ndarray]:
+        """Add special tokens to each sequence and pad them into model features."""
+        sequences = [
+            self.tokenizer.build_inputs_with_special_tokens(list(ids))
+            for ids in token_ids
+        ]
+        max_length = max(len(sequence) for sequence in sequences)
+
+        input_ids = np.full(
+            (len(sequences), max_length), self.tokenizer.pad_token_id, dtype=np.int64
+        )
+        attention_mask = np.zeros((len(sequences), max_length), dtype=np.int64)
+
+        for row, sequence in enumerate(sequences):
+            input_ids[row, : len(sequence)] = sequence
+            attention_mask[row, : len(sequence)] = 1
+
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def _encode_token_ids(
+        self,
+        token_ids: Sequence[Sequence[int]],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Run the encoder directly on already tokenized sequences.
+
+        This skips the tokenization `SentenceTransformer.encode` would otherwise redo.
+        Sequences are sorted by length before batching to minimise padding, and the
+        amount of padding is recorded in `self.padding_stats`.
+
+        :param token_ids: token ids for each sequence, excluding special tokens. Each
+            sequence must fit in the encoder's context window.
+        :param batch_size: number of sequences per forward pass
+        :param device: torch.device to use for encoding
+        :param max_tokens_per_batch: if set, the budget of padded tokens per forward
+            pass, which replaces `batch_size`. Defaults to
+            config.ENCODING_MAX_TOKENS_PER_BATCH.
+        :return np.ndarray: one embedding per sequence, in input order
+        """
+        if max_tokens_per_batch is None:
+            max_tokens_per_batch = config.ENCODING_MAX_TOKENS_PER_BATCH
+
+        embeddings = np.empty((len(token_ids), self.dimension), dtype=np.float32)
+        length_sorted_idx = np.argsort([-len(ids) for ids in token_ids], kind="stable")
+        n_special_tokens = self.tokenizer.num_special_tokens_to_add()
+        batch_boundaries = get_batch_boundaries(
+            [len(token_ids[idx]) + n_special_tokens for idx in length_sorted_idx],
+            batch_size=batch_size,
+            max_tokens_per_batch=max_tokens_per_batch,
         )
 
-        # Reduce the embeddings to the original number of texts
-        reduced_embeddings = []
+        for start_index, end_index in batch_boundaries:
+            batch_idx = length_sorted_idx[start_index:end_index]
+            padded = self._pad_token_ids([token_ids[idx] for idx in batch_idx])
+            self.padding_stats.update(padded["attention_mask"])
+
+            embeddings[batch_idx] = self._forward(padded, device=device)
 
-        for length in window_lengths:
-            if length > 1:
-                reduced_embeddings.append(np.mean(embeddings[:length], axis=0))
-                embeddings = embeddings[length:]
-            else:
-                reduced_embeddings.append(embeddings[0])
-                embeddings = embeddings[1:]
+        return embeddings
 
-        return np.vstack(reduced_embeddings)
+    def _forward(
+        self, features: dict[str, np.ndarray], device: Optional[str] = None
+    ) -> np.ndarray:
+        """Run the model on a padded batch, returning its sentence embeddings."""
+        import torch
+        from sentence_transformers.util import batch_to_device
+
+        if self.precision in CPU_ONLY_PRECISIONS and device not in (None, "cpu"):
+            logger.warning(
+                f"{self.precision} precision only runs on CPU, ignoring device "
+                f"'{device}'."
+            )
+            device = "cpu"
+
+        device = device or str(self.encoder.device)
+        self.encoder.to(device)
+
+        tensors = batch_to_device(
+            {name: torch.from_numpy(array) for name, array in features.items()}, device
+        )
+
+        with torch.no_grad(), torch.autocast(
+            device_type="cpu",
+            dtype=torch.bfloat16,
+            enabled=self.precision == "bf16",
+        ):
+            out_features = self.encoder.forward(tensors)
+
+        return out_features["sentence_embedding"].float().cpu().numpy()
 
     @property
     def dimension(self) -> int:
         """Return the dimension of the embedding."""
         return self.encoder.get_sentence_embedding_dimension()
+
+
+def _get_sentence_embedding_module(
+    sentence_transformer: "torch.nn.Module",
+) -> "torch.nn.Module":
+    """Wrap a SentenceTransformer so it can be traced for export to ONNX."""
+    import torch
+
+    class SentenceEmbeddingModule(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.sentence_transformer = sentence_transformer
+
+        def forward(
+            self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+        ) -> torch.Tensor:
+            features = {"input_ids": input_ids, "attention_mask": attention_mask}
+            return self.sentence_transformer(features)["sentence_embedding"]
+
+    return SentenceEmbeddingModule()
+
+
+def _replace_linear_with_dynamic_int8(module: "torch.nn.Module") -> "torch.nn.Module":
+    """
+    Swap a module's linear layers for dynamically quantised int8 ones, in place.
+
+    The new layers have zero weights, for loading quantised weights into. This is
+    the structure `quantize_dynamic` produces, without quantising any weights.
+    """
+    import torch
+
+    for name, child in module.named_children():
+        # quantize_dynamic only swaps layers of exactly this type
+        if type(child) is torch.nn.Linear:
+            setattr(
+                module,
+                name,
+                torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features,
+                    child.out_features,
+                    bias_=child.bias is not None,
+                    dtype=torch.qint8,
+                ),
+            )
+        else:
+            _replace_linear_with_dynamic_int8(child)
+
+    return module
+
+
+def get_onnx_model_path(model_name: str, model_revision: str) -> Path:
+    """Return the path the ONNX export of a revision of a model is cached at."""
+    return get_model_cache_dir(model_name, "onnx") / model_revision / "model.onnx"
+
+
+def get_quantized_model_path(model_name: str, model_revision: str) -> Path:
+    """
+    Return the path the int8 quantised weights of a revision of a model are cached at.
+
+    The layout of quantised weights can change between torch versions, so the path
+    includes the torch version they were created with.
+    """
+    import torch
+
+    return (
+        get_model_cache_dir(model_name, "quantized")
+        / model_revision
+        / f"int8-torch-{torch.__version__}.pt"
+    )
+
+
+class ONNXEncoder(SBERTEncoder):
+    """Encoder which runs a sentence-transformers model with ONNX Runtime.
+
+    The model is exported to ONNX the first time it's used, and the export is cached
+    in INDEX_ENCODER_CACHE_FOLDER. Tokenization, sliding windows and batching are the
+    same as for SBERTEncoder; only the forward passes run in ONNX Runtime, with all
+    graph optimisations enabled. Only CPU inference is supported.
+
+    Requires the optional `onnx` dependencies.
+    """
+
+    backend = "onnx"
+
+    def __init__(
+        self,
+        model_name: str,
+        weight_windows_by_new_tokens: bool = False,
+        precision: str = "fp32",
+    ):
+        if precision != "fp32":
+            raise ValueError(
+                f"The ONNX encoder only supports fp32 precision, not '{precision}'."
+            )
+
+        super().__init__(
+            model_name, weight_windows_by_new_tokens=weight_windows_by_new_tokens
+        )
+
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                "The ONNX encoder backend requires onnxruntime. Install it with "
+                "`poetry install --extras onnx`."
+            ) from e
+
+        onnx_model_path = get_onnx_model_path(model_name, self.model_revision)
+        if not onnx_model_path.exists():
+            self._export_to_onnx(onnx_model_path)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            str(onnx_model_path),
+            sess_options=session_options,
+            providers=["CPUExecutionProvider"],
+        )
+
+        # Only the tokenizer and the pooling config are needed from here on, so
+        # release the torch weights rather than keep a second copy of the model
+        self.encoder[0].auto_model = None
+
+    def _export_to_onnx(self, onnx_model_path: Path) -> None:
+        """Export the model to ONNX, with dynamic batch and sequence dimensions."""
+        import torch
+
+        logger.info(f"Exporting encoder to ONNX at {onnx_model_path}")
+        onnx_model_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.encoder.to("cpu")
+        dummy_features = {
+            name: torch.from_numpy(array)
+            for name, array in self._pad_token_ids([[0] * 8, [0] * 4]).items()
+        }
+
+        # Newer versions of torch export with dynamo by default. The TorchScript
+        # exporter is used everywhere, and older versions don't take the argument.
+        export_kwargs = (
+            {"dynamo": False}
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters
+            else {}
+        )
+
+        # Export to a temporary file first so a partial export is never cached
+        tmp_path = onnx_model_path.with_suffix(".onnx.tmp")
+        with torch.no_grad():
+            torch.onnx.export(
+                _get_sentence_embedding_module(self.encoder),
+                (dummy_features["input_ids"], dummy_features["attention_mask"]),
+                str(tmp_path),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["sentence_embedding"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "sentence_embedding": {0: "batch"},
+                },
+                opset_version=17,
+                **export_kwargs,
+            )
+        tmp_path.rename(onnx_model_path)
+
+    def _forward(
+        self, features: dict[str, np.ndarray], device: Optional[str] = None
+    ) -> np.ndarray:
+        """Run the ONNX model on a padded batch, returning its sentence embeddings."""
+        if device not in (None, "cpu"):
+            logger.warning(
+                f"The ONNX encoder only runs on CPU, ignoring device '{device}'."
+            )
+
+        return self.session.run(["sentence_embedding"], features)[0]
+
+
+ENCODER_BACKENDS: dict[str, type[SBERTEncoder]] = {
+    "torch": SBERTEncoder,
+    "onnx": ONNXEncoder,
+}
+
+
+def load_encoder(
+    model_name: str,
+    backend: str = "torch",
+    weight_windows_by_new_tokens: bool = False,
+    precision: str = "fp32",
+) -> SBERTEncoder:
+    """
+    Load an encoder for a sentence-transformers model with the given backend.
+
+    :param model_name: name or path of the model
+    :param backend: one of ENCODER_BACKENDS
+    :param weight_windows_by_new_tokens: see SBERTEncoder
+    :param precision: one of PRECISIONS. Not all backends support all precisions.
+    :raises ValueError: if the backend or precision isn't supported
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(
+            f"Unknown encoder backend '{backend}'. Should be one of "
+            f"{list(ENCODER_BACKENDS)}."
+        )
+
+    return ENCODER_BACKENDS[backend](
+        model_name,
+        weight_windows_by_new_tokens=weight_windows_by_new_tokens,
+        precision=precision,
+    )
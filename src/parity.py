@@ -0,0 +1,72 @@
+"""Checks that encoders running at reduced precision match full precision."""
+
+from typing import Dict, Sequence
+
+import numpy as np
+
+from src.ml import SentenceEncoder
+
+# Fixed sample of texts to compare encoders on, covering the kinds of text in parsed
+# policy documents: headings, short and long paragraphs, numbers and non-prose.
+PARITY_SAMPLE_TEXTS = [
+    "Climate Change Act 2008",
+    "Chapter 3: Adaptation",
+    "Page 3 of 120",
+    "The Secretary of State must ensure that the net UK carbon account for the year "
+    "2050 is at least 100% lower than the 1990 baseline.",
+    "The National Adaptation Programme sets out actions to address the risks "
+    "identified in the climate change risk assessment, including flooding, "
+    "heatwaves and water scarcity.",
+    "Table 2. Emissions by sector (MtCO2e): energy 120.4, transport 98.1, "
+    "agriculture 45.7, waste 16.2.",
+    "Renewable energy targets: 15% of final energy consumption by 2020, rising to "
+    "32% by 2030.",
+    "This policy was adopted by the Council of Ministers on 12 March 2019 and "
+    "enters into force on the date of its publication in the Official Gazette.",
+    "",
+    " ".join(
+        [
+            "The government will support the transition to a low carbon economy "
+            "through investment in clean energy, energy efficiency in buildings, "
+            "sustainable transport and the protection of forests and peatlands."
+        ]
+        * 30
+    ),
+]
+
+
+def cosine_similarities(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the cosine similarity between each pair of rows in two arrays."""
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return np.sum(a * b, axis=1) / np.maximum(norms, np.finfo(np.float32).eps)
+
+
+def precision_parity_report(
+    reference: SentenceEncoder,
+    candidate: SentenceEncoder,
+    texts: Sequence[str] = PARITY_SAMPLE_TEXTS,
+    batch_size: int = 32,
+) -> Dict[str, float]:
+    """
+    Compare the embeddings of a candidate encoder with those of a reference encoder.
+
+    :param reference: encoder to compare against, usually running at fp32
+    :param candidate: encoder to check, e.g. running at a reduced precision
+    :param texts: texts to encode with both encoders
+    :param batch_size: batch size for encoding
+    :return Dict[str, float]: summary of cosine similarities and absolute
+        differences between the embeddings of each text
+    """
+    reference_embeddings = reference.encode_batch(list(texts), batch_size=batch_size)
+    candidate_embeddings = candidate.encode_batch(list(texts), batch_size=batch_size)
+
+    similarities = cosine_similarities(reference_embeddings, candidate_embeddings)
+
+    return {
+        "n_texts": len(texts),
+        "min_cosine_similarity": float(similarities.min()),
+        "mean_cosine_similarity": float(similarities.mean()),
+        "max_abs_difference": float(
+            np.abs(reference_embeddings - candidate_embeddings).max()
+        ),
+    }
@@ -0,0 +1,142 @@
+"""Helpers for running the embeddings generation pipeline as streaming stages."""
+
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# How often a blocked producer checks whether the consumer has stopped, in seconds
+_POLL_INTERVAL = 0.1
+
+
+class _Done:
+    """Marks the end of a buffered iterable."""
+
+
+@dataclass
+class _Failure:
+    """An exception raised while producing the items of a buffered iterable."""
+
+    exception: BaseException
+
+
+def buffered(iterable: Iterable[T], max_size: int) -> Iterator[T]:
+    """
+    Iterate over an iterable in a background thread, keeping up to `max_size` items.
+
+    Producing items (e.g. reading and parsing input files) starts straight away and
+    overlaps with whatever consumes them. The queue between the two is bounded, so
+    the producer only runs ahead of the consumer by `max_size` items, and memory use
+    doesn't grow with the length of the iterable.
+
+    Exceptions raised by the iterable are re-raised by the returned iterator. If the
+    returned iterator is closed early, the background thread stops too.
+
+    :param iterable: items to produce, e.g. a chain of generators
+    :param max_size: maximum number of items produced but not yet consumed
+    :return Iterator: the items of `iterable`, in order
+    """
+    items: queue.Queue = queue.Queue(maxsize=max_size)
+    stopped = threading.Event()
+
+    def put(item: Any) -> bool:
+        """Put an item on the queue, returning False if the consumer has stopped."""
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Failure(e))
+        else:
+            put(_Done())
+
+    thread = threading.Thread(target=produce, name="pipeline-buffer", daemon=True)
+    thread.start()
+
+    return _consume(items, stopped)
+
+
+def _consume(items: queue.Queue, stopped: threading.Event) -> Iterator[Any]:
+    try:
+        while True:
+            item = items.get()
+            if isinstance(item, _Done):
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
+
+
+def prefetch(
+    func: Callable[[T], R], items: Iterable[T], n_in_flight: int
+) -> Iterator[R]:
+    """
+    Apply a function to items in a thread pool, keeping `n_in_flight` calls running.
+
+    This is for I/O-bound functions such as downloading a document: while the caller
+    works on one result, the next `n_in_flight` items are already being fetched,
+    hiding their latency. Results are yielded in the order of `items`, and an
+    exception raised by `func` is re-raised when its result is reached.
+
+    :param func: function to apply to each item
+    :param items: items to apply the function to
+    :param n_in_flight: number of calls to run ahead of the caller, and the number
+        of threads
+    :return Iterator: the result of `func` for each item, in order
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=n_in_flight, thread_name_prefix="prefetch"
+    )
+    futures: Deque[Future] = deque()
+
+    try:
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) > n_in_flight:
+                yield futures.popleft().result()
+
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def take_until(stop: threading.Event, iterable: Iterable[T]) -> Iterator[T]:
+    """
+    Yield items until an event is set, then close the iterable.
+
+    The event is checked before each item is taken, so once it's set no more items
+    are taken from the iterable. Closing it stops e.g. a `buffered` producer thread.
+
+    :param stop: event which stops iteration once set
+    :param iterable: items to yield
+    :return Iterator: the items of `iterable`, up to when `stop` was set
+    """
+    iterator = iter(iterable)
+    try:
+        while not stop.is_set():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
@@ -1,13 +1,58 @@
+import io
 import tempfile
-from typing import Any, Sequence
+import threading
+from typing import Any, Dict, List, Optional, Sequence
 
 import boto3
 import numpy as np
 from aws_error_utils.aws_error_utils import errors
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+from src import config
 from src.config import S3_PATTERN
 
+_s3_client: Optional[Any] = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client() -> Any:
+    """
+    Return the S3 client shared by the process, creating it on first use.
+
+    boto3 clients are thread-safe and keep a pool of connections which are reused
+    across requests, so one client serves every thread. Creating clients from
+    boto3's default session isn't thread-safe, so the client is created under a lock.
+    """
+    global _s3_client
+
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.session.Session().client(
+                    "s3",
+                    config=Config(
+                        max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                        retries={
+                            "mode": config.S3_RETRY_MODE,
+                            "max_attempts": config.S3_MAX_ATTEMPTS,
+                        },
+                        connect_timeout=config.S3_CONNECT_TIMEOUT,
+                        read_timeout=config.S3_READ_TIMEOUT,
+                        tcp_keepalive=True,
+                    ),
+                )
+
+    return _s3_client
+
+
+def reset_s3_client() -> None:
+    """Discard the shared S3 client, so the next one picks up new credentials or mocks."""
+    global _s3_client
+
+    with _s3_client_lock:
+        _s3_client = None
+
 
 def validate_s3_pattern(s3_path: str):
     """Validates that a string is a valid s3 path."""
@@ -16,12 +61,10 @@ def validate_s3_pattern(s3_path: str):
         raise Exception(f"Key does not represent an s3 path: {s3_path}")
     bucket = s3_match.group("bucket")
     key = s3_match.group("prefix")
-    s3client = boto3.client("s3")
+    s3client = get_s3_client()
     return bucket, key, s3client
 
 
-# TODO do we want to instantiate one client object and pass that through rather than
-#  instantiating each time?
 def check_file_exists_in_s3(s3_path: str) -> bool:
     """Checks whether a file exists in an S3 bucket."""
     bucket, key, s3client = validate_s3_pattern(s3_path)
@@ -38,18 +81,28 @@ def check_file_exists_in_s3(s3_path: str) -> bool:
         raise e
 
 
-def get_s3_keys_with_prefix(s3_prefix: str) -> Sequence[str]:
+def get_s3_object_metadata(s3_path: str) -> Dict[str, Any]:
     """
-    Get a list of keys in an S3 bucket with a given prefix.
+    Get the metadata of an S3 object with a HEAD request.
 
-    Returns an empty list if the prefix does not exist or is empty.
+    :param s3_path: path of the object, including s3:// at the start
+    :return dict: the head_object response, including the object's `ETag` and
+        `LastModified` time
+    """
+    bucket, key, s3client = validate_s3_pattern(s3_path)
+    return s3client.head_object(Bucket=bucket, Key=key)
 
-    We use this instead of cloudpathlib's glob because it's much faster. Relevant issue:
-    https://github.com/drivendataorg/cloudpathlib/issues/274.
+
+def get_s3_objects_with_prefix(s3_prefix: str) -> List[Dict[str, Any]]:
+    """
+    Get the objects in an S3 bucket with a given prefix, with their metadata.
+
+    Returns an empty list if the prefix does not exist or is empty.
 
     :param s3_prefix: prefix, including s3:// at the start
     :raises Exception: if prefix does not represent an s3 path
-    :return list[str]: list of full paths to objects in bucket, excluding s3:// prefix
+    :return list[dict]: the `Key`, `ETag`, `LastModified` and `Size` of each object,
+        as returned by list_objects_v2. Keys exclude the s3:// prefix.
     """
     s3_match = S3_PATTERN.match(s3_prefix)
     if s3_match is None:
@@ -57,7 +110,7 @@ def get_s3_keys_with_prefix(s3_prefix: str) -> Sequence[str]:
 
     bucket = s3_match.group("bucket")
     prefix = s3_match.group("prefix").rstrip("/") + "/"
-    s3client = boto3.client("s3")
+    s3client = get_s3_client()
 
     try:
         list_response = s3client.list_objects_v2(Bucket=bucket, Prefix=prefix)
@@ -66,7 +119,7 @@ def get_s3_keys_with_prefix(s3_prefix: str) -> Sequence[str]:
     except Exception as e:
         raise e
 
-    files = [o["Key"] for o in list_response.get("Contents", []) if o["Key"] != prefix]
+    objects = [o for o in list_response.get("Contents", []) if o["Key"] != prefix]
 
     finished_listing = not list_response["IsTruncated"]
     while not finished_listing:
@@ -76,12 +129,26 @@ def get_s3_keys_with_prefix(s3_prefix: str) -> Sequence[str]:
             Prefix=prefix,
             ContinuationToken=continuation_token,
         )
-        files.extend(
-            [o["Key"] for o in list_response["Contents"] if o["Key"] != prefix]
-        )
+        objects.extend([o for o in list_response["Contents"] if o["Key"] != prefix])
         finished_listing = not list_response["IsTruncated"]
 
-    return files
+    return objects
+
+
+def get_s3_keys_with_prefix(s3_prefix: str) -> Sequence[str]:
+    """
+    Get a list of keys in an S3 bucket with a given prefix.
+
+    Returns an empty list if the prefix does not exist or is empty.
+
+    We use this instead of cloudpathlib's glob because it's much faster. Relevant issue:
+    https://github.com/drivendataorg/cloudpathlib/issues/274.
+
+    :param s3_prefix: prefix, including s3:// at the start
+    :raises Exception: if prefix does not represent an s3 path
+    :return list[str]: list of full paths to objects in bucket, excluding s3:// prefix
+    """
+    return [o["Key"] for o in get_s3_objects_with_prefix(s3_prefix)]
 
 
 def s3_object_read_text(s3_path: str) -> str:
@@ -132,3 +199,19 @@ def save_ndarray_to_s3_as_npy(array: Any, s3_path: str) -> None:
             raise ValueError(f"Bucket {bucket} does not exist")
         except Exception as e:
             raise e
+
+
+def load_npy_from_s3(s3_path: str) -> np.ndarray:
+    """Loads a NumPy ndarray from a .npy file in an S3 bucket."""
+    bucket, key, s3client = validate_s3_pattern(s3_path)
+
+    try:
+        response = s3client.get_object(Bucket=bucket, Key=key)
+    except errors.NoSuchBucket:
+        raise ValueError(f"Bucket {bucket} does not exist")
+    except errors.NoSuchKey:
+        raise ValueError(f"Key {key} does not exist")
+    except Exception as e:
+        raise e
+
+    return np.load(io.BytesIO(response["Body"].read()))
@@ -0,0 +1,57 @@
+"""Graceful shutdown of a run when the process is asked to stop."""
+
+import logging
+import signal
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# Exit code of a run that stopped early on SIGTERM, after saving its progress.
+# This is EX_TEMPFAIL: the run can be retried and resumes where it stopped.
+INTERRUPTED_EXIT_CODE = 75
+
+
+class RunInterrupted(Exception):
+    """Raised when a run stopped early on SIGTERM, after saving its progress."""
+
+
+@contextmanager
+def handle_sigterm() -> Iterator[threading.Event]:
+    """
+    Set an event on SIGTERM instead of exiting, while in the context.
+
+    Spot and batch schedulers send SIGTERM shortly before killing a job. The event
+    lets the run stop taking new work and save what it has done in the grace
+    period. The previous handler is restored on leaving the context.
+
+    Signal handlers can only be set from the main thread. Elsewhere, the event is
+    never set and SIGTERM keeps its existing handler.
+
+    :return Iterator[threading.Event]: event set once SIGTERM is received
+    """
+    shutdown = threading.Event()
+
+    if threading.current_thread() is not threading.main_thread():
+        yield shutdown
+        return
+
+    def request_shutdown(signum, frame) -> None:
+        shutdown.set()
+
+    previous_handler = signal.signal(signal.SIGTERM, request_shutdown)
+    try:
+        yield shutdown
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
+def ignore_sigterm() -> None:
+    """
+    Ignore SIGTERM in this process, e.g. in worker processes.
+
+    When SIGTERM is sent to a whole process group, workers then keep running until
+    the main process has finished its current work and shuts them down.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
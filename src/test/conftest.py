@@ -1,16 +1,20 @@
+import hashlib
 import json
 import os
-from typing import List, Sequence, Union
+from typing import List, Optional, Sequence, Union
 
 import boto3
 import botocore.client
+import numpy as np
 import pytest
-from cpr_sdk.parser_models import HTMLData, ParserOutput
+from cpr_sdk.parser_models import BlockType, HTMLData, HTMLTextBlock, ParserOutput
 from cpr_sdk.pipeline_general_models import BackendDocument
 from moto import mock_aws
 from pydantic import AnyHttpUrl
 
 from cli.test.conftest import get_html_text_block
+from src.ml import SentenceEncoder
+from src.s3 import reset_s3_client
 
 
 class S3Client:
@@ -29,6 +33,46 @@ class S3Client:
         )
 
 
+class FakeEncoder(SentenceEncoder):
+    """
+    Deterministic encoder which doesn't need a model.
+
+    Each text is embedded as a pseudo-random vector seeded by its hash, and every call
+    to `encode_batch` is recorded so tests can inspect how work was batched.
+    """
+
+    def __init__(self, dimension: int = 8):
+        self._dimension = dimension
+        self.batches: List[List[str]] = []
+
+    def _embed(self, text: str) -> np.ndarray:
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).random(self._dimension, dtype=np.float32)
+
+    def encode(self, text: str, device: Optional[str] = None) -> np.ndarray:
+        """Return the text's pseudo-random embedding."""
+        return self._embed(text)
+
+    def encode_batch(
+        self, text_batch: List[str], batch_size: int = 32, device: Optional[str] = None
+    ) -> np.ndarray:
+        """Record the batch, and return the embedding of each text in it."""
+        self.batches.append(list(text_batch))
+        if not text_batch:
+            return np.empty((0, self._dimension), dtype=np.float32)
+        return np.vstack([self._embed(text) for text in text_batch])
+
+    @property
+    def dimension(self) -> int:
+        """Return the dimension of the embeddings."""
+        return self._dimension
+
+
+@pytest.fixture
+def fake_encoder() -> FakeEncoder:
+    return FakeEncoder()
+
+
 @pytest.fixture
 def s3_bucket_and_region() -> dict:
     return {
@@ -77,6 +121,8 @@ def pipeline_s3_objects(
 @pytest.fixture
 def pipeline_s3_client(s3_bucket_and_region, pipeline_s3_objects):
     with mock_aws():
+        # The shared client has to be created inside the mock
+        reset_s3_client()
         s3_client = S3Client(s3_bucket_and_region["region"])
 
         s3_client.client.create_bucket(
@@ -95,6 +141,8 @@ def pipeline_s3_client(s3_bucket_and_region, pipeline_s3_objects):
 
         yield s3_client
 
+    reset_s3_client()
+
 
 def get_parser_output(
     html_data: Union[HTMLData, None],
@@ -102,10 +150,12 @@ def get_parser_output(
     languages: Union[Sequence[str], None],
     content_type: Union[str, None],
     translated: bool,
+    document_id: str = "test_id",
+    document_description: str = "test_description",
 ):
     """Return a ParserOutput object with the given parameters."""
     return ParserOutput(
-        document_id="test_id",
+        document_id=document_id,
         document_metadata=BackendDocument.model_validate(
             {
                 "publication_ts": "2013-01-01T00:00:00",
@@ -135,7 +185,7 @@ def get_parser_output(
             }
         ),
         document_name="test_name",
-        document_description="test_description",
+        document_description=document_description,
         document_source_url=(AnyHttpUrl(source_url) if source_url else None),
         document_cdn_object="test_cdn_object",
         document_md5_sum="test_md5_sum",
@@ -248,3 +298,45 @@ def test_parser_output_source_url_un_supported_lang_data() -> List[ParserOutput]
             translated=False,
         )
     ]
+
+
+def get_parser_output_with_texts(
+    document_id: str, description: str, texts: Sequence[str]
+) -> ParserOutput:
+    """Return an English HTML ParserOutput with one text block per text."""
+    return get_parser_output(
+        html_data=HTMLData(
+            has_valid_text=True,
+            text_blocks=[
+                HTMLTextBlock(
+                    text=[text],
+                    text_block_id=f"{document_id}_{idx}",
+                    language="en",
+                    type=BlockType.TEXT,
+                    type_confidence=1.0,
+                )
+                for idx, text in enumerate(texts)
+            ],
+        ),
+        source_url="https://www.example.com/files/climate-document.html",
+        languages=["en"],
+        content_type="text/html",
+        translated=False,
+        document_id=document_id,
+        document_description=description,
+    )
+
+
+@pytest.fixture
+def test_parser_outputs_with_texts() -> List[ParserOutput]:
+    """Returns parser outputs with distinct texts and varying numbers of blocks."""
+    return [
+        get_parser_output_with_texts(
+            document_id=f"doc_{doc_idx}",
+            description=f"description of document {doc_idx}",
+            texts=[
+                f"block {block_idx} of document {doc_idx}" for block_idx in range(n)
+            ],
+        )
+        for doc_idx, n in enumerate([3, 0, 1, 7, 2, 5])
+    ]
@@ -0,0 +1,254 @@
+import logging
+import threading
+
+import numpy as np
+
+from src import config
+from src.batching import (
+    EncodingScheduler,
+    encode_parser_outputs,
+    get_text_hash,
+    get_texts_to_encode,
+)
+from src.ml import SBERTEncoder
+from src.test.conftest import get_parser_output_with_texts
+from src.utils import encode_parser_output
+
+
+def test_get_texts_to_encode(test_parser_outputs_with_texts):
+    """Tests that the description is followed by the text blocks, in order."""
+    parser_output = test_parser_outputs_with_texts[0]
+
+    assert get_texts_to_encode(parser_output) == [
+        "description of document 0",
+        "block 0 of document 0",
+        "block 1 of document 0",
+        "block 2 of document 0",
+    ]
+
+
+def test_encode_parser_outputs_full_batches(
+    fake_encoder, test_parser_outputs_with_texts
+):
+    """Tests that texts from many documents are pooled into full batches."""
+    batch_size = 4
+
+    outputs = list(
+        encode_parser_outputs(
+            fake_encoder, test_parser_outputs_with_texts, batch_size=batch_size
+        )
+    )
+
+    # Documents are returned in order, with one row per text
+    assert [parser_output for parser_output, _ in outputs] == (
+        test_parser_outputs_with_texts
+    )
+    for parser_output, embeddings in outputs:
+        texts = get_texts_to_encode(parser_output)
+        assert embeddings.shape == (len(texts), fake_encoder.dimension)
+        for text, embedding in zip(texts, embeddings):
+            assert np.array_equal(embedding, fake_encoder.encode(text))
+
+    # Every batch is a multiple of the batch size apart from the last one
+    n_texts = sum(
+        len(get_texts_to_encode(parser_output))
+        for parser_output in test_parser_outputs_with_texts
+    )
+    assert sum(len(batch) for batch in fake_encoder.batches) == n_texts
+    for batch in fake_encoder.batches[:-1]:
+        assert len(batch) % batch_size == 0
+
+
+def test_encode_parser_outputs_pools_batches(
+    fake_encoder, test_parser_outputs_with_texts
+):
+    """Tests that several batches of texts are pooled before encoding."""
+    outputs = list(
+        encode_parser_outputs(
+            fake_encoder, test_parser_outputs_with_texts, batch_size=2, pool_batches=5
+        )
+    )
+
+    assert len(outputs) == len(test_parser_outputs_with_texts)
+    for batch in fake_encoder.batches[:-1]:
+        assert len(batch) >= 10
+        assert len(batch) % 2 == 0
+
+
+def test_encode_parser_outputs_deduplicates_texts(fake_encoder):
+    """Tests that each distinct text is only encoded once per run."""
+    parser_outputs = [
+        get_parser_output_with_texts(
+            document_id=f"doc_{idx}",
+            description=description,
+            texts=["Page 1", f"body {idx}", "Page 1"],
+        )
+        for idx, description in enumerate(["", "same", "", "same", "other", ""])
+    ]
+
+    outputs = list(encode_parser_outputs(fake_encoder, parser_outputs, batch_size=2))
+
+    encoded_texts = [text for batch in fake_encoder.batches for text in batch]
+    assert sorted(encoded_texts) == sorted(
+        ["", "other", "same", "Page 1"] + [f"body {idx}" for idx in range(6)]
+    )
+
+    for parser_output, embeddings in outputs:
+        for text, embedding in zip(get_texts_to_encode(parser_output), embeddings):
+            assert np.array_equal(embedding, fake_encoder.encode(text))
+
+
+def test_encode_parser_outputs_reuses_near_duplicates(fake_encoder, caplog):
+    """Tests that near-duplicate texts reuse an embedding when enabled, and are logged."""
+    paragraph = (
+        "This policy applies to all government departments and agencies, and "
+        "should be read together with the national climate change strategy."
+    )
+    parser_outputs = [
+        get_parser_output_with_texts(
+            document_id=f"doc_{idx}",
+            description=f"description {idx}",
+            texts=[f"{paragraph} Page {idx + 1}", "an unrelated heading"],
+        )
+        for idx in range(3)
+    ]
+
+    with caplog.at_level(logging.INFO):
+        outputs = list(
+            encode_parser_outputs(
+                fake_encoder,
+                parser_outputs,
+                batch_size=2,
+                near_duplicate_threshold=0.8,
+            )
+        )
+
+    encoded_texts = [text for batch in fake_encoder.batches for text in batch]
+    assert f"{paragraph} Page 1" in encoded_texts
+    assert f"{paragraph} Page 2" not in encoded_texts
+    assert f"{paragraph} Page 3" not in encoded_texts
+
+    first_embedding = outputs[0][1][1]
+    for _, embeddings in outputs[1:]:
+        assert np.array_equal(embeddings[1], first_embedding)
+
+    near_duplicate_logs = [
+        record for record in caplog.records if "near-duplicate" in record.message
+    ]
+    assert [record.props["document_id"] for record in near_duplicate_logs] == [
+        "doc_1",
+        "doc_2",
+    ]
+    assert near_duplicate_logs[0].props["rows"] == [1]
+    assert near_duplicate_logs[0].props["text_block_ids"] == ["doc_1_0"]
+
+
+def test_encoding_scheduler_reports_duplicates(fake_encoder):
+    """Tests that the scheduler counts the duplicate texts it didn't encode."""
+    scheduler = EncodingScheduler(fake_encoder, batch_size=2)
+    for idx in range(3):
+        scheduler.add(
+            get_parser_output_with_texts(
+                document_id=f"doc_{idx}", description="", texts=["Page 1", "Page 1"]
+            )
+        )
+        scheduler.encode_pool(flush=True)
+
+    assert scheduler.n_texts == 9
+    assert scheduler.n_texts_encoded == 2
+    assert scheduler.n_duplicates_removed == 7
+
+
+def test_encode_parser_outputs_reuses_given_embeddings(fake_encoder):
+    """Tests that texts with a reusable embedding aren't encoded."""
+    parser_output = get_parser_output_with_texts(
+        document_id="doc", description="description", texts=["same", "changed"]
+    )
+    reused_embedding = np.full(fake_encoder.dimension, 7, dtype=np.float32)
+
+    def get_reusable_embeddings(_):
+        return {get_text_hash("same"): reused_embedding}
+
+    [(_, embeddings)] = encode_parser_outputs(
+        fake_encoder,
+        [parser_output],
+        batch_size=2,
+        get_reusable_embeddings=get_reusable_embeddings,
+    )
+
+    encoded_texts = [text for batch in fake_encoder.batches for text in batch]
+    assert sorted(encoded_texts) == ["changed", "description"]
+    assert np.array_equal(embeddings[1], reused_embedding)
+    assert np.array_equal(embeddings[2], fake_encoder.encode("changed"))
+
+
+def test_encode_parser_outputs_empty(fake_encoder):
+    """Tests that no encoding happens when there are no documents."""
+    assert list(encode_parser_outputs(fake_encoder, [], batch_size=4)) == []
+    assert fake_encoder.batches == []
+
+
+def test_encode_parser_outputs_stops_without_flushing(
+    fake_encoder, test_parser_outputs_with_texts
+):
+    """Tests that queued texts aren't encoded once stopped, and their documents are dropped."""
+    stop = threading.Event()
+
+    def inputs():
+        for parser_output in test_parser_outputs_with_texts[:4]:
+            yield parser_output
+        stop.set()
+
+    outputs = list(
+        encode_parser_outputs(fake_encoder, inputs(), batch_size=4, stop=stop)
+    )
+
+    # doc_3's last 3 texts were still queued, so it isn't yielded
+    assert [parser_output for parser_output, _ in outputs] == (
+        test_parser_outputs_with_texts[:3]
+    )
+    assert [len(batch) for batch in fake_encoder.batches] == [4, 8]
+
+
+def test_encode_parser_outputs_matches_per_document_encoding(
+    test_parser_outputs_with_texts,
+):
+    """Tests that pooling texts across documents doesn't change their embeddings."""
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+
+    for parser_output, embeddings in encode_parser_outputs(
+        encoder, test_parser_outputs_with_texts, batch_size=4
+    ):
+        description_embedding, text_embeddings = encode_parser_output(
+            encoder, parser_output, batch_size=4
+        )
+
+        assert np.allclose(embeddings[0], description_embedding, atol=1e-5)
+        if text_embeddings is not None:
+            assert np.allclose(embeddings[1:], text_embeddings, atol=1e-5)
+        else:
+            assert embeddings.shape[0] == 1
+
+
+def test_encode_parser_outputs_padding_efficiency():
+    """Tests that bucketing texts by length across documents reduces padding."""
+    parser_outputs = [
+        get_parser_output_with_texts(
+            document_id=f"doc_{idx}",
+            description=f"description {idx}",
+            texts=[f"heading {idx}", f"paragraph {idx} is a long text " * 20],
+        )
+        for idx in range(8)
+    ]
+
+    efficiencies = []
+    for pool_batches in [1, 8]:
+        encoder = SBERTEncoder(config.SBERT_MODEL)
+        list(
+            encode_parser_outputs(
+                encoder, parser_outputs, batch_size=3, pool_batches=pool_batches
+            )
+        )
+        efficiencies.append(encoder.padding_stats.efficiency)
+
+    assert 0 < efficiencies[0] < efficiencies[1] <= 1
@@ -0,0 +1,64 @@
+import numpy as np
+
+from src.cache import CachedEncoder, EmbeddingCache
+
+
+def test_embedding_cache(tmp_path):
+    """Tests that embeddings are stored per model and persist across connections."""
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", "model-a", max_size_bytes=10_000)
+    embeddings = np.arange(8, dtype=np.float32).reshape(2, 4)
+
+    assert cache.get_many(["foo", "bar"]) == [None, None]
+    cache.put_many(["foo", "bar"], embeddings)
+
+    cached = cache.get_many(["bar", "baz"])
+    assert np.array_equal(cached[0], embeddings[1])
+    assert cached[1] is None
+    assert (cache.hits, cache.misses) == (1, 3)
+    cache.close()
+
+    reopened_cache = EmbeddingCache(
+        tmp_path / "cache.sqlite", "model-a", max_size_bytes=10_000
+    )
+    assert np.array_equal(reopened_cache.get_many(["foo"])[0], embeddings[0])
+
+    other_model_cache = EmbeddingCache(
+        tmp_path / "cache.sqlite", "model-b", max_size_bytes=10_000
+    )
+    assert other_model_cache.get_many(["foo"]) == [None]
+
+
+def test_embedding_cache_evicts_least_recently_used(tmp_path):
+    """Tests that the least recently used embeddings are evicted over the size cap."""
+    # Room for three embeddings of 4 float32s
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", "model", max_size_bytes=48)
+    embedding = np.ones((1, 4), dtype=np.float32)
+
+    for text in ["a", "b", "c"]:
+        cache.put_many([text], embedding)
+    cache.get_many(["a"])
+    cache.put_many(["d"], embedding)
+
+    assert [found is not None for found in cache.get_many(["a", "b", "c", "d"])] == [
+        True,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_cached_encoder(tmp_path, fake_encoder):
+    """Tests that only texts missing from the cache are encoded."""
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", "fake", max_size_bytes=10_000)
+    encoder = CachedEncoder(fake_encoder, cache)
+
+    first_embeddings = encoder.encode_batch(["foo", "bar", "foo"])
+    assert fake_encoder.batches == [["foo", "bar"]]
+
+    second_embeddings = encoder.encode_batch(["bar", "baz", "foo"])
+    assert fake_encoder.batches[-1] == ["baz"]
+
+    assert np.array_equal(first_embeddings[0], first_embeddings[2])
+    assert np.array_equal(second_embeddings[0], first_embeddings[1])
+    assert np.array_equal(second_embeddings[2], first_embeddings[0])
+    assert np.allclose(second_embeddings[1], fake_encoder.encode("baz"))
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from src.dedup import NearDuplicateIndex, get_lsh_bands, get_shingles
+
+PARAGRAPH = (
+    "The national adaptation plan sets out measures to reduce the vulnerability "
+    "of coastal communities to sea level rise and storm surges."
+)
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    return len(np.intersect1d(a, b)) / len(np.union1d(a, b))
+
+
+def test_get_shingles():
+    """Tests that shingles ignore case and whitespace, and handle short texts."""
+    assert np.array_equal(
+        get_shingles("Page 3 of  120"), get_shingles("page 3 of\n120")
+    )
+    assert len(get_shingles("abcdef", shingle_size=5)) == 2
+    assert len(get_shingles("ab", shingle_size=5)) == 1
+    assert len(get_shingles("", shingle_size=5)) == 1
+
+
+def test_get_lsh_bands():
+    """Tests that the banding's threshold is just below the requested threshold."""
+    for threshold in [0.5, 0.8, 0.95]:
+        bands, rows = get_lsh_bands(128, threshold)
+        assert bands * rows == 128
+        assert (1 / bands) ** (1 / rows) <= threshold
+
+
+def test_signature_estimates_jaccard_similarity():
+    """Tests that signatures agree on about as many rows as the Jaccard similarity."""
+    index = NearDuplicateIndex(threshold=0.5, n_permutations=256)
+    other_text = PARAGRAPH.replace("coastal communities", "island nations")
+
+    estimated = np.mean(
+        index.get_signature(PARAGRAPH) == index.get_signature(other_text)
+    )
+    actual = jaccard(get_shingles(PARAGRAPH), get_shingles(other_text))
+
+    assert estimated == pytest.approx(actual, abs=0.1)
+
+
+def test_near_duplicate_index():
+    """Tests that near-duplicates are found, and dissimilar texts aren't."""
+    index = NearDuplicateIndex(threshold=0.8)
+    index.add(PARAGRAPH)
+    index.add("An unrelated sentence about renewable energy targets for 2030.")
+
+    match = index.query(index.get_signature(PARAGRAPH + " Page 3"))
+    assert match is not None
+    assert match[0] == PARAGRAPH
+    assert match[1] >= 0.8
+
+    assert index.query(index.get_signature("Something else entirely.")) is None
+
+    index.remove(PARAGRAPH)
+    assert PARAGRAPH not in index
+    assert len(index) == 1
+    assert index.query(index.get_signature(PARAGRAPH + " Page 3")) is None
+
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(threshold=0)
@@ -0,0 +1,149 @@
+import numpy as np
+
+from src.batching import get_text_hash
+from src.incremental import PreviousOutputs, get_reusable_embeddings
+from src.manifest import ManifestEntry, get_embeddings_hash
+from src.test.conftest import get_parser_output_with_texts
+from src.writer import OutputIndex
+
+
+def test_get_reusable_embeddings():
+    """Tests that each text's embedding is keyed by its hash, if the rows line up."""
+    parser_output = get_parser_output_with_texts(
+        document_id="doc", description="description", texts=["block"]
+    )
+    embeddings = np.arange(4, dtype=np.float32).reshape(2, 2)
+
+    reusable_embeddings = get_reusable_embeddings(parser_output, embeddings)
+
+    assert set(reusable_embeddings) == {
+        get_text_hash("description"),
+        get_text_hash("block"),
+    }
+    assert np.array_equal(reusable_embeddings[get_text_hash("block")], embeddings[1])
+    assert get_reusable_embeddings(parser_output, embeddings[:1]) == {}
+
+
+def write_previous_outputs(
+    output_dir, parser_output, embeddings, model_id
+) -> ManifestEntry:
+    """Write a document's outputs, returning the manifest entry recording them."""
+    json_text = parser_output.model_dump_json()
+    (output_dir / f"{parser_output.document_id}.json").write_text(json_text)
+    np.save(output_dir / f"{parser_output.document_id}.npy", embeddings)
+    return ManifestEntry(
+        document_id=parser_output.document_id,
+        model_id=model_id,
+        json_sha256=get_text_hash(json_text),
+        npy_sha256=get_embeddings_hash(embeddings),
+    )
+
+
+def test_previous_outputs_local(tmp_path):
+    """Tests that previous outputs are loaded only for documents in the index."""
+    parser_output = get_parser_output_with_texts(
+        document_id="doc", description="description", texts=["block"]
+    )
+    entry = write_previous_outputs(
+        tmp_path, parser_output, np.ones((2, 3), dtype=np.float32), "model-a"
+    )
+
+    previous_outputs = PreviousOutputs(
+        str(tmp_path),
+        False,
+        OutputIndex({"doc.json", "doc.npy"}),
+        manifest_entries={"doc": entry},
+    )
+    previous_outputs.load("doc")
+    previous_outputs.load("new_doc")
+    assert previous_outputs.n_loaded == 1
+
+    # Embeddings of the wrong dimension aren't reused
+    assert previous_outputs.pop_reusable_embeddings(parser_output, 4, "model-a") is None
+
+    previous_outputs.load("doc")
+    reusable_embeddings = previous_outputs.pop_reusable_embeddings(
+        parser_output, 3, "model-a"
+    )
+    assert reusable_embeddings is not None
+    assert len(reusable_embeddings) == 2
+    assert previous_outputs.pop_reusable_embeddings(parser_output, 3, "model-a") is None
+
+
+def test_previous_outputs_model_mismatch(tmp_path):
+    """Tests that embeddings aren't reused unless made with the encoder's model."""
+    parser_outputs = {
+        document_id: get_parser_output_with_texts(
+            document_id=document_id, description="description", texts=["block"]
+        )
+        for document_id in ["doc_a", "doc_b"]
+    }
+    entries = {
+        document_id: write_previous_outputs(
+            tmp_path, parser_output, np.ones((2, 3), dtype=np.float32), "old-model"
+        )
+        for document_id, parser_output in parser_outputs.items()
+    }
+    entries["doc_b"].model_id = None
+
+    previous_outputs = PreviousOutputs(
+        str(tmp_path),
+        False,
+        OutputIndex({"doc_a.json", "doc_a.npy", "doc_b.json", "doc_b.npy"}),
+        manifest_entries=entries,
+    )
+    previous_outputs.load("doc_a")
+    previous_outputs.load("doc_b")
+
+    # doc_b's model isn't known, so its outputs aren't even read
+    assert previous_outputs.n_loaded == 1
+    assert (
+        previous_outputs.pop_reusable_embeddings(parser_outputs["doc_a"], 3, "model-a")
+        is None
+    )
+    assert (
+        previous_outputs.pop_reusable_embeddings(parser_outputs["doc_b"], 3, "model-a")
+        is None
+    )
+
+
+def test_previous_outputs_out_of_sync(tmp_path):
+    """Tests that a .json and .npy which the manifest didn't record together aren't paired."""
+    old_parser_output = get_parser_output_with_texts(
+        document_id="doc", description="description", texts=["old block"]
+    )
+    entry = write_previous_outputs(
+        tmp_path, old_parser_output, np.ones((2, 3), dtype=np.float32), "model-a"
+    )
+    output_index = OutputIndex({"doc.json", "doc.npy"})
+
+    # An interrupted run wrote the new .json, but not the .npy
+    new_parser_output = get_parser_output_with_texts(
+        document_id="doc", description="description", texts=["new block"]
+    )
+    (tmp_path / "doc.json").write_text(new_parser_output.model_dump_json())
+
+    previous_outputs = PreviousOutputs(
+        str(tmp_path), False, output_index, manifest_entries={"doc": entry}
+    )
+    previous_outputs.load("doc")
+    assert previous_outputs.n_loaded == 0
+    assert (
+        previous_outputs.pop_reusable_embeddings(new_parser_output, 3, "model-a")
+        is None
+    )
+
+    # And the other way round, a new .npy next to the old .json
+    write_previous_outputs(
+        tmp_path, old_parser_output, np.zeros((2, 3), dtype=np.float32), "model-a"
+    )
+    previous_outputs.load("doc")
+    assert previous_outputs.n_loaded == 0
+
+    # Entries recorded without hashes aren't trusted either
+    write_previous_outputs(
+        tmp_path, old_parser_output, np.ones((2, 3), dtype=np.float32), "model-a"
+    )
+    previous_outputs.manifest_entries["doc"] = ManifestEntry("doc", "model-a")
+    previous_outputs.load("doc")
+    assert previous_outputs.n_loaded == 0
@@ -0,0 +1,145 @@
+import numpy as np
+
+from src.manifest import (
+    CheckpointManifest,
+    InputVersion,
+    ManifestEntry,
+    get_changed_input_ids,
+    get_embeddings_hash,
+    get_input_versions,
+)
+from src.writer import BackgroundWriter
+
+
+def test_checkpoint_manifest_local(tmp_path):
+    """Tests that documents are recorded once both outputs are written."""
+    manifest = CheckpointManifest(str(tmp_path / "manifest"))
+
+    manifest.on_file_written("doc_a.json", 10)
+    manifest.expect("doc_a", "model-a", json_sha256="json-hash", npy_sha256="npy-hash")
+    assert manifest.n_recorded == 0
+
+    manifest.on_file_written("doc_a.npy", 20)
+    manifest.expect("doc_b", "model-a")
+    manifest.on_file_written("doc_b.npy", 20)
+
+    entries = CheckpointManifest(str(tmp_path / "manifest")).load()
+    assert entries == {
+        "doc_a": ManifestEntry(
+            document_id="doc_a",
+            model_id="model-a",
+            json_bytes=10,
+            npy_bytes=20,
+            json_sha256="json-hash",
+            npy_sha256="npy-hash",
+        )
+    }
+    assert entries["doc_a"].is_stale("model-b")
+
+
+def test_get_embeddings_hash():
+    """Tests that the hash of embeddings changes with their values and shape."""
+    embeddings = np.zeros((2, 3), dtype=np.float32)
+
+    assert get_embeddings_hash(embeddings) == get_embeddings_hash(embeddings.copy())
+    assert get_embeddings_hash(embeddings) != get_embeddings_hash(embeddings + 1)
+    assert get_embeddings_hash(embeddings) != get_embeddings_hash(
+        embeddings.reshape(3, 2)
+    )
+
+
+def test_checkpoint_manifest_ignores_partial_lines(tmp_path):
+    """Tests that a segment cut off mid-line by a killed run still loads."""
+    manifest = CheckpointManifest(str(tmp_path))
+    manifest.record_many([ManifestEntry(document_id="doc_a", model_id="model-a")])
+    with open(next(tmp_path.glob("*.jsonl")), "a") as f:
+        f.write('{"document_id": "doc_b", "mod')
+
+    assert set(CheckpointManifest(str(tmp_path)).load()) == {"doc_a"}
+
+
+def test_checkpoint_manifest_s3(pipeline_s3_client, s3_bucket_and_region):
+    """Tests that entries are written to S3 in segments, latest entries winning."""
+    path = f"s3://{s3_bucket_and_region['bucket']}/manifest"
+    manifest = CheckpointManifest(path, segment_size=2)
+    writer = BackgroundWriter(
+        f"s3://{s3_bucket_and_region['bucket']}/output",
+        s3=True,
+        on_written=manifest.on_file_written,
+    )
+
+    for document_id in ["doc_a", "doc_b", "doc_c"]:
+        writer.write_text(document_id + ".json", "{}")
+        writer.write_text(document_id + ".npy", "[]")
+        manifest.expect(document_id, "model-a")
+    writer.flush()
+    manifest.flush()
+    writer.verify()
+
+    rerun_manifest = CheckpointManifest(path, segment_size=2)
+    rerun_manifest.record_many([ManifestEntry(document_id="doc_a", model_id="new")])
+
+    entries = CheckpointManifest(path).load()
+    assert set(entries) == {"doc_a", "doc_b", "doc_c"}
+    assert entries["doc_a"].model_id == "new"
+    assert entries["doc_c"].json_bytes == 2
+
+
+def test_get_input_versions_local(tmp_path):
+    """Tests that local input files have a version which changes with the file."""
+    (tmp_path / "doc_a.json").write_text("{}")
+    (tmp_path / "doc_a.npy").write_text("")
+
+    versions = get_input_versions(str(tmp_path), s3=False)
+    assert set(versions) == {"doc_a"}
+
+    (tmp_path / "doc_a.json").write_text('{"changed": true}')
+    assert get_input_versions(str(tmp_path), s3=False) != versions
+
+    # A subset of files is looked up without listing, leaving out missing ones
+    (tmp_path / "doc_b.json").write_text("{}")
+    assert get_input_versions(
+        str(tmp_path), s3=False, file_names=["doc_a.json", "missing.json"]
+    ) == {"doc_a": get_input_versions(str(tmp_path), s3=False)["doc_a"]}
+
+
+def test_get_input_versions_s3(pipeline_s3_client, s3_bucket_and_region, test_prefix):
+    """Tests that S3 input versions are the objects' ETags and LastModified times."""
+    versions = get_input_versions(
+        f"s3://{s3_bucket_and_region['bucket']}/{test_prefix}/", s3=True
+    )
+
+    assert set(versions) == {"test_id"}
+    assert versions["test_id"].etag and '"' not in versions["test_id"].etag
+
+    assert (
+        get_input_versions(
+            f"s3://{s3_bucket_and_region['bucket']}/{test_prefix}",
+            s3=True,
+            file_names=["test_id.json", "missing.json"],
+        )
+        == versions
+    )
+
+
+def test_get_changed_input_ids():
+    """Tests that inputs are changed if their ETag or LastModified time moved on."""
+    old = InputVersion(etag="a", last_modified="2024-01-01T00:00:00+00:00")
+    new = InputVersion(etag="b", last_modified="2024-02-01T00:00:00+00:00")
+    entries = {
+        "same": ManifestEntry("same", "model", input_etag="a"),
+        "new_etag": ManifestEntry("new_etag", "model", input_etag="a"),
+        "newer": ManifestEntry(
+            "newer", "model", input_last_modified="2024-01-01T00:00:00+00:00"
+        ),
+        "imported": ManifestEntry("imported", None),
+    }
+    input_versions = {
+        "same": old,
+        "new_etag": new,
+        "newer": new,
+        "imported": new,
+        "not_encoded": new,
+    }
+
+    assert get_changed_input_ids(input_versions, entries) == {"new_etag", "newer"}
@@ -1,7 +1,20 @@
 import numpy as np
+import pytest
+import torch
 
 from src import config
-from src.ml import SBERTEncoder, sliding_window
+from src.ml import (
+    ONNXEncoder,
+    SBERTEncoder,
+    cpu_supports_bf16,
+    get_batch_boundaries,
+    get_onnx_model_path,
+    get_window_new_token_counts,
+    get_quantized_model_path,
+    load_encoder,
+    reduce_window_embeddings,
+    sliding_window,
+)
 
 
 def test_encoder():
@@ -12,6 +25,12 @@ def test_encoder():
     assert encoder is not None
 
     assert isinstance(encoder.encode("Hello world!"), np.ndarray)
+    np.testing.assert_allclose(
+        encoder.encode("Hello world!"),
+        encoder.encode_batch(["Hello world!"])[0],
+        rtol=1e-5,
+        atol=1e-6,
+    )
 
     assert isinstance(encoder.encode_batch(["Hello world!"] * 100), np.ndarray)
 
@@ -43,13 +62,272 @@ def test_encoder_sliding_window():
     assert not np.array_equal(embeddings[0, :], embeddings[1, :])
 
 
+def test_encoder_sliding_window_fills_context():
+    """Assert that long texts are windowed on tokens, filling the context window."""
+
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+
+    long_text = "Hello world! " * 500
+    n_text_tokens = len(encoder.get_token_ids(long_text))
+
+    assert n_text_tokens > encoder.window_size
+    assert encoder.get_n_tokens(long_text) == n_text_tokens + 2
+
+    embeddings = encoder.encode_batch([long_text])
+    assert embeddings.shape == (1, encoder.dimension)
+
+    # A text which fits in the context window is encoded the same way as by the
+    # underlying sentence-transformers model.
+    assert np.allclose(
+        encoder.encode_batch(["Hello world!"])[0],
+        encoder.encode("Hello world!"),
+        atol=1e-5,
+    )
+
+
+def test_tokenize_batch():
+    """Assert that batched tokenization matches tokenizing texts one at a time."""
+
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+
+    texts = ["Hello world!", "", "  Hello  ", "Hello world! " * 300]
+    token_ids = encoder.tokenize_batch(texts)
+
+    assert len(token_ids) == len(texts)
+    assert token_ids == [encoder.get_token_ids(text) for text in texts]
+    assert token_ids[1] == []
+    assert encoder.tokenize_batch([]) == []
+
+
 def test_sliding_window():
-    """Tests that the sliding_window function returns the correct embeddings."""
-    text = "Hello world! " * 50
+    """Tests that the sliding_window function returns the correct windows."""
+    token_ids = list(range(23))
     window_size = 10
     stride = 5
 
-    windows = sliding_window(text=text, window_size=window_size, stride=stride)
+    windows = sliding_window(
+        token_ids=token_ids, window_size=window_size, stride=stride
+    )
+
+    assert windows[0] == list(range(0, 10))
+    assert windows[1] == list(range(5, 15))
+    assert windows[2] == list(range(10, 20))
+    # The last window is aligned with the end so trailing tokens aren't dropped
+    assert windows[-1] == list(range(13, 23))
+    assert len(windows) == 4
+
+    assert sliding_window(token_ids=[1, 2, 3], window_size=10, stride=5) == [[1, 2, 3]]
+
+
+def test_get_window_new_token_counts():
+    """Tests that each window counts the tokens the window before didn't have."""
+    # Windows start at 0, 5, 10 and 13, as in test_sliding_window
+    assert get_window_new_token_counts(23, window_size=10, stride=5) == [10, 5, 5, 3]
+    assert get_window_new_token_counts(20, window_size=10, stride=5) == [10, 5, 5]
+    assert get_window_new_token_counts(3, window_size=10, stride=5) == [3]
+    assert sum(get_window_new_token_counts(1234, window_size=10, stride=5)) == 1234
+
+
+def test_get_batch_boundaries():
+    """Tests that batches are cut by count, or packed up to a token budget."""
+    sorted_lengths = [100, 60, 50, 10, 10, 10, 5]
+
+    assert get_batch_boundaries(sorted_lengths, batch_size=3) == [
+        (0, 3),
+        (3, 6),
+        (6, 7),
+    ]
+
+    # Each batch is padded to the length of its first (longest) sequence
+    assert get_batch_boundaries(
+        sorted_lengths, batch_size=3, max_tokens_per_batch=120
+    ) == [(0, 1), (1, 3), (3, 7)]
+
+    # A sequence longer than the budget still gets a batch of its own
+    assert get_batch_boundaries([500, 10], batch_size=3, max_tokens_per_batch=100) == [
+        (0, 1),
+        (1, 2),
+    ]
+
+    assert get_batch_boundaries([], batch_size=3, max_tokens_per_batch=100) == []
+
+
+def test_encoder_token_budget_batching():
+    """Assert that packing batches by token budget doesn't change the embeddings."""
+
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+
+    batch_to_encode = ["Hello world!", "Hello world! " * 100, "Hello", "world " * 600]
+
+    embeddings = encoder.encode_batch(batch_to_encode, batch_size=2)
+    embeddings_token_budget = encoder.encode_batch(
+        batch_to_encode, batch_size=2, max_tokens_per_batch=256
+    )
+
+    assert np.allclose(embeddings, embeddings_token_budget, atol=1e-5)
+
+
+def test_reduce_window_embeddings():
+    """Tests that window embeddings are averaged per text."""
+    window_embeddings = np.array(
+        [[1.0, 1.0], [2.0, 4.0], [4.0, 8.0], [3.0, 3.0]], dtype=np.float32
+    )
+    window_offsets = np.array([0, 1, 3, 4])
+
+    assert np.array_equal(
+        reduce_window_embeddings(window_embeddings, window_offsets),
+        np.array([[1.0, 1.0], [3.0, 6.0], [3.0, 3.0]], dtype=np.float32),
+    )
+
+    out = np.empty((3, 2), dtype=np.float32)
+    weighted = reduce_window_embeddings(
+        window_embeddings,
+        window_offsets,
+        window_weights=np.array([5, 3, 1, 2]),
+        out=out,
+    )
+    assert weighted is out
+    assert np.allclose(weighted, [[1.0, 1.0], [2.5, 5.0], [3.0, 3.0]])
+
+    assert reduce_window_embeddings(
+        np.empty((0, 2), dtype=np.float32), np.array([0])
+    ).shape == (0, 2)
+
 
-    assert windows[0] == "Hello worl"
-    assert windows[1] == " world! He"
+def test_encoder_window_embeddings():
+    """Assert that per-window embeddings can be kept as a ragged array."""
+
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+
+    batch_to_encode = ["Hello world!", "world " * 1200, ""]
+    window_embeddings, window_offsets = encoder.encode_batch_windows(batch_to_encode)
+
+    assert window_offsets[0] == 0
+    assert len(window_offsets) == len(batch_to_encode) + 1
+    assert list(np.diff(window_offsets)) == [1, 4, 1]
+    assert window_embeddings.shape == (window_offsets[-1], encoder.dimension)
+
+    embeddings = encoder.encode_batch(batch_to_encode)
+    assert np.allclose(embeddings[1], window_embeddings[1:5].mean(axis=0), atol=1e-5)
+
+    weighted_encoder = SBERTEncoder(
+        config.SBERT_MODEL, weight_windows_by_new_tokens=True
+    )
+    weighted_embeddings = weighted_encoder.encode_batch(batch_to_encode)
+    assert weighted_embeddings.shape == embeddings.shape
+    assert not np.isnan(weighted_embeddings).any()
+
+    # The long text's windows are weighted by the tokens each adds
+    weights = get_window_new_token_counts(
+        len(encoder.tokenize_batch([batch_to_encode[1]])[0]),
+        window_size=encoder.window_size,
+        stride=encoder.window_stride,
+    )
+    assert np.allclose(
+        weighted_embeddings[1],
+        np.average(window_embeddings[1:5], axis=0, weights=weights),
+        atol=1e-5,
+    )
+    assert np.allclose(weighted_embeddings[[0, 2]], embeddings[[0, 2]], atol=1e-5)
+
+
+def test_onnx_encoder():
+    """Assert that the ONNX encoder produces the same embeddings as the torch one."""
+    pytest.importorskip("onnxruntime")
+
+    torch_encoder = SBERTEncoder(config.SBERT_MODEL)
+    onnx_encoder = load_encoder(config.SBERT_MODEL, backend="onnx")
+
+    assert isinstance(onnx_encoder, ONNXEncoder)
+    assert get_onnx_model_path(config.SBERT_MODEL, onnx_encoder.model_revision).exists()
+    assert onnx_encoder.dimension == torch_encoder.dimension
+    assert onnx_encoder.model_id.endswith(";backend=onnx")
+    # The torch weights aren't kept in memory next to the ONNX Runtime session
+    assert onnx_encoder.encoder[0].auto_model is None
+
+    batch_to_encode = ["Hello world!", "Hello world! " * 300, ""]
+    assert np.allclose(
+        onnx_encoder.encode_batch(batch_to_encode, batch_size=2),
+        torch_encoder.encode_batch(batch_to_encode, batch_size=2),
+        atol=1e-4,
+    )
+    assert np.allclose(
+        onnx_encoder.encode("Hello world!"),
+        torch_encoder.encode("Hello world!"),
+        atol=1e-4,
+    )
+
+
+def test_load_encoder_unknown_backend():
+    """Assert that an unknown backend raises a helpful error."""
+    with pytest.raises(ValueError, match="Unknown encoder backend"):
+        load_encoder(config.SBERT_MODEL, backend="tensorflow")
+
+
+def test_encoder_int8_precision(monkeypatch):
+    """Assert that the int8 encoder is cached and produces embeddings of the same shape."""
+    encoder = SBERTEncoder(config.SBERT_MODEL, precision="int8")
+
+    assert get_quantized_model_path(config.SBERT_MODEL, encoder.model_revision).exists()
+
+    embeddings = encoder.encode_batch(["Hello world!", "Hello world! " * 300])
+    assert embeddings.shape == (2, encoder.dimension)
+    assert embeddings.dtype == np.float32
+
+    # Later startups load the cached weights without quantising the model again
+    def fail_to_quantize(*args, **kwargs):
+        raise AssertionError("quantize_dynamic was called")
+
+    monkeypatch.setattr(torch.ao.quantization, "quantize_dynamic", fail_to_quantize)
+    cached_encoder = SBERTEncoder(config.SBERT_MODEL, precision="int8")
+    np.testing.assert_array_equal(
+        cached_encoder.encode_batch(["Hello world!", "Hello world! " * 300]),
+        embeddings,
+    )
+
+    with pytest.raises(ValueError, match="Unknown precision"):
+        SBERTEncoder(config.SBERT_MODEL, precision="int4")
+
+
+def test_encoder_bf16_precision(monkeypatch):
+    """Assert that bf16 returns float32 embeddings, and falls back without support."""
+    encoder = SBERTEncoder(config.SBERT_MODEL, precision="bf16")
+
+    embeddings = encoder.encode_batch(["Hello world!", "Hello world! " * 300])
+    assert embeddings.shape == (2, encoder.dimension)
+    assert embeddings.dtype == np.float32
+
+    monkeypatch.setattr("src.ml.cpu_supports_bf16", lambda: False)
+    fallback_encoder = SBERTEncoder(config.SBERT_MODEL, precision="bf16")
+    assert fallback_encoder.precision == "fp32"
+
+
+def test_cpu_supports_bf16(tmp_path):
+    """Assert that bf16 support is read from the CPU flags."""
+    cpuinfo_path = tmp_path / "cpuinfo"
+
+    cpuinfo_path.write_text("processor\t: 0\nflags\t\t: fpu sse avx512f\n")
+    assert not cpu_supports_bf16(str(cpuinfo_path))
+
+    cpuinfo_path.write_text("processor\t: 0\nflags\t\t: fpu avx512f avx512_bf16\n")
+    assert cpu_supports_bf16(str(cpuinfo_path))
+
+    cpuinfo_path.write_text("processor\t: 0\nflags\t\t: fpu amx_tile amx_bf16\n")
+    assert cpu_supports_bf16(str(cpuinfo_path))
+
+    assert not cpu_supports_bf16(str(tmp_path / "missing"))
+
+
+def test_encoder_model_id():
+    """Assert that the model id changes with everything that changes the embeddings."""
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+
+    assert encoder.model_id == SBERTEncoder(config.SBERT_MODEL).model_id
+    assert encoder.model_id.startswith(f"{config.SBERT_MODEL}@")
+    assert (
+        encoder.model_id
+        != SBERTEncoder(config.SBERT_MODEL, weight_windows_by_new_tokens=True).model_id
+    )
+    assert (
+        encoder.model_id != SBERTEncoder(config.SBERT_MODEL, precision="int8").model_id
+    )
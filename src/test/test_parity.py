@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from src import config
+from src.ml import SBERTEncoder
+from src.parity import PARITY_SAMPLE_TEXTS, cosine_similarities, precision_parity_report
+
+
+def test_cosine_similarities():
+    """Tests that cosine similarities are computed row-wise."""
+    a = np.array([[1.0, 0.0], [1.0, 1.0], [0.0, 0.0]])
+    b = np.array([[2.0, 0.0], [-1.0, -1.0], [0.0, 0.0]])
+
+    assert np.allclose(cosine_similarities(a, b), [1.0, -1.0, 0.0])
+
+
+def test_precision_parity_report_identical(fake_encoder):
+    """Tests that an encoder has perfect parity with itself."""
+    report = precision_parity_report(fake_encoder, fake_encoder)
+
+    assert report["n_texts"] == len(PARITY_SAMPLE_TEXTS)
+    assert report["min_cosine_similarity"] == pytest.approx(1.0)
+    assert report["mean_cosine_similarity"] == pytest.approx(1.0)
+    assert report["max_abs_difference"] == 0.0
+
+
+def test_precision_parity_report_int8():
+    """Tests that int8 quantised embeddings are close to fp32 embeddings."""
+    reference = SBERTEncoder(config.SBERT_MODEL)
+    candidate = SBERTEncoder(config.SBERT_MODEL, precision="int8")
+
+    report = precision_parity_report(reference, candidate)
+
+    assert report["min_cosine_similarity"] > 0.95
+    assert report["mean_cosine_similarity"] <= 1.0 + 1e-6
+
+
+def test_precision_parity_report_bf16():
+    """Tests that bf16 embeddings are close to fp32 embeddings."""
+    reference = SBERTEncoder(config.SBERT_MODEL)
+    candidate = SBERTEncoder(config.SBERT_MODEL, precision="bf16")
+
+    report = precision_parity_report(reference, candidate)
+
+    assert report["min_cosine_similarity"] > 0.95
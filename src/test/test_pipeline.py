@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from src.pipeline import buffered, prefetch, take_until
+
+
+def test_buffered():
+    """Tests that buffered yields every item in order."""
+    assert list(buffered(range(100), max_size=3)) == list(range(100))
+    assert list(buffered([], max_size=3)) == []
+
+
+def test_buffered_is_bounded():
+    """Tests that the producer only runs ahead of the consumer by max_size items."""
+    produced = []
+
+    def produce():
+        for idx in range(100):
+            produced.append(idx)
+            yield idx
+
+    items = buffered(produce(), max_size=5)
+    assert next(items) == 0
+    time.sleep(0.3)
+
+    # The item being consumed, those in the queue and one waiting to be put on it
+    assert len(produced) <= 1 + 5 + 1
+
+
+def test_buffered_raises_producer_exceptions():
+    """Tests that an exception in the producer is raised to the consumer."""
+
+    def produce():
+        yield 1
+        raise ValueError("failed to read document")
+
+    items = buffered(produce(), max_size=2)
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="failed to read document"):
+        next(items)
+
+
+def test_buffered_stops_producer_when_closed():
+    """Tests that closing the iterator early stops the background thread."""
+    finished = threading.Event()
+
+    def produce():
+        try:
+            for idx in range(1000):
+                yield idx
+        finally:
+            finished.set()
+
+    items = buffered(produce(), max_size=2)
+    next(items)
+    items.close()
+
+    assert finished.wait(timeout=5)
+
+
+def test_prefetch():
+    """Tests that prefetch yields results in order, running calls concurrently."""
+
+    def slow_square(x: int) -> int:
+        time.sleep(0.1)
+        return x * x
+
+    start = time.perf_counter()
+    assert list(prefetch(slow_square, range(8), n_in_flight=8)) == [
+        x * x for x in range(8)
+    ]
+    assert time.perf_counter() - start < 0.5
+
+    assert list(prefetch(slow_square, [], n_in_flight=2)) == []
+
+
+def test_prefetch_raises_in_order():
+    """Tests that an exception is raised when the failed item's result is reached."""
+
+    def check(x: int) -> int:
+        if x == 2:
+            raise ValueError("bad item")
+        return x
+
+    results = prefetch(check, range(5), n_in_flight=3)
+    assert next(results) == 0
+    assert next(results) == 1
+    with pytest.raises(ValueError, match="bad item"):
+        next(results)
+
+
+def test_take_until():
+    """Tests that no items are taken once the event is set, and the source is closed."""
+    stop = threading.Event()
+    closed = threading.Event()
+
+    def produce():
+        try:
+            for idx in range(100):
+                if idx == 3:
+                    stop.set()
+                yield idx
+        finally:
+            closed.set()
+
+    assert list(take_until(stop, produce())) == [0, 1, 2, 3]
+    assert closed.is_set()
+    assert list(take_until(threading.Event(), range(5))) == list(range(5))
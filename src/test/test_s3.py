@@ -1,11 +1,17 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+from src import config
 from src.s3 import (
+    get_s3_client,
+    reset_s3_client,
     validate_s3_pattern,
     check_file_exists_in_s3,
     get_s3_keys_with_prefix,
+    get_s3_objects_with_prefix,
+    load_npy_from_s3,
     s3_object_read_text,
     write_json_to_s3,
     save_ndarray_to_s3_as_npy,
@@ -84,3 +90,44 @@ def test_save_ndarray_to_s3_as_npy(pipeline_s3_client, s3_bucket_and_region):
         )
     except Exception as e:
         assert "Bucket random_bucket does not exist" in str(e)
+
+
+def test_load_npy_from_s3(pipeline_s3_client, s3_bucket_and_region):
+    """Test that an ndarray saved to s3 loads back unchanged."""
+    array = np.arange(6, dtype=np.float32).reshape(2, 3)
+    path = f"s3://{s3_bucket_and_region['bucket']}/prefix/test.npy"
+    save_ndarray_to_s3_as_npy(array, path)
+
+    assert np.array_equal(load_npy_from_s3(path), array)
+
+
+def test_get_s3_client_is_shared():
+    """Test that one configured client is shared across calls and threads."""
+    reset_s3_client()
+    client = get_s3_client()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        clients = list(executor.map(lambda _: get_s3_client(), range(8)))
+
+    assert all(other is client for other in clients)
+    assert client.meta.config.max_pool_connections == config.S3_MAX_POOL_CONNECTIONS
+    assert client.meta.config.retries["mode"] == config.S3_RETRY_MODE
+    assert client.meta.config.connect_timeout == config.S3_CONNECT_TIMEOUT
+    assert client.meta.config.read_timeout == config.S3_READ_TIMEOUT
+
+    reset_s3_client()
+    assert get_s3_client() is not client
+    reset_s3_client()
+
+
+def test_get_s3_objects_with_prefix(
+    pipeline_s3_client, s3_bucket_and_region, test_prefix
+):
+    """Test that objects are listed with their ETag and LastModified time."""
+    objects = get_s3_objects_with_prefix(
+        f"s3://{s3_bucket_and_region['bucket']}/{test_prefix}/"
+    )
+
+    assert [o["Key"] for o in objects] == [f"{test_prefix}/test_id.json"]
+    assert objects[0]["ETag"]
+    assert objects[0]["LastModified"]
@@ -0,0 +1,33 @@
+import os
+import signal
+import threading
+
+from src.shutdown import handle_sigterm
+
+
+def test_handle_sigterm():
+    """Tests that SIGTERM sets the event, and the previous handler is restored."""
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    with handle_sigterm() as shutdown:
+        assert not shutdown.is_set()
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert shutdown.wait(timeout=5)
+
+    assert signal.getsignal(signal.SIGTERM) is previous_handler
+
+
+def test_handle_sigterm_off_main_thread():
+    """Tests that the handler isn't set outside the main thread."""
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    handlers = []
+
+    def run() -> None:
+        with handle_sigterm():
+            handlers.append(signal.getsignal(signal.SIGTERM))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    assert handlers == [previous_handler]
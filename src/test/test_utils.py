@@ -1,6 +1,8 @@
+import json
 from typing import Sequence
 
 import numpy as np
+import pytest
 from cpr_sdk.parser_models import BlockType, ParserOutput, PDFTextBlock
 
 from cli.test.conftest import test_pdf_file_json  # noqa: F401
@@ -10,7 +12,9 @@ from src.utils import (
     encode_parser_output,
     filter_blocks,
     filter_on_block_type,
+    get_files_to_process,
     get_ids_with_suffix,
+    iter_Text2EmbeddingsInput,
     replace_text_blocks,
 )
 
@@ -150,8 +154,65 @@ def test_encode_indexer_input(test_pdf_file_json):  # noqa: F811
     assert isinstance(text_embeddings, np.ndarray)
 
 
+@pytest.mark.parametrize("redo", [False, True])
+def test_get_files_to_process_local(tmp_path, monkeypatch, redo):
+    """Tests that encoded documents are skipped using a listing of the output dir."""
+    monkeypatch.setattr(config, "FILES_TO_PROCESS", None)
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for document_id in ["doc_a", "doc_b"]:
+        (input_dir / f"{document_id}.json").write_text("{}")
+
+    files_to_process = get_files_to_process(
+        False,
+        str(input_dir),
+        str(output_dir),
+        redo,
+        None,
+        output_file_names={"doc_a.json", "doc_a.npy"},
+    )
+
+    assert sorted(files_to_process) == (["doc_a", "doc_b"] if redo else ["doc_b"])
+
+
+def test_get_files_to_process_changed_inputs(tmp_path, monkeypatch):
+    """Tests that encoded documents whose input changed are processed again."""
+    monkeypatch.setattr(config, "FILES_TO_PROCESS", None)
+
+    files_to_process = get_files_to_process(
+        False,
+        str(tmp_path),
+        str(tmp_path),
+        False,
+        None,
+        output_file_names={"doc_a.npy", "doc_b.npy"},
+        input_file_names={"doc_a.json", "doc_b.json", "doc_c.json"},
+        changed_ids={"doc_b"},
+    )
+
+    assert sorted(files_to_process) == ["doc_b", "doc_c"]
+
+
 # TODO get_files_to_process
-#   TODO local files, s3 files, environment variable files
+#   TODO s3 files, environment variable files
 
 # TODO get_Text2EmbeddingsInput_array
-#   TODO needs s3 files, local files, of the form json IndexerInput objects
+#   TODO needs s3 files, of the form json IndexerInput objects
+
+
+def test_iter_Text2EmbeddingsInput_local(tmp_path, test_pdf_file_json):  # noqa: F811
+    """Tests that parser outputs are read lazily, one at a time, from local files."""
+    for document_id in ["doc_a", "doc_b"]:
+        (tmp_path / f"{document_id}.json").write_text(
+            json.dumps({**test_pdf_file_json, "document_id": document_id})
+        )
+
+    parser_outputs = iter_Text2EmbeddingsInput(
+        str(tmp_path), False, ["doc_a", "doc_b", "missing"]
+    )
+
+    assert next(parser_outputs).document_id == "doc_a"
+    assert next(parser_outputs).document_id == "doc_b"
+    with pytest.raises(FileNotFoundError):
+        next(parser_outputs)
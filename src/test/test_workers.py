@@ -0,0 +1,84 @@
+import numpy as np
+
+from src import config, workers
+from src.ml import SBERTEncoder
+from src.workers import (
+    ParallelEncoder,
+    can_share_weights,
+    get_available_cores,
+    is_oversubscribed,
+    split_cores,
+    split_texts,
+)
+
+
+def test_split_cores():
+    """Tests that each worker gets its own contiguous set of cores."""
+    assert split_cores(list(range(8)), 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert split_cores(list(range(4)), 4) == [[0], [1], [2], [3]]
+
+    # Cores are shared when there are more workers than cores
+    assert split_cores([0, 1], 3) == [[0], [1], [0]]
+
+
+def test_is_oversubscribed():
+    """Tests that oversubscription is detected against the available cores."""
+    n_cores = len(get_available_cores())
+
+    assert not is_oversubscribed(1, n_cores)
+    assert is_oversubscribed(2, n_cores)
+
+
+def test_split_texts():
+    """Tests that texts are split into contiguous chunks of similar size."""
+    texts = ["a" * 10, "b", "c", "d" * 10, "e"]
+
+    chunks = split_texts(texts, 2)
+    assert [text for chunk in chunks for text in chunk] == texts
+    assert chunks == [["a" * 10, "b"], ["c", "d" * 10, "e"]]
+
+    assert split_texts(["a"], 4) == [["a"]]
+    assert split_texts([], 4) == []
+
+
+def test_parallel_encoder():
+    """Tests that encoding across workers matches encoding in one process."""
+    batch_to_encode = ["Hello world!", "Hello world! " * 300, "", "Hello"] * 3
+
+    with ParallelEncoder(config.SBERT_MODEL, n_workers=2) as parallel_encoder:
+        # Every worker has started, and loaded its model, before the first batch
+        for executor in parallel_encoder._executors:
+            assert len(executor._processes) == 1
+
+        embeddings = parallel_encoder.encode_batch(batch_to_encode, batch_size=4)
+        assert parallel_encoder.padding_stats.padded_tokens > 0
+
+        assert parallel_encoder.encode_batch([]).shape == (
+            0,
+            parallel_encoder.dimension,
+        )
+
+    encoder = SBERTEncoder(config.SBERT_MODEL)
+    assert np.allclose(
+        embeddings, encoder.encode_batch(batch_to_encode, batch_size=4), atol=1e-5
+    )
+
+
+def _worker_weights_are_shared() -> bool:
+    assert workers._worker_encoder is not None
+    return all(
+        parameter.is_shared()
+        for parameter in workers._worker_encoder.encoder.parameters()
+    )
+
+
+def test_parallel_encoder_shares_weights():
+    """Tests that workers use one copy of the weights, in shared memory."""
+    assert can_share_weights("torch", "fp32")
+    assert can_share_weights("torch", "bf16")
+    assert not can_share_weights("torch", "int8")
+    assert not can_share_weights("onnx", "fp32")
+
+    with ParallelEncoder(config.SBERT_MODEL, n_workers=2) as parallel_encoder:
+        for executor in parallel_encoder._executors:
+            assert executor.submit(_worker_weights_are_shared).result()
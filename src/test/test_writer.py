@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+import pytest
+
+from src.writer import (
+    BackgroundWriter,
+    OutputIndex,
+    OutputWriteError,
+    list_file_names,
+)
+
+
+def test_background_writer(tmp_path):
+    """Tests that queued files are written and verified in a local directory."""
+    writer = BackgroundWriter(str(tmp_path), s3=False, n_threads=2)
+    array = np.arange(6, dtype=np.float32).reshape(2, 3)
+
+    writer.write_text("doc.json", '{"document_id": "doc"}')
+    writer.write_npy("doc.npy", array)
+    writer.flush()
+    writer.verify()
+
+    assert list_file_names(str(tmp_path), s3=False) == {"doc.json", "doc.npy"}
+    assert (tmp_path / "doc.json").read_text() == '{"document_id": "doc"}'
+    assert np.array_equal(np.load(tmp_path / "doc.npy"), array)
+    assert writer.n_files_written == 2
+    assert writer.n_bytes_written == len('{"document_id": "doc"}') + array.nbytes
+
+
+def test_background_writer_retries(tmp_path):
+    """Tests that failed writes are retried, and reported once out of attempts."""
+    writer = BackgroundWriter(str(tmp_path), s3=False, max_attempts=3, retry_delay=0.01)
+    attempts = {"flaky.json": 0, "broken.json": 0}
+
+    def write(file_name: str, n_failures: int) -> None:
+        attempts[file_name] += 1
+        if attempts[file_name] <= n_failures:
+            raise ConnectionError("connection reset")
+        (tmp_path / file_name).write_text("{}")
+
+    writer._submit("flaky.json", 2, lambda: write("flaky.json", n_failures=2))
+    writer._submit("broken.json", 2, lambda: write("broken.json", n_failures=3))
+
+    writer.flush()
+    with pytest.raises(OutputWriteError, match="broken.json"):
+        writer.verify()
+
+    assert attempts == {"flaky.json": 3, "broken.json": 3}
+    assert writer.n_files_written == 1
+    assert (tmp_path / "flaky.json").exists()
+
+
+def test_background_writer_bounds_in_flight_bytes(tmp_path):
+    """Tests that queueing a write blocks while too many bytes are in flight."""
+    writer = BackgroundWriter(str(tmp_path), s3=False, max_in_flight_bytes=10)
+    release = threading.Event()
+
+    def blocked_write() -> None:
+        release.wait()
+        (tmp_path / "first.json").write_text("{}")
+
+    writer._submit("first.json", 8, blocked_write)
+
+    second_queued = threading.Event()
+
+    def queue_second() -> None:
+        writer.write_text("second.json", "{}" * 2)
+        second_queued.set()
+
+    threading.Thread(target=queue_second).start()
+    assert not second_queued.wait(timeout=0.2)
+
+    release.set()
+    assert second_queued.wait(timeout=5)
+    writer.flush()
+    writer.verify()
+
+
+def test_background_writer_updates_output_index(tmp_path):
+    """Tests that written files are added to the output index, and failed ones aren't."""
+    (tmp_path / "old.npy").write_bytes(b"")
+    output_index = OutputIndex.from_listing(str(tmp_path), s3=False)
+    writer = BackgroundWriter(
+        str(tmp_path), s3=False, max_attempts=1, output_index=output_index
+    )
+
+    def failing_write() -> None:
+        raise ConnectionError("connection reset")
+
+    writer.write_npy("new.npy", np.zeros(3, dtype=np.float32))
+    writer._submit("broken.json", 2, failing_write)
+
+    writer.flush()
+    with pytest.raises(OutputWriteError):
+        writer.verify()
+
+    assert output_index.file_names == {"old.npy", "new.npy"}
+    assert "new.npy" in output_index
+    assert "broken.json" not in output_index
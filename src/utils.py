@@ -1,13 +1,17 @@
+import functools
 import logging
 import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional, Sequence, Set, Tuple, Union
+from typing import Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
 import numpy as np
 from cpr_sdk.parser_models import BlockType, ParserOutput, TextBlock
 
 from src import config
 from src.ml import SentenceEncoder
+from src.pipeline import prefetch
 from src.s3 import get_s3_keys_with_prefix, s3_object_read_text
 
 logger = logging.getLogger(__name__)
@@ -56,6 +60,18 @@ def filter_on_block_type(
     """
     Filter a sequence of ParserOutputs.
 
+    Remove the text blocks that are of the types declared in the remove block types
+    array.
+    """
+    return list(iter_filter_on_block_type(inputs, remove_block_types))
+
+
+def iter_filter_on_block_type(
+    inputs: Iterable[ParserOutput], remove_block_types: List[str]
+) -> Iterator[ParserOutput]:
+    """
+    Filter ParserOutputs one at a time.
+
     Remove the text blocks that are of the types declared in the remove block types
     array.
     """
@@ -69,15 +85,13 @@ def filter_on_block_type(
             )
             remove_block_types.remove(_filter)
 
-    return [
-        replace_text_blocks(
+    for _input in inputs:
+        yield replace_text_blocks(
             block=_input,
             new_text_blocks=filter_blocks(
                 parser_output=_input, remove_block_types=remove_block_types
             ),
         )
-        for _input in inputs
-    ]
 
 
 def get_ids_with_suffix(files: Sequence[str], suffix: str) -> Set[str]:
@@ -122,15 +136,46 @@ def encode_parser_output(
     return description_embedding, text_embeddings
 
 
+def get_files_to_process_subset() -> Optional[List[str]]:
+    """
+    Return the input file names set in the FILES_TO_PROCESS config, if any.
+
+    FILES_TO_PROCESS is a list of file names, each preceded by a $.
+    """
+    if config.FILES_TO_PROCESS is None:
+        return None
+
+    return config.FILES_TO_PROCESS.split("$")[1:]
+
+
 def get_files_to_process(
-    s3: bool, input_dir: str, output_dir: str, redo: bool, limit: Union[None, int]
+    s3: bool,
+    input_dir: str,
+    output_dir: str,
+    redo: bool,
+    limit: Union[None, int],
+    output_file_names: Optional[Iterable[str]] = None,
+    input_file_names: Optional[Iterable[str]] = None,
+    changed_ids: Optional[Set[str]] = None,
 ) -> Sequence[str]:
     """
     Get the list of files to process.
 
-    Either from the config or from the input directory.
+    Either from the config or from the input directory. Documents whose embeddings
+    are already in the output directory are excluded, unless `redo` is set or
+    their input has changed since.
+
+    :param output_file_names: names of the files in the output directory, if
+        already listed. The output directory is listed if not given.
+    :param input_file_names: names of the files in the input directory, if already
+        listed. The input directory is listed if not given.
+    :param changed_ids: ids of documents whose input changed after their embeddings
+        were made, e.g. from `get_changed_input_ids`
     """
-    if s3:
+    changed_ids = changed_ids or set()
+    if output_file_names is not None:
+        document_paths_previously_parsed = list(output_file_names)
+    elif s3:
         document_paths_previously_parsed = get_s3_keys_with_prefix(output_dir)
     else:
         document_paths_previously_parsed = os.listdir(output_dir)
@@ -139,9 +184,11 @@ def get_files_to_process(
         document_paths_previously_parsed, ".npy"
     )
 
-    if config.FILES_TO_PROCESS is not None:
-        files_to_process_subset = config.FILES_TO_PROCESS.split("$")[1:]
+    files_to_process_subset = get_files_to_process_subset()
+    if files_to_process_subset is not None:
         files_to_process = [os.path.join(input_dir, f) for f in files_to_process_subset]
+    elif input_file_names is not None:
+        files_to_process = list(input_file_names)
     else:
         if s3:
             files_to_process = get_s3_keys_with_prefix(input_dir)
@@ -152,14 +199,22 @@ def get_files_to_process(
     files_already_processed = document_ids_previously_parsed.intersection(
         files_to_process_ids
     )
+    files_changed = files_already_processed.intersection(changed_ids)
     if not redo and files_already_processed:
         logger.warning(
-            f"{len(files_already_processed)} "
+            f"{len(files_already_processed) - len(files_changed)} "
             f"documents found that have already been encoded. Skipping. "
         )
+    if not redo and files_changed:
+        logger.info(
+            f"{len(files_changed)} documents have changed since they were encoded. "
+            "Encoding them again."
+        )
 
     files_to_process_ids_sequence = [
-        id_ for id_ in files_to_process_ids if id_ not in document_ids_previously_parsed
+        id_
+        for id_ in files_to_process_ids
+        if redo or id_ not in document_ids_previously_parsed or id_ in changed_ids
     ]
     if not files_to_process_ids_sequence:
         logger.warning("No more documents to encode. Exiting.")
@@ -182,11 +237,45 @@ def get_Text2EmbeddingsInput_array(
     These objects will be used to generate embeddings and are either read in from S3
     or from the local file system.
     """
-    return [
-        ParserOutput.model_validate_json(
-            s3_object_read_text(os.path.join(input_dir, id_ + ".json"))
-            if s3
-            else Path(os.path.join(input_dir, id_ + ".json")).read_text()
-        )
-        for id_ in files_to_process_ids
-    ]
+    return list(iter_Text2EmbeddingsInput(input_dir, s3, files_to_process_ids))
+
+
+def read_Text2EmbeddingsInput(input_dir: str, s3: bool, id_: str) -> ParserOutput:
+    """Construct a ParserOutput object from a parser output json."""
+    return ParserOutput.model_validate_json(
+        s3_object_read_text(os.path.join(input_dir, id_ + ".json"))
+        if s3
+        else Path(os.path.join(input_dir, id_ + ".json")).read_text()
+    )
+
+
+def iter_Text2EmbeddingsInput(
+    input_dir: str,
+    s3: bool,
+    files_to_process_ids: Iterable[str],
+    n_prefetch: int = 1,
+) -> Iterator[ParserOutput]:
+    """
+    Construct ParserOutput objects from parser output jsons, one at a time.
+
+    The next `n_prefetch` jsons are read and validated in a thread pool while the
+    caller works on the current one, so read latency (e.g. S3 GETs) is hidden.
+    """
+    return prefetch(
+        functools.partial(read_Text2EmbeddingsInput, input_dir, s3),
+        files_to_process_ids,
+        n_in_flight=n_prefetch,
+    )
+
+
+@contextmanager
+def log_duration(phase: str) -> Iterator[None]:
+    """Log how long the code in the `with` block took to run."""
+    start = time.perf_counter()
+    yield
+    duration = time.perf_counter() - start
+
+    logger.info(
+        f"{phase} took {duration:.2f}s.",
+        extra={"props": {"phase": phase, "duration_seconds": round(duration, 3)}},
+    )
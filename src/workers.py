@@ -0,0 +1,262 @@
+"""Encoding with a pool of CPU worker processes."""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+from src.ml import PaddingStats, SBERTEncoder, SentenceEncoder, load_encoder
+from src.shutdown import ignore_sigterm
+
+logger = logging.getLogger(__name__)
+
+# The encoder of the current worker process, set by `_init_worker`
+_worker_encoder: Optional[SBERTEncoder] = None
+
+
+def get_available_cores() -> List[int]:
+    """Return the ids of the CPU cores this process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: Sequence[int], n_workers: int) -> List[List[int]]:
+    """
+    Split CPU cores into one contiguous core set per worker.
+
+    If there are fewer cores than workers, cores are shared between workers.
+    """
+    if n_workers <= len(cores):
+        return [
+            [int(core) for core in core_set]
+            for core_set in np.array_split(cores, n_workers)
+        ]
+
+    return [[cores[idx % len(cores)]] for idx in range(n_workers)]
+
+
+def is_oversubscribed(n_workers: int, threads_per_worker: int) -> bool:
+    """Return whether the workers' threads would outnumber the available cores."""
+    return n_workers * threads_per_worker > len(get_available_cores())
+
+
+def split_texts(text_batch: Sequence[str], n_chunks: int) -> List[List[str]]:
+    """
+    Split texts into contiguous chunks with roughly equal numbers of characters.
+
+    Empty chunks are dropped.
+    """
+    cumulative_lengths = np.cumsum([len(text) + 1 for text in text_batch])
+    if len(cumulative_lengths) == 0:
+        return []
+
+    targets = cumulative_lengths[-1] * np.arange(1, n_chunks) / n_chunks
+    boundaries = [0, *np.searchsorted(cumulative_lengths, targets), len(text_batch)]
+
+    return [
+        list(text_batch[start:end])
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+        if end > start
+    ]
+
+
+def can_share_weights(backend: str, precision: str) -> bool:
+    """
+    Return whether workers can share one copy of an encoder's weights.
+
+    Weights of torch models are shared through shared memory. Quantised torch models
+    keep their weights in packed parameters which can't be moved to shared memory,
+    and ONNX Runtime sessions can't be sent to other processes, so with those each
+    worker loads its own copy of the model.
+    """
+    return backend == "torch" and precision in ("fp32", "bf16")
+
+
+def _init_worker(
+    cores: List[int],
+    n_threads: int,
+    encoder_kwargs: dict,
+    shared_encoder: Optional[SBERTEncoder] = None,
+) -> None:
+    """
+    Pin a worker process to its cores and set up its encoder.
+
+    The worker uses `shared_encoder` if given, whose weights are in shared memory,
+    otherwise it loads its own encoder.
+    """
+    import torch
+
+    global _worker_encoder
+
+    # The main process handles SIGTERM, finishing its current batch before it shuts
+    # the workers down
+    ignore_sigterm()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(n_threads)
+
+    _worker_encoder = shared_encoder or load_encoder(**encoder_kwargs)
+
+
+def _get_worker_dimension() -> int:
+    assert _worker_encoder is not None
+    return _worker_encoder.dimension
+
+
+def _get_worker_model_id() -> str:
+    assert _worker_encoder is not None
+    return _worker_encoder.model_id
+
+
+def _encode_batch_in_worker(
+    text_batch: List[str], encode_batch_kwargs: dict
+) -> tuple[np.ndarray, PaddingStats]:
+    """Encode texts with the worker's encoder, returning the padding it added too."""
+    assert _worker_encoder is not None
+    _worker_encoder.padding_stats = PaddingStats()
+    embeddings = _worker_encoder.encode_batch(text_batch, **encode_batch_kwargs)
+
+    return embeddings, _worker_encoder.padding_stats
+
+
+class ParallelEncoder(SentenceEncoder):
+    """
+    Encoder which spreads encoding across a pool of CPU worker processes.
+
+    Each worker is pinned to its own set of CPU cores and uses as many torch threads
+    as it has cores, as torch's intra-op parallelism stops scaling well beyond a
+    handful of threads. Each call to `encode_batch` is split into one chunk per
+    worker, and the chunks are encoded in parallel.
+
+    Where possible (see `can_share_weights`) the model is loaded once, in this
+    process, and its weights are moved to shared memory which every worker maps, so
+    memory use doesn't grow with the number of workers. Otherwise each worker loads
+    its own copy of the model.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        n_workers: int,
+        threads_per_worker: Optional[int] = None,
+        **encoder_kwargs: Any,
+    ):
+        """
+        Start the worker processes.
+
+        :param model_name: name or path of the model
+        :param n_workers: number of worker processes
+        :param threads_per_worker: number of torch threads per worker. Defaults to
+            the number of cores each worker is pinned to.
+        :param encoder_kwargs: other arguments to `load_encoder`
+        """
+        import torch.multiprocessing
+
+        super().__init__()
+
+        core_sets = split_cores(get_available_cores(), n_workers)
+        n_threads = [threads_per_worker or len(cores) for cores in core_sets]
+        encoder_kwargs = dict(model_name=model_name, **encoder_kwargs)
+
+        shared_encoder = None
+        if can_share_weights(
+            encoder_kwargs.get("backend", "torch"),
+            encoder_kwargs.get("precision", "fp32"),
+        ):
+            shared_encoder = load_encoder(**encoder_kwargs)
+            shared_encoder.encoder.share_memory()
+
+        # torch's multiprocessing context sends tensors in shared memory to workers
+        # as handles to that memory, rather than copying them. Workers are spawned
+        # rather than forked, as forking after torch has started its thread pool can
+        # deadlock the workers.
+        mp_context = torch.multiprocessing.get_context("spawn")
+
+        self._executors = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=mp_context,
+                initializer=_init_worker,
+                initargs=(cores, worker_threads, encoder_kwargs, shared_encoder),
+            )
+            for cores, worker_threads in zip(core_sets, n_threads)
+        ]
+        self.padding_stats = PaddingStats()
+        # Processes only start on their first task, so give every worker one now.
+        # This way they all load their models while the encoder is being loaded,
+        # rather than in the first call to `encode_batch`.
+        dimensions = [
+            future.result()
+            for future in [
+                executor.submit(_get_worker_dimension) for executor in self._executors
+            ]
+        ]
+        self._dimension = dimensions[0]
+        self.model_id = self._executors[0].submit(_get_worker_model_id).result()
+
+        logger.info(
+            f"Started {n_workers} encoding workers.",
+            extra={
+                "props": {
+                    "core_sets": core_sets,
+                    "threads_per_worker": n_threads,
+                    "shared_weights": shared_encoder is not None,
+                }
+            },
+        )
+
+    def encode(self, text: str, device: Optional[str] = None) -> np.ndarray:
+        """Encode a string, return a numpy array."""
+        return self.encode_batch([text], device=device)[0]
+
+    def encode_batch(
+        self,
+        text_batch: List[str],
+        batch_size: int = 32,
+        device: Optional[str] = None,
+        **kwargs: Any,
+    ) -> np.ndarray:
+        """
+        Encode a batch of strings across the workers, return a numpy array.
+
+        For args, see SBERTEncoder.encode_batch.
+        """
+        chunks = split_texts(text_batch, len(self._executors))
+        if not chunks:
+            return np.empty((0, self.dimension), dtype=np.float32)
+
+        encode_batch_kwargs = dict(batch_size=batch_size, device=device, **kwargs)
+        futures = [
+            executor.submit(_encode_batch_in_worker, chunk, encode_batch_kwargs)
+            for executor, chunk in zip(self._executors, chunks)
+        ]
+
+        embeddings = []
+        for future in futures:
+            chunk_embeddings, padding_stats = future.result()
+            embeddings.append(chunk_embeddings)
+            self.padding_stats.real_tokens += padding_stats.real_tokens
+            self.padding_stats.padded_tokens += padding_stats.padded_tokens
+
+        return np.vstack(embeddings)
+
+    @property
+    def dimension(self) -> int:
+        """Return the dimension of the embeddings produced by the encoder."""
+        return self._dimension
+
+    def close(self) -> None:
+        """Shut down the worker processes."""
+        for executor in self._executors:
+            executor.shutdown()
+
+    def __enter__(self) -> "ParallelEncoder":
+        """Return the encoder, to be closed when the block exits."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Shut down the workers."""
+        self.close()
@@ -0,0 +1,235 @@
+"""Writing of output files in the background."""
+
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Set
+
+import numpy as np
+
+from src.s3 import get_s3_keys_with_prefix, save_ndarray_to_s3_as_npy, write_json_to_s3
+
+logger = logging.getLogger(__name__)
+
+
+class OutputWriteError(Exception):
+    """Raised when output files couldn't be written."""
+
+
+def list_file_names(directory: str, s3: bool) -> Set[str]:
+    """Return the names of the files in a local or S3 directory."""
+    if s3:
+        return {os.path.basename(key) for key in get_s3_keys_with_prefix(directory)}
+
+    return set(os.listdir(directory))
+
+
+class OutputIndex:
+    """
+    In-memory index of the files in an output directory.
+
+    It's built from a single listing of the directory at the start of a run and
+    updated as outputs are written, so checking whether a document's outputs exist
+    doesn't cost a request per document.
+    """
+
+    def __init__(self, file_names: Iterable[str] = ()):
+        self._file_names: Set[str] = set(file_names)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_listing(cls, directory: str, s3: bool) -> "OutputIndex":
+        """Build the index by listing a local or S3 directory."""
+        return cls(list_file_names(directory, s3))
+
+    def __contains__(self, file_name: str) -> bool:
+        """Return whether a file is in the output directory."""
+        with self._lock:
+            return file_name in self._file_names
+
+    def __len__(self) -> int:
+        """Return the number of files in the output directory."""
+        with self._lock:
+            return len(self._file_names)
+
+    @property
+    def file_names(self) -> Set[str]:
+        """A copy of the names of the files in the index."""
+        with self._lock:
+            return set(self._file_names)
+
+    def add(self, file_name: str) -> None:
+        """Record that a file has been written to the output directory."""
+        with self._lock:
+            self._file_names.add(file_name)
+
+
+class BackgroundWriter:
+    """
+    Writes output files to a local or S3 directory in a pool of background threads.
+
+    Writes are queued with `write_text` and `write_npy`, which return straight away
+    so that uploads run while the next documents are encoded. The total size of the
+    queued and running writes is bounded by `max_in_flight_bytes`: once it's reached,
+    queueing another write blocks until earlier ones finish. Failed writes are
+    retried with exponential backoff.
+
+    `flush` must be called once all outputs are queued, to wait for the writes to
+    finish. `verify` then raises if any write failed. A write that returned without
+    an error is taken to have succeeded, so the output directory isn't listed.
+
+    If an `OutputIndex` is given, each file is added to it once written, and
+    `on_written` is called with each file's name and size once it's written.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        s3: bool,
+        n_threads: int = 8,
+        max_in_flight_bytes: int = 256 * 1024 * 1024,
+        max_attempts: int = 3,
+        retry_delay: float = 1.0,
+        output_index: Optional[OutputIndex] = None,
+        on_written: Optional[Callable[[str, int], None]] = None,
+    ):
+        """
+        Start the writer threads.
+
+        :param output_dir: local directory or S3 prefix to write to
+        :param s3: whether output_dir is in S3
+        :param n_threads: number of writes to run concurrently
+        :param max_in_flight_bytes: maximum total size of queued and running writes.
+            A single write larger than this still goes ahead, on its own.
+        :param max_attempts: number of times to try each write
+        :param retry_delay: seconds to wait before the first retry, doubling for
+            each retry after that
+        :param output_index: index of the output directory to add written files to
+        :param on_written: function called from a writer thread with the name and
+            size of each file once it's written
+        """
+        self.output_dir = output_dir
+        self.s3 = s3
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.output_index = output_index
+        self.on_written = on_written
+
+        self.n_files_written = 0
+        self.n_bytes_written = 0
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="writer"
+        )
+        self._in_flight_bytes = 0
+        self._in_flight_changed = threading.Condition()
+        self._failed_file_names: List[str] = []
+
+    def write_text(self, file_name: str, text: str) -> None:
+        """Queue writing text to a file in the output directory."""
+        path = os.path.join(self.output_dir, file_name)
+        write = (
+            functools.partial(write_json_to_s3, text, path)
+            if self.s3
+            else functools.partial(Path(path).write_text, text)
+        )
+
+        self._submit(file_name, len(text.encode("utf-8")), write)
+
+    def write_npy(self, file_name: str, array: np.ndarray) -> None:
+        """Queue saving an array as a .npy file in the output directory."""
+        path = os.path.join(self.output_dir, file_name)
+        write = (
+            functools.partial(save_ndarray_to_s3_as_npy, array, path)
+            if self.s3
+            else functools.partial(np.save, path, array)
+        )
+
+        self._submit(file_name, array.nbytes, write)
+
+    def _submit(self, file_name: str, n_bytes: int, write: Callable[[], None]) -> None:
+        with self._in_flight_changed:
+            self._in_flight_changed.wait_for(
+                lambda: self._in_flight_bytes == 0
+                or self._in_flight_bytes + n_bytes <= self.max_in_flight_bytes
+            )
+            self._in_flight_bytes += n_bytes
+            self._executor.submit(self._write_with_retries, file_name, n_bytes, write)
+
+    def _write_with_retries(
+        self, file_name: str, n_bytes: int, write: Callable[[], None]
+    ) -> None:
+        succeeded = False
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    write()
+                    succeeded = True
+                    if self.output_index is not None:
+                        self.output_index.add(file_name)
+                    if self.on_written is not None:
+                        self.on_written(file_name, n_bytes)
+                    return
+                except Exception as e:
+                    if attempt == self.max_attempts:
+                        logger.error(
+                            f"Failed to write {file_name}.",
+                            extra={
+                                "props": {"file_name": file_name, "exception": str(e)}
+                            },
+                        )
+                        return
+
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    logger.warning(
+                        f"Failed to write {file_name}, retrying in {delay:.1f}s.",
+                        extra={
+                            "props": {
+                                "file_name": file_name,
+                                "attempt": attempt,
+                                "exception": str(e),
+                            }
+                        },
+                    )
+                    time.sleep(delay)
+        finally:
+            with self._in_flight_changed:
+                self._in_flight_bytes -= n_bytes
+                if succeeded:
+                    self.n_files_written += 1
+                    self.n_bytes_written += n_bytes
+                else:
+                    self._failed_file_names.append(file_name)
+                self._in_flight_changed.notify_all()
+
+    def flush(self) -> None:
+        """Wait for all queued writes to finish, and stop the writer threads."""
+        self._executor.shutdown()
+
+        logger.info(
+            f"Wrote {self.n_files_written} output files.",
+            extra={
+                "props": {
+                    "n_files": self.n_files_written,
+                    "n_bytes": self.n_bytes_written,
+                    "n_failed": len(self._failed_file_names),
+                }
+            },
+        )
+
+    def verify(self) -> None:
+        """
+        Check that every write succeeded. Must be called after `flush`.
+
+        :raises OutputWriteError: if any write failed after all its attempts
+        """
+        if self._failed_file_names:
+            raise OutputWriteError(
+                f"{len(self._failed_file_names)} output files failed to write to "
+                f"{self.output_dir}: {sorted(self._failed_file_names)}"
+            )